@@ -1,13 +1,28 @@
+import asyncio
+import logging
 from lib.utils import setup_log
 from lib.model_runner import ModelRunner
 from lib.data_processing import ResponseParser
+from lib.inference_engine import run_jobs_concurrently
+from lib.http_transport import HttpTransportSettings
+from lib.shutdown import DEFAULT_DRAIN_SECONDS, RunInterrupted
 from lib.config import MyConfig
 from configlist import config_list
 
+logger = logging.getLogger(__name__)
+
 skip_if_exist = True
 # skip_if_exist = False
 
+# Run the requests of all configs in one pass: jobs of the same model share one rate budget
+# and are served round-robin, instead of running the configs one after another
+run_as_pipeline = False
+# run_as_pipeline = True
+
 def main():
+    if run_as_pipeline:
+        run_pipeline()
+        return
     for config_files in config_list:
         config = MyConfig(file_paths=config_files)
 
@@ -19,6 +34,36 @@ def main():
         # break
 
 
+def run_pipeline():
+    configs = [MyConfig(file_paths=config_files) for config_files in config_list]
+
+    jobs = []
+    save_filepaths = set()
+    for config in configs:
+        for job in ModelRunner(config).collect_jobs(skip_if_exists=skip_if_exist):
+            # configs sharing an output file only need to run it once
+            if job.save_filepath in save_filepaths:
+                logger.info(f"Skip duplicate job for {job.save_filepath}.")
+                continue
+            save_filepaths.add(job.save_filepath)
+            jobs.append(job)
+
+    if jobs:
+        transport = HttpTransportSettings.from_config(configs[0])
+        metrics_dirs = [config.output_root for config in configs]
+        drain_seconds = configs[0].get("shutdown_drain_seconds", DEFAULT_DRAIN_SECONDS)
+        asyncio.run(run_jobs_concurrently(jobs, share_model_budgets=True, transport=transport,
+                                          metrics_dirs=metrics_dirs, drain_seconds=drain_seconds))
+
+    for config in configs:
+        parser = ResponseParser(config=config)
+        parser.run(skip_if_exist=skip_if_exist)
+
+
 if __name__ == "__main__":
     setup_log()
-    main()
+    try:
+        main()
+    except RunInterrupted as e:
+        # results of partial runs are not parsed, run again to resume
+        logger.warning(f"{e}. Run this script again to resume.")
@@ -0,0 +1,33 @@
+import pandas as pd
+from lib.utils import setup_log
+from lib.planner import InferencePlanner
+from lib.config import MyConfig
+from configlist import config_list
+
+# Assumed latency of one API call, only matters for models with a max_in_flight cap
+latency_seconds = 10.0
+
+
+def main():
+    all_plans = []
+    for config_files in config_list:
+        config = MyConfig(file_paths=config_files)
+
+        planner = InferencePlanner(config, latency_seconds=latency_seconds)
+        plans = planner.run()
+        all_plans.extend({"run": config.run_prefix, **plan} for plan in plans)
+
+    if not all_plans:
+        print("Nothing to plan, prepare the datasets first.")
+        return
+    df = pd.DataFrame(all_plans)
+    columns = ["run", "model", "requests", "already_completed", "total_tokens", "bound_by", "wall_minutes", "cost_usd"]
+    with pd.option_context("display.max_rows", None, "display.width", 200):
+        print(df[columns].to_string(index=False))
+    print(f"Total: {df['requests'].sum()} requests, {df['total_tokens'].sum()} tokens, ${df['cost_usd'].sum():.2f}")
+    print("Runs of different models go in parallel, runs of the same model share its rate budget.")
+
+
+if __name__ == "__main__":
+    setup_log()
+    main()
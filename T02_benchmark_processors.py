@@ -0,0 +1,232 @@
+# Benchmark the throughput of the request processors against the local mock LLM server
+#
+# Starts lib/mock_llm_server.py in a separate process (so its CPU time is not counted), runs
+# synthetic requests through the OpenAI and the Gemini processor and reports requests/s,
+# tokens/s, p50/p99 latency and client CPU time per request. Run it before and after a
+# scheduler change to compare, e.g.
+#   python T02_benchmark_processors.py --num_requests 2000 --latency_median_ms 300 --rate_limit_error_rate 0.02
+# The `openai_batch` processor runs the same requests through the Batch API runner instead,
+# e.g. with failing polls and several batches:
+#   python T02_benchmark_processors.py --processors openai_batch --batch_poll_error_rate 0.3 --max_requests_per_batch 300
+
+import argparse
+import asyncio
+import json
+import logging
+import math
+import multiprocessing
+import os
+import tempfile
+import time
+from dataclasses import asdict
+
+import aiohttp
+
+from lib.adapters import GeminiAdapter, OpenAIAdapter
+from lib.api_errors import RetryPolicy
+from lib.api_request_google import process_api_requests_from_file
+from lib.api_request_parallel_processor import process_api_requests_from_file_openai
+from lib.hedging import HedgeSettings
+from lib.http_transport import create_session
+from lib.openai_batch import OpenAIBatchRunner
+from lib.mock_llm_server import MockServerSettings, run_server
+
+PROMPT = "Score the following essay according to the rubric. " * 20
+PROCESSORS = ["openai", "gemini", "openai_batch"]
+
+
+def write_requests(filepath, processor, num_requests):
+    with open(filepath, "w") as f:
+        for i in range(num_requests):
+            text = f"{PROMPT} Essay {i}."
+            if processor != "gemini":
+                request = {"messages": [{"role": "user", "content": text}], "metadata": {"row_id": i}}
+            else:
+                request = {"contents": [{"parts": [{"text": text}]}], "metadata": {"row_id": i}}
+            f.write(json.dumps(request) + "\n")
+
+
+class LatencyTrace:
+    """Client-side latency of every HTTP call, from sending the request to the response headers."""
+
+    def __init__(self):
+        self.latencies = []
+        self._started = {}
+
+    def trace_config(self):
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(self._on_request_start)
+        trace_config.on_request_end.append(self._on_request_end)
+        return trace_config
+
+    async def _on_request_start(self, session, context, params):
+        self._started[id(context)] = time.monotonic()
+
+    async def _on_request_end(self, session, context, params):
+        started = self._started.pop(id(context), None)
+        if started is not None:
+            self.latencies.append(time.monotonic() - started)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, math.ceil(fraction * len(values)) - 1))]
+
+
+def count_tokens(save_filepath, adapter):
+    num_tokens = 0
+    with open(save_filepath) as f:
+        for line in f:
+            response = json.loads(line)[1]
+            if isinstance(response, dict):
+                num_tokens += sum(adapter.usage(response))
+    return num_tokens
+
+
+async def run_processor(processor, server_url, work_dir, args):
+    requests_filepath = os.path.join(work_dir, f"{processor}_requests.jsonl")
+    save_filepath = os.path.join(work_dir, f"{processor}_results.jsonl")
+    write_requests(requests_filepath, processor, args.num_requests)
+
+    trace = LatencyTrace()
+    hedging = HedgeSettings(percentile=args.hedge_percentile, min_delay=0.0) if args.hedge_percentile else None
+    async with create_session(trace_configs=[trace.trace_config()]) as session:
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        if processor == "openai":
+            adapter = OpenAIAdapter(api_key="mock", request_url=server_url + "/v1/chat/completions")
+            status = await process_api_requests_from_file_openai(
+                requests_filepath=requests_filepath,
+                save_filepath=save_filepath,
+                request_url=adapter.request_url,
+                api_key="mock",
+                max_requests_per_minute=args.max_requests_per_minute,
+                max_tokens_per_minute=args.max_tokens_per_minute,
+                token_encoding_name=None,
+                max_attempts=args.max_attempts,
+                logging_level=logging.WARNING,
+                additional_params={"model": "gpt-4o", "temperature": 0},
+                resume=False,
+                session=session,
+                hedging=hedging,
+            )
+        elif processor == "openai_batch":
+            adapter = OpenAIAdapter(api_key="mock", request_url=server_url + "/v1/chat/completions")
+            runner = OpenAIBatchRunner(
+                adapter=adapter,
+                max_requests_per_batch=args.max_requests_per_batch,
+                poll_interval=0.05,
+                max_poll_interval=0.5,
+                retry_policy=RetryPolicy(max_delay=0.5),
+            )
+            status = await runner.run(
+                requests_filepath=requests_filepath,
+                save_filepath=save_filepath,
+                additional_params={"model": "gpt-4o", "temperature": 0},
+                resume=False,
+                session=session,
+            )
+        else:
+            adapter = GeminiAdapter(api_key="mock", request_url=server_url + "/v1beta/models/gemini-pro:generateContent")
+            status = await process_api_requests_from_file(
+                requests_filepath=requests_filepath,
+                save_filepath=save_filepath,
+                request_url=adapter.request_url,
+                api_key="mock",
+                max_attempts=args.max_attempts,
+                logging_level=logging.WARNING,
+                max_requests_per_minute=args.max_requests_per_minute,
+                max_tokens_per_minute=args.max_tokens_per_minute,
+                resume=False,
+                session=session,
+                hedging=hedging,
+            )
+        cpu_seconds = time.process_time() - cpu_start
+        wall_seconds = time.perf_counter() - wall_start
+
+    num_tokens = count_tokens(save_filepath, adapter)
+    return {
+        "processor": processor,
+        "requests": args.num_requests,
+        "succeeded": status.num_tasks_succeeded,
+        "failed": status.num_tasks_failed,
+        "retries": getattr(status, "num_retries", 0),  # the batch runner has no per-request retries
+        "hedges": getattr(status, "num_hedges", 0),
+        "http_calls": len(trace.latencies),
+        "wall_seconds": round(wall_seconds, 3),
+        "requests_per_second": round(status.num_tasks_succeeded / wall_seconds, 2),
+        "tokens_per_second": round(num_tokens / wall_seconds, 1),
+        "latency_p50_ms": round(percentile(trace.latencies, 0.5) * 1000, 1) if trace.latencies else None,
+        "latency_p99_ms": round(percentile(trace.latencies, 0.99) * 1000, 1) if trace.latencies else None,
+        "cpu_ms_per_request": round(cpu_seconds * 1000 / args.num_requests, 3),
+    }
+
+
+def print_results(results):
+    columns = ["processor", "succeeded", "failed", "retries", "hedges", "requests_per_second", "tokens_per_second",
+               "latency_p50_ms", "latency_p99_ms", "cpu_ms_per_request"]
+    widths = [max(len(c), *(len(str(r[c])) for r in results)) for c in columns]
+    print("  ".join(c.ljust(w) for c, w in zip(columns, widths)))
+    for r in results:
+        print("  ".join(str(r[c]).ljust(w) for c, w in zip(columns, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--processors", nargs="+", choices=PROCESSORS, default=PROCESSORS)
+    parser.add_argument("--num_requests", type=int, default=1000)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--max_requests_per_minute", type=float, default=60_000)
+    parser.add_argument("--max_tokens_per_minute", type=float, default=50_000_000)
+    parser.add_argument("--max_attempts", type=int, default=5)
+    parser.add_argument("--latency_distribution", default="lognormal")
+    parser.add_argument("--latency_median_ms", type=float, default=200)
+    parser.add_argument("--latency_sigma", type=float, default=0.5)
+    parser.add_argument("--rate_limit_error_rate", type=float, default=0.0)
+    parser.add_argument("--server_error_rate", type=float, default=0.0)
+    parser.add_argument("--server_requests_per_minute", type=float, default=None)
+    parser.add_argument("--server_tokens_per_minute", type=float, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch_poll_error_rate", type=float, default=0.0, help="batch polls answered with a 502")
+    parser.add_argument("--max_requests_per_batch", type=int, default=50_000)
+    parser.add_argument("--hedge_percentile", type=float, default=None, help="hedge calls slower than this percentile")
+    parser.add_argument("--output", default=None, help="also save the results to this json file")
+    args = parser.parse_args()
+
+    settings = MockServerSettings(
+        latency_distribution=args.latency_distribution,
+        latency_median_ms=args.latency_median_ms,
+        latency_sigma=args.latency_sigma,
+        rate_limit_error_rate=args.rate_limit_error_rate,
+        server_error_rate=args.server_error_rate,
+        requests_per_minute=args.server_requests_per_minute,
+        tokens_per_minute=args.server_tokens_per_minute,
+        batch_poll_error_rate=args.batch_poll_error_rate,
+        seed=args.seed,
+    )
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=run_server, args=(settings, "127.0.0.1", args.port, ready), daemon=True)
+    server.start()
+    if not ready.wait(timeout=10):
+        raise Exception("Mock LLM server did not start")
+
+    results = []
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            for processor in args.processors:
+                results.append(asyncio.run(run_processor(processor, f"http://127.0.0.1:{args.port}", work_dir, args)))
+    finally:
+        server.terminate()
+        server.join()
+
+    print(f"Mock server: {asdict(settings)}")
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"settings": asdict(settings), "args": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
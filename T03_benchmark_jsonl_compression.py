@@ -0,0 +1,118 @@
+# Benchmark plain, gzip and zstd compressed jsonl output files
+#
+# Writes output lines the way the result writer does (batches of lines, flushed after every
+# batch), reads them back the way ResponseParser does (streaming, one json line at a time) and
+# reports the file size, compression ratio and write/read throughput in MB/s of uncompressed
+# jsonl. The lines are synthetic `[request, response, metadata]` lines with the full system
+# message, or the lines of an existing output file, e.g.
+#   python T03_benchmark_jsonl_compression.py --num_lines 5000
+#   python T03_benchmark_jsonl_compression.py --input data/output/.../dataset/test.full.gpt-4o.output.jsonl
+
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from lib.io import DEFAULT_COMPRESSION_LEVELS, iter_jsonl_lines, open_jsonl
+
+ESSAY = "In my opinion, it is better to work in a team than alone, because " * 30
+SYSTEM_MESSAGE_FN = "./configs/system_message_full.txt"
+FORMATS = {
+    "jsonl": ".jsonl",
+    "gzip": ".jsonl.gz",
+    "zstd": ".jsonl.zst",
+}
+
+
+def synthetic_lines(num_lines):
+    system_message = "Score the essay according to the rubric."
+    if os.path.exists(SYSTEM_MESSAGE_FN):
+        with open(SYSTEM_MESSAGE_FN) as f:
+            system_message = f.read()
+    for i in range(num_lines):
+        request = {
+            "model": "gpt-4o-2024-08-06",
+            "messages": [
+                {"role": "system", "content": system_message},
+                {"role": "user", "content": f"{ESSAY} (essay {i})"},
+            ],
+            "temperature": 0,
+        }
+        response = {
+            "id": f"chatcmpl-{i:08d}",
+            "object": "chat.completion",
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": json.dumps({"score": 3.5, "reasoning": f"Essay {i} is well organized."})},
+                "finish_reason": "stop",
+            }],
+            "usage": {"prompt_tokens": 1500 + i % 300, "completion_tokens": 80 + i % 40, "total_tokens": 1580 + i % 340},
+        }
+        metadata = {"line_number": i, "essay": {"Sample_ID": i, "ETS Score": 3.5 + i % 3 * 0.5, "Form_ID": 1, "Item_ID": 2}}
+        yield (json.dumps([request, response, metadata]) + "\n").encode("utf-8")
+
+
+def benchmark(lines, format, work_dir, batch_size):
+    filepath = os.path.join(work_dir, "output" + FORMATS[format])
+    num_bytes = sum(len(line) for line in lines)
+
+    start = time.perf_counter()
+    with open_jsonl(filepath, "ab") as f:
+        for i in range(0, len(lines), batch_size):
+            f.write(b"".join(lines[i:i + batch_size]))
+            f.flush()
+    write_seconds = time.perf_counter() - start
+    size = os.path.getsize(filepath)
+
+    start = time.perf_counter()
+    num_read = 0
+    for line in iter_jsonl_lines(filepath):
+        json.loads(line)
+        num_read += 1
+    read_seconds = time.perf_counter() - start
+    assert num_read == len(lines), f"read {num_read} of {len(lines)} lines from {filepath}"
+
+    return {
+        "format": format,
+        "level": DEFAULT_COMPRESSION_LEVELS.get(format, "-"),
+        "lines": len(lines),
+        "size_mb": round(size / 1e6, 2),
+        "ratio": round(num_bytes / size, 2),
+        "write_mb_per_s": round(num_bytes / 1e6 / write_seconds, 1),
+        "read_mb_per_s": round(num_bytes / 1e6 / read_seconds, 1),
+    }
+
+
+def print_results(results):
+    columns = ["format", "level", "lines", "size_mb", "ratio", "write_mb_per_s", "read_mb_per_s"]
+    widths = [max(len(c), *(len(str(r[c])) for r in results)) for c in columns]
+    print("  ".join(c.ljust(w) for c, w in zip(columns, widths)))
+    for r in results:
+        print("  ".join(str(r[c]).ljust(w) for c, w in zip(columns, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--formats", nargs="+", choices=list(FORMATS), default=list(FORMATS))
+    parser.add_argument("--num_lines", type=int, default=2000)
+    parser.add_argument("--input", default=None, help="benchmark the lines of this output file instead")
+    parser.add_argument("--batch_size", type=int, default=100, help="lines per flush, as in the result writer")
+    parser.add_argument("--output", default=None, help="also save the results to this json file")
+    args = parser.parse_args()
+
+    if args.input:
+        lines = list(iter_jsonl_lines(args.input, "rb"))
+    else:
+        lines = list(synthetic_lines(args.num_lines))
+    with tempfile.TemporaryDirectory() as work_dir:
+        results = [benchmark(lines, format, work_dir, args.batch_size) for format in args.formats]
+
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
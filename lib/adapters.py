@@ -0,0 +1,368 @@
+"""
+PROVIDER ADAPTERS
+
+Thin, provider-specific pieces used by the inference engine (lib/inference_engine.py).
+
+An adapter knows how to build the HTTP request for one API format, how many tokens a request
+will consume, how to classify an error response, and where the prompt and generated content
+live in a request/response pair. Token estimates are corrected online from the usage reported
+with each response (`observe_usage`, see `TokenEstimator` in lib/token_counter.py). Everything else (scheduling, retries, output, metrics) is
+owned by the engine, so it behaves the same for every model in `llm_models`.
+
+Adapters are registered by the `format` value of `DataPath`/`LlmModel`:
+```
+adapter = get_adapter("gemini", api_key=os.getenv("GOOGLE_API_KEY"), model="gemini-pro")
+```
+"""
+
+import re
+from abc import ABC, abstractmethod
+
+from lib.api_errors import ErrorKind, classify_http_error
+from lib.scheduler import AdaptiveRateLimitScheduler, RateLimitScheduler
+from lib.token_counter import (
+    DEFAULT_COMPLETION_TOKENS_ESTIMATE,
+    TokenEstimator,
+    encoding_name_for_model,
+    get_token_counter,
+)
+
+
+class ProviderAdapter(ABC):
+    """Base adapter, subclasses implement one API format.
+
+    Subclasses must implement `extract_prompt` and `extract_content`; the other methods have
+    defaults that fit a provider without usage reporting or caching.
+    """
+
+    format = "<abstract>"
+    api_key_env_var = ""
+    default_request_url = ""
+    scheduler_class = RateLimitScheduler
+    default_max_requests_per_minute = 60
+    default_max_tokens_per_minute = None
+    default_max_in_flight = None
+    # completion tokens budgeted per request until responses report the real usage
+    default_output_tokens_estimate = DEFAULT_COMPLETION_TOKENS_ESTIMATE
+
+    def __init__(self, api_key: str, request_url: str | None = None, model: str | None = None) -> None:
+        self.api_key = api_key
+        self.model = model
+        self.request_url = request_url or self.default_request_url
+        self.token_estimator = TokenEstimator(completion_tokens=self.default_output_tokens_estimate)
+
+    def request_headers(self, api_key: str | None = None) -> dict:
+        """Headers of a call, authenticated with `api_key` (e.g. from a credential pool) or the adapter's key."""
+        return {}
+
+    def request_params(self, api_key: str | None = None) -> dict:
+        return {}
+
+    def additional_params(self, temperature: float | None = None) -> dict:
+        """Run-wide parameters that override those in the request file."""
+        return {}
+
+    def prepare_request(self, request_json: dict, additional_params: dict) -> dict:
+        """Apply run-wide parameters (model, temperature, ...) to a request read from file."""
+        request_json.update(additional_params)
+        return request_json
+
+    def num_tokens(self, request_json: dict) -> int:
+        """Tokens the request is expected to consume, for rate budgeting."""
+        return self.token_estimator.prompt_tokens(self.num_prompt_tokens(request_json)) + self.num_completion_tokens(request_json)
+
+    def num_prompt_tokens(self, request_json: dict) -> int:
+        """Prompt tokens of the request as counted locally, before any correction."""
+        return 0
+
+    def num_completion_tokens(self, request_json: dict) -> int:
+        """Completion tokens the request is expected to generate, over all choices."""
+        return 0
+
+    def num_choices(self, request_json: dict) -> int:
+        return 1
+
+    def observe_usage(self, request_json: dict, prompt_tokens: int, completion_tokens: int) -> None:
+        """Correct future estimates with the usage the provider reported for `request_json`."""
+        if not prompt_tokens and not completion_tokens:
+            return
+        self.token_estimator.observe(
+            self.num_prompt_tokens(request_json), prompt_tokens, completion_tokens / self.num_choices(request_json)
+        )
+
+    def is_deterministic(self, request_json: dict) -> bool:
+        """Whether the request samples at temperature 0, so its response may be cached."""
+        return False
+
+    def usage(self, response_json: dict) -> tuple[int, int]:
+        """(prompt tokens, completion tokens) the provider reports for a response."""
+        return 0, 0
+
+    def classify_error(self, status: int | None, error: dict) -> ErrorKind:
+        return classify_http_error(
+            status,
+            str(error.get("message", "")),
+            str(error.get("status", "")),
+            str(error.get("code", "")),
+            str(error.get("type", "")),
+        )
+
+    def stats(self) -> dict:
+        return {"token_estimator": self.token_estimator.stats()}
+
+    @classmethod
+    @abstractmethod
+    def extract_prompt(cls, request_json: dict) -> str:
+        """Text of the prompt sent with `request_json`."""
+
+    @classmethod
+    @abstractmethod
+    def extract_content(cls, response_json: dict) -> str:
+        """Generated text of `response_json`."""
+
+    def create_scheduler(
+        self,
+        max_requests_per_minute: float | None = None,
+        max_tokens_per_minute: float | None = None,
+        max_in_flight: int | None = None,
+        **kwargs,
+    ) -> RateLimitScheduler:
+        """Scheduler with the given budgets, falling back to the adapter defaults."""
+        return self.scheduler_class(
+            max_requests_per_minute=max_requests_per_minute or self.default_max_requests_per_minute,
+            max_tokens_per_minute=max_tokens_per_minute or self.default_max_tokens_per_minute,
+            max_in_flight=max_in_flight or self.default_max_in_flight,
+            **kwargs,
+        )
+
+
+class OpenAIAdapter(ProviderAdapter):
+    """OpenAI chat completions (and the other endpoints `num_tokens_consumed_from_request` knows)."""
+
+    format = "openai"
+    api_key_env_var = "OPENAI_API_KEY"
+    default_request_url = "https://api.openai.com/v1/chat/completions"
+    scheduler_class = AdaptiveRateLimitScheduler
+    # starting budgets only, adapted to the x-ratelimit-* response headers
+    default_max_requests_per_minute = 3_000 * 0.5
+    default_max_tokens_per_minute = 250_000 * 0.5
+
+    def __init__(
+        self,
+        api_key: str,
+        request_url: str | None = None,
+        model: str | None = None,
+        token_encoding_name: str | None = None,
+    ) -> None:
+        super().__init__(api_key=api_key, request_url=request_url, model=model)
+        self.api_endpoint = api_endpoint_from_url(self.request_url)
+        # None picks the encoding of the model, e.g. o200k_base for gpt-4o
+        self.token_encoding_name = token_encoding_name
+
+    def request_headers(self, api_key: str | None = None) -> dict:
+        return {"Authorization": f"Bearer {api_key or self.api_key}"}
+
+    def additional_params(self, temperature: float | None = None) -> dict:
+        params = {}
+        if self.model is not None:
+            params["model"] = self.model
+        if temperature is not None:
+            params["temperature"] = temperature
+        return params
+
+    def encoding_name(self, request_json: dict | None = None) -> str:
+        if self.token_encoding_name:
+            return self.token_encoding_name
+        return encoding_name_for_model(self.model or (request_json or {}).get("model"))
+
+    def num_prompt_tokens(self, request_json: dict) -> int:
+        return num_tokens_consumed_from_request(
+            request_json, self.api_endpoint, self.encoding_name(request_json), completion_tokens_estimate=0
+        )
+
+    def num_completion_tokens(self, request_json: dict) -> int:
+        if not self.api_endpoint.endswith("completions"):
+            return 0  # e.g. embeddings
+        max_tokens = request_json.get("max_completion_tokens", request_json.get("max_tokens"))
+        prompt = request_json.get("prompt")
+        num_prompts = len(prompt) if isinstance(prompt, list) else 1
+        return num_prompts * self.num_choices(request_json) * self.token_estimator.completion_tokens(max_tokens)
+
+    def num_choices(self, request_json: dict) -> int:
+        return request_json.get("n", 1)
+
+    def is_deterministic(self, request_json: dict) -> bool:
+        # the API samples at temperature 1 when none is given
+        return request_json.get("temperature", 1) == 0 and request_json.get("n", 1) == 1
+
+    def usage(self, response_json: dict) -> tuple[int, int]:
+        usage = response_json.get("usage") or {}
+        return usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+
+    def stats(self) -> dict:
+        return {**super().stats(), "token_counter": get_token_counter(self.encoding_name()).stats()}
+
+    @classmethod
+    def extract_prompt(cls, request_json: dict) -> str:
+        for message in request_json["messages"]:
+            if message["role"] == "user":
+                return message["content"]
+        return ""
+
+    @classmethod
+    def extract_content(cls, response_json: dict) -> str:
+        return response_json["choices"][0]["message"]["content"]
+
+
+class GeminiAdapter(ProviderAdapter):
+    """Google generateContent."""
+
+    format = "gemini"
+    api_key_env_var = "GOOGLE_API_KEY"
+    request_url_template = "https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent"
+    default_request_url = request_url_template.format(model="gemini-pro")
+    # Budgets leave headroom below the gemini-pro pay-as-you-go limits (360 RPM, 120,000 TPM)
+    default_max_requests_per_minute = 360 * 0.5
+    default_max_tokens_per_minute = 120_000 * 0.5
+    default_max_in_flight = 32
+    # Used to estimate token usage locally, Gemini does not report limits in response headers.
+    # The count is scaled to Gemini's own tokenizer from the usage reported with each response.
+    token_estimate_encoding_name = "cl100k_base"
+
+    def __init__(self, api_key: str, request_url: str | None = None, model: str | None = None) -> None:
+        if request_url is None and model is not None:
+            request_url = self.request_url_template.format(model=model)
+        super().__init__(api_key=api_key, request_url=request_url, model=model)
+
+    def request_params(self, api_key: str | None = None) -> dict:
+        return {"key": api_key or self.api_key}
+
+    def additional_params(self, temperature: float | None = None) -> dict:
+        # the model is part of the request URL
+        if temperature is None:
+            return {}
+        return {"generationConfig": {"temperature": temperature}}
+
+    def num_prompt_tokens(self, request_json: dict) -> int:
+        """Local estimate: Gemini does not use a tiktoken encoding, so this is an approximation."""
+        token_counter = get_token_counter(self.token_estimate_encoding_name)
+        num_tokens = 0
+        for content in request_json.get("contents", []):
+            for part in content.get("parts", []):
+                if "text" in part:
+                    num_tokens += token_counter.count(part["text"])
+        return num_tokens
+
+    def num_completion_tokens(self, request_json: dict) -> int:
+        max_output_tokens = request_json.get("generationConfig", {}).get("maxOutputTokens")
+        return self.num_choices(request_json) * self.token_estimator.completion_tokens(max_output_tokens)
+
+    def num_choices(self, request_json: dict) -> int:
+        return request_json.get("generationConfig", {}).get("candidateCount", 1)
+
+    def is_deterministic(self, request_json: dict) -> bool:
+        generation_config = request_json.get("generationConfig", {})
+        return generation_config.get("temperature") == 0 and generation_config.get("candidateCount", 1) == 1
+
+    def usage(self, response_json: dict) -> tuple[int, int]:
+        usage = response_json.get("usageMetadata") or {}
+        return usage.get("promptTokenCount", 0), usage.get("candidatesTokenCount", 0)
+
+    @classmethod
+    def extract_prompt(cls, request_json: dict) -> str:
+        return request_json["contents"][0]["parts"][0]["text"]
+
+    @classmethod
+    def extract_content(cls, response_json: dict) -> str:
+        return response_json["candidates"][0]["content"]["parts"][0]["text"]
+
+
+ADAPTERS = {
+    OpenAIAdapter.format: OpenAIAdapter,
+    GeminiAdapter.format: GeminiAdapter,
+}
+
+
+def get_adapter_class(format: str) -> type[ProviderAdapter]:
+    try:
+        return ADAPTERS[format]
+    except KeyError:
+        raise Exception(f"Unknown model format: {format}")
+
+
+def get_adapter(format: str, **kwargs) -> ProviderAdapter:
+    return get_adapter_class(format)(**kwargs)
+
+
+# OpenAI token counting
+
+
+def api_endpoint_from_url(request_url):
+    """Extract the API endpoint from the request URL."""
+    match = re.search("^https?://[^/]+/v\\d+/(.+)$", request_url)
+    return match[1]
+
+
+def num_tokens_consumed_from_request(
+    request_json: dict,
+    api_endpoint: str,
+    token_encoding_name: str,
+    completion_tokens_estimate: int = DEFAULT_COMPLETION_TOKENS_ESTIMATE,
+):
+    """Count the number of tokens in the request. Only supports completion and embedding requests.
+
+    Completions are budgeted at `completion_tokens_estimate` per choice, at most the request's `max_tokens`.
+    """
+    token_counter = get_token_counter(token_encoding_name)
+    # if completions request, tokens = prompt + n * expected completion tokens
+    if api_endpoint.endswith("completions"):
+        max_tokens = request_json.get("max_completion_tokens", request_json.get("max_tokens"))
+        if max_tokens is not None:
+            completion_tokens_estimate = min(max_tokens, completion_tokens_estimate)
+        n = request_json.get("n", 1)
+        completion_tokens = n * completion_tokens_estimate
+
+        # chat completions
+        if api_endpoint.startswith("chat/"):
+            num_tokens = 0
+            for message in request_json["messages"]:
+                num_tokens += 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
+                for key, value in message.items():
+                    num_tokens += token_counter.count(value)
+                    if key == "name":  # if there's a name, the role is omitted
+                        num_tokens -= 1  # role is always required and always 1 token
+            num_tokens += 2  # every reply is primed with <im_start>assistant
+            return num_tokens + completion_tokens
+        # normal completions
+        else:
+            prompt = request_json["prompt"]
+            if isinstance(prompt, str):  # single prompt
+                prompt_tokens = token_counter.count(prompt)
+                num_tokens = prompt_tokens + completion_tokens
+                return num_tokens
+            elif isinstance(prompt, list):  # multiple prompts
+                prompt_tokens = sum([token_counter.count(p) for p in prompt])
+                num_tokens = prompt_tokens + completion_tokens * len(prompt)
+                return num_tokens
+            else:
+                raise TypeError(
+                    'Expecting either string or list of strings for "prompt" field in completion request'
+                )
+    # if embeddings request, tokens = input tokens
+    elif api_endpoint == "embeddings":
+        input = request_json["input"]
+        if isinstance(input, str):  # single input
+            num_tokens = token_counter.count(input)
+            return num_tokens
+        elif isinstance(input, list):  # multiple inputs
+            num_tokens = sum([token_counter.count(i) for i in input])
+            return num_tokens
+        else:
+            raise TypeError(
+                'Expecting either string or list of strings for "inputs" field in embedding request'
+            )
+    # more logic needed to support other API calls (e.g., edits, inserts, DALL-E)
+    else:
+        raise NotImplementedError(
+            f'API endpoint "{api_endpoint}" not implemented in this script'
+        )
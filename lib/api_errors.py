@@ -0,0 +1,148 @@
+"""
+API ERRORS
+
+Typed classification of failed API calls, shared by the request processors, so that rate
+limiting, transient server/network problems and permanent request errors are counted and
+retried differently instead of by matching message substrings inline.
+
+`RetryPolicy` decides when a failed request is sent again: each request backs off on its own
+(jittered exponential backoff per error kind, or the provider's `Retry-After`), so one
+throttled request does not hold back the others.
+"""
+
+import asyncio
+import datetime
+import email.utils
+import random
+from dataclasses import dataclass, field
+from enum import Enum
+
+import aiohttp
+
+
+class ErrorKind(Enum):
+    RATE_LIMIT = "rate_limit"  # 429 / per-minute quota exhausted
+    QUOTA = "quota"  # billing quota of the key used up, only another key helps
+    SERVER = "server"  # 5xx
+    TIMEOUT = "timeout"
+    CONNECTION = "connection"  # refused, reset, DNS, ...
+    AUTH = "auth"  # 401 / 403
+    CLIENT = "client"  # other 4xx, the request itself is wrong
+    OTHER = "other"
+
+    @property
+    def is_retryable(self) -> bool:
+        return self not in (ErrorKind.AUTH, ErrorKind.QUOTA, ErrorKind.CLIENT)
+
+    @property
+    def is_api_error(self) -> bool:
+        """Errors reported by the API itself, as opposed to the transport."""
+        return self in (ErrorKind.SERVER, ErrorKind.AUTH, ErrorKind.QUOTA, ErrorKind.CLIENT)
+
+    @property
+    def is_credential_error(self) -> bool:
+        """Errors caused by the API key, another key may succeed."""
+        return self in (ErrorKind.AUTH, ErrorKind.QUOTA)
+
+
+# structured error codes/types only: the messages of ordinary per-minute 429s also mention
+# "quota" and "billing", and those must stay retryable
+quota_codes = [
+    "insufficient_quota",
+]
+
+rate_limit_messages = [
+    "Rate limit",
+    "Quota exceeded",
+    "Resource has been exhausted",
+]
+
+
+def classify_http_error(
+    status: int | None, message: str = "", error_status: str = "", error_code: str = "", error_type: str = ""
+) -> ErrorKind:
+    """Classify an error response from its HTTP status and the provider's error message/status/code/type."""
+    # OpenAI reports an exhausted billing quota as a 429 too, told apart only by its code
+    if error_code in quota_codes or error_type in quota_codes:
+        return ErrorKind.QUOTA
+    if status == 429 or error_status == "RESOURCE_EXHAUSTED":
+        return ErrorKind.RATE_LIMIT
+    if any(msg in message for msg in rate_limit_messages):
+        return ErrorKind.RATE_LIMIT
+    if status is None:
+        return ErrorKind.OTHER
+    if status in (401, 403):
+        return ErrorKind.AUTH
+    if status == 408:
+        return ErrorKind.TIMEOUT
+    if status >= 500:
+        return ErrorKind.SERVER
+    if status >= 400:
+        return ErrorKind.CLIENT
+    return ErrorKind.OTHER
+
+
+def classify_exception(e: Exception) -> ErrorKind:
+    """Classify an exception raised while calling the API."""
+    if isinstance(e, (asyncio.TimeoutError, aiohttp.ServerTimeoutError)):
+        return ErrorKind.TIMEOUT
+    if isinstance(e, aiohttp.ClientResponseError):
+        return classify_http_error(e.status, e.message)
+    if isinstance(e, (aiohttp.ClientConnectionError, ConnectionError)):
+        return ErrorKind.CONNECTION
+    return ErrorKind.OTHER
+
+
+def parse_retry_after(headers) -> float | None:
+    """Seconds to wait according to `retry-after-ms` or `Retry-After` (seconds or HTTP date)."""
+    value = headers.get("retry-after-ms")
+    if value is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("Retry-After") or headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+def _default_base_delays() -> dict:
+    return {
+        ErrorKind.RATE_LIMIT: 2.0,
+        ErrorKind.SERVER: 1.0,
+        ErrorKind.TIMEOUT: 2.0,
+        ErrorKind.CONNECTION: 0.5,
+        ErrorKind.OTHER: 1.0,
+    }
+
+
+@dataclass
+class RetryPolicy:
+    """Per-request retry delays: jittered exponential backoff, or `Retry-After` when given.
+
+    The n-th retry of an error kind waits a random time between half and all of
+    `base_delay * multiplier ** (n - 1)`, capped at `max_delay`.
+    """
+
+    base_delays: dict = field(default_factory=_default_base_delays)
+    multiplier: float = 2.0
+    max_delay: float = 60.0
+
+    def delay(self, error_kind: ErrorKind, num_failures: int, retry_after: float | None = None) -> float:
+        if retry_after is not None:
+            # the provider knows best, a little jitter keeps the retries from arriving together
+            return min(retry_after, self.max_delay) * random.uniform(1.0, 1.1)
+        base_delay = self.base_delays.get(error_kind, 1.0)
+        ceiling = min(self.max_delay, base_delay * self.multiplier ** max(0, num_failures - 1))
+        return random.uniform(ceiling / 2, ceiling)
@@ -5,11 +5,23 @@ from typing import Optional
 from pydantic import BaseModel
 
 
+# "jsonl_compression" config value -> extension of the full test request and output files
+JSONL_EXTENSIONS = {
+    None: 'jsonl',
+    'gzip': 'jsonl.gz',
+    'zstd': 'jsonl.zst',
+}
+
+
 class LlmModel(BaseModel):
     active: bool
     id: str
     label: str
     format: str
+    # Optional per-model rate budgets, the processor defaults are used when omitted
+    max_requests_per_minute: Optional[float] = None
+    max_tokens_per_minute: Optional[float] = None
+    max_in_flight: Optional[int] = None
 
 class DataPath(BaseModel):
     index_file: str
@@ -21,6 +33,9 @@ class DataPath(BaseModel):
     llm_model_id: Optional[str] = None
     active: bool = True
     format: str = "openai"
+    max_requests_per_minute: Optional[float] = None
+    max_tokens_per_minute: Optional[float] = None
+    max_in_flight: Optional[int] = None
 
 
 class JsonConfigLoader:
@@ -47,6 +62,10 @@ class JsonConfigLoader:
     def __getattr__(self, key):
         return self.data[key]
 
+    def get(self, key, default=None):
+        """Optional config value, for keys that older config files do not have."""
+        return self.data.get(key, default)
+
 class MyConfig(JsonConfigLoader):
     
     def __init__(self, file_paths=[]):
@@ -78,6 +97,9 @@ class MyConfig(JsonConfigLoader):
                         format=model.format,
                         is_finetuned=False,
                         active=model.active,
+                        max_requests_per_minute=model.max_requests_per_minute,
+                        max_tokens_per_minute=model.max_tokens_per_minute,
+                        max_in_flight=model.max_in_flight,
                     ))
             # Finetuned model
             data_paths.append(DataPath(
@@ -143,13 +165,22 @@ class MyConfig(JsonConfigLoader):
     def dataset_test_full_filename(self):
         return os.path.join(self.output_root, 'dataset', 'test.full.jsonl')
 
+    @property
+    def jsonl_extension(self):
+        # "jsonl_compression": "gzip" or "zstd" compresses the full test requests and outputs
+        compression = self.get('jsonl_compression')
+        if compression not in JSONL_EXTENSIONS:
+            allowed = ', '.join(json.dumps(value) for value in JSONL_EXTENSIONS)
+            raise ValueError(f"Invalid jsonl_compression {compression!r} in config, allowed values: {allowed}")
+        return JSONL_EXTENSIONS[compression]
+
     def get_dataset_test_input_filename(self, model_id:str):
         # if model_id not in ['gemini-pro']:
             # raise ValueError(f"Unsupported model id: {model_id}")
-        return os.path.join(self.output_root, 'dataset', f'test.full.{model_id}.jsonl')
+        return os.path.join(self.output_root, 'dataset', f'test.full.{model_id}.{self.jsonl_extension}')
     
     def get_dataset_test_output_filename(self, model_id):
-        return os.path.join(self.output_root, 'dataset', f'test.full.{model_id}.output.jsonl')
+        return os.path.join(self.output_root, 'dataset', f'test.full.{model_id}.output.{self.jsonl_extension}')
         # return input_fn.replace('.jsonl', f'.result.{model_id}.jsonl')
     
     def get_dataset_test_result_finetuned_filename(self):
@@ -0,0 +1,201 @@
+"""
+CREDENTIAL POOL
+
+Spreads the requests of one model over several API keys, e.g. the project keys of a research
+group, so a sweep draws on the rate limits of all of them instead of one organization's.
+
+Every `Credential` has its own request/token buckets, made by the adapter (so the OpenAI
+buckets still adapt to the `x-ratelimit-*` headers returned for that key). `CredentialPool` is
+a drop-in scheduler for the engine: `acquire` picks the key with the most headroom, i.e. the
+largest fraction of its buckets still available, and returns it; the call is then sent with
+that key and its response headers, rate limit errors, token usage and release are booked
+against that key's buckets. The buckets share the pool's condition, so a release or refund on
+any key wakes the dispatch loop.
+
+Keys that return auth or quota errors are quarantined for `quarantine_seconds`, and the engine
+retries the request on another key. Once every key is quarantined, the quarantine is ignored
+and requests fail fast, like with a single bad key.
+
+Config entry; the keys are read from the named environment variables, never put keys into the
+config. Budgets left out fall back to the job's budgets, then to the adapter defaults:
+```
+"api_credentials": {
+  "openai": [
+    {"name": "lab", "api_key_env_var": "OPENAI_API_KEY", "max_requests_per_minute": 5000, "max_tokens_per_minute": 800000},
+    {"name": "project-b", "api_key_env_var": "OPENAI_API_KEY_PROJECT_B"}
+  ]
+}
+```
+"""
+
+import logging
+import os
+import time
+from dataclasses import dataclass, fields
+
+from lib.scheduler import RateLimitScheduler
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUARANTINE_SECONDS = 600.0
+
+
+@dataclass
+class CredentialSettings:
+    name: str
+    api_key_env_var: str
+    # None falls back to the budgets of the job
+    max_requests_per_minute: float = None
+    max_tokens_per_minute: float = None
+    max_in_flight: int = None
+
+
+def credentials_from_config(config, format: str) -> list[CredentialSettings] | None:
+    """Credentials of `format` from the `api_credentials` config entry, None if there are none."""
+    entries = (config.get("api_credentials") or {}).get(format)
+    if not entries:
+        return None
+    names = {f.name for f in fields(CredentialSettings)}
+    credentials = []
+    for entry in entries:
+        unknown = set(entry) - names
+        if unknown:
+            raise Exception(f"Unknown api_credentials settings: {sorted(unknown)}")
+        credentials.append(CredentialSettings(**entry))
+    return credentials
+
+
+@dataclass
+class Credential:
+    """One API key and its rate budget."""
+
+    name: str
+    api_key: str
+    scheduler: RateLimitScheduler
+    quarantined_until: float = 0.0
+    num_requests: int = 0
+    num_quarantines: int = 0
+
+    def is_quarantined(self, now: float) -> bool:
+        return self.quarantined_until > now
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "requests": self.num_requests,
+            "quarantines": self.num_quarantines,
+            "quarantined": self.is_quarantined(time.monotonic()),
+            **self.scheduler.stats(),
+        }
+
+
+class CredentialPool(RateLimitScheduler):
+    """Scheduler that hands out the API key with the most headroom for every call.
+
+    The retry queue and the waiting of the dispatch loop work as in `RateLimitScheduler`; the
+    buckets are those of the keys. `acquire` and `try_acquire` return the chosen `Credential`.
+    """
+
+    def __init__(
+        self,
+        adapter,
+        credentials: list[CredentialSettings],
+        max_requests_per_minute: float | None = None,
+        max_tokens_per_minute: float | None = None,
+        max_in_flight: int | None = None,
+        quarantine_seconds: float = DEFAULT_QUARANTINE_SECONDS,
+    ) -> None:
+        super().__init__(max_requests_per_minute=max_requests_per_minute or adapter.default_max_requests_per_minute)
+        self.quarantine_seconds = quarantine_seconds
+        self.credentials = []
+        for settings in credentials:
+            api_key = os.getenv(settings.api_key_env_var)
+            if not api_key:
+                logger.warning(f"Skipping credential {settings.name}: {settings.api_key_env_var} is not set")
+                continue
+            scheduler = adapter.create_scheduler(
+                max_requests_per_minute=settings.max_requests_per_minute or max_requests_per_minute,
+                max_tokens_per_minute=settings.max_tokens_per_minute or max_tokens_per_minute,
+                max_in_flight=settings.max_in_flight or max_in_flight,
+                condition=self._condition,
+            )
+            self.credentials.append(Credential(name=settings.name, api_key=api_key, scheduler=scheduler))
+        if not self.credentials:
+            raise Exception(f"None of the {len(credentials)} configured API keys is set in the environment")
+
+    def _pick(self, num_tokens: int, now: float) -> tuple[Credential | None, float | None]:
+        """Available key with the most headroom, or None and the seconds until one may be."""
+        best = None
+        best_headroom = None
+        wait = None
+        healthy = [c for c in self.credentials if not c.is_quarantined(now)]
+        for credential in healthy or self.credentials:
+            scheduler = credential.scheduler
+            scheduler._refill(now)
+            delay = scheduler._seconds_until_available(num_tokens, now)
+            if delay is not None and delay <= 0:
+                headroom = scheduler.headroom()
+                if best is None or headroom > best_headroom:
+                    best, best_headroom = credential, headroom
+            elif delay is not None:  # None: only a release frees this key, which wakes the pool
+                wait = delay if wait is None else min(wait, delay)
+        if healthy:
+            # a quarantined key coming back may be available earlier
+            for credential in self.credentials:
+                if credential.is_quarantined(now):
+                    delay = credential.quarantined_until - now
+                    wait = delay if wait is None else min(wait, delay)
+        return best, wait
+
+    def _take(self, credential: Credential, num_tokens: int) -> Credential:
+        credential.scheduler._consume(num_tokens)
+        credential.num_requests += 1
+        return credential
+
+    async def acquire(self, num_tokens: int = 0) -> Credential:
+        """Wait until a key has capacity for one request of `num_tokens`, then consume it there."""
+        ticket = next(self._tickets)
+        async with self._condition:
+            self._waiters.append(ticket)
+            try:
+                while True:
+                    if self._waiters[0] != ticket:
+                        await self._wait(None)
+                        continue
+                    credential, delay = self._pick(num_tokens, time.monotonic())
+                    if credential is not None:
+                        return self._take(credential, num_tokens)
+                    logger.debug(f"Waiting {delay}s for capacity on any key ({num_tokens} tokens)")
+                    await self._wait(delay)
+            finally:
+                self._waiters.remove(ticket)
+                self._condition.notify_all()
+
+    def try_acquire(self, num_tokens: int = 0) -> Credential | None:
+        if self._waiters:
+            return None
+        credential, _ = self._pick(num_tokens, time.monotonic())
+        if credential is None:
+            return None
+        return self._take(credential, num_tokens)
+
+    def quarantine(self, credential: Credential) -> bool:
+        """Take `credential` out of rotation; returns whether another key is still available."""
+        now = time.monotonic()
+        if not credential.is_quarantined(now):
+            credential.num_quarantines += 1
+            logger.warning(f"Quarantining API key {credential.name} for {self.quarantine_seconds:.0f}s")
+        credential.quarantined_until = now + self.quarantine_seconds
+        return any(not c.is_quarantined(now) for c in self.credentials)
+
+    def stats(self) -> dict:
+        def total(name):
+            values = [c.scheduler.stats()[name] for c in self.credentials]
+            return None if None in values else sum(values)
+
+        return {
+            "max_requests_per_minute": total("max_requests_per_minute"),
+            "max_tokens_per_minute": total("max_tokens_per_minute"),
+            "max_in_flight": total("max_in_flight"),
+            "credentials": [credential.stats() for credential in self.credentials],
+        }
@@ -7,7 +7,8 @@ import pandas as pd
 from lib.io import read_data, write_data
 from lib.essay import Essay
 from lib.utils import calc_agreement, calc_metrics_dict
-from lib.io import save_to_jsonl
+from lib.io import open_jsonl, save_to_jsonl
+from lib.adapters import get_adapter_class
 
 import logging
 logger = logging.getLogger(__name__)
@@ -513,29 +514,40 @@ class ResponseParser:
             logger.info(f"Result file {output_file} already exists, skip parsing.")
             return
         rows = []
-        with open(input_file, 'r') as file:
+        with open_jsonl(input_file, 'r') as file:
             for line in file:
                 json_data = json.loads(line)
-                llm_prompt, raw_response = self.extract_prompt_and_raw_response(json_data, format)
-                res = self.parse_raw_response(raw_response)
-                essay_data = json_data[2]["essay"]
-                agreement = self.calc_agreement(
-                    ground_truth_score=essay_data["ETS Score"],
-                    llm_score=res["score"],
-                    integer_score_only=integer_score_only,
-                    )
-                row_data = {
-                    **agreement,
-                    "LLM Score": res["score"],
-                    **essay_data,
-                    "llm_prompt": llm_prompt,
-                    "raw_response": raw_response,
-                    "reasoning": res["reasoning"],
-                }
+                row_data = self.parse_line(json_data, integer_score_only, format)
+                if row_data is None:
+                    # Request failed after all attempts; a resumed run appends its result later
+                    logger.warning(f"Skip failed request in {input_file}: {json_data[1]}")
+                    continue
                 rows.append(row_data)
         df = pd.DataFrame(rows)
         write_data(df, output_file)
         logger.info(f"Parsed result saved to file: {output_file}")
+
+    @classmethod
+    def parse_line(cls, json_data, integer_score_only, format='openai'):
+        """Result row of one `[request, response, metadata]` output line, None if the request failed."""
+        if not isinstance(json_data[1], dict):
+            return None
+        llm_prompt, raw_response = cls.extract_prompt_and_raw_response(json_data, format)
+        res = cls.parse_raw_response(raw_response)
+        essay_data = json_data[2]["essay"]
+        agreement = calc_agreement(
+            ground_truth_score=essay_data["ETS Score"],
+            llm_score=res["score"],
+            integer_score_only=integer_score_only,
+            )
+        return {
+            **agreement,
+            "LLM Score": res["score"],
+            **essay_data,
+            "llm_prompt": llm_prompt,
+            "raw_response": raw_response,
+            "reasoning": res["reasoning"],
+        }
     
     def calc_agreement(self, ground_truth_score, llm_score, integer_score_only):
         return calc_agreement(
@@ -546,17 +558,9 @@ class ResponseParser:
     
     @classmethod
     def extract_prompt_and_raw_response(cls, json_data, format):
-        raw_response = ''
-        llm_prompt = ''
-        if format == 'openai':
-            for message in json_data[0]["messages"]:
-                if message["role"] == "user":
-                    llm_prompt = message["content"]
-                    break
-            raw_response = json_data[1]["choices"][0]["message"]["content"]
-        elif format == 'gemini':
-            llm_prompt = json_data[0]["contents"][0]["parts"][0]["text"]
-            raw_response = json_data[1]["candidates"][0]["content"]["parts"][0]["text"]
+        adapter_class = get_adapter_class(format)
+        llm_prompt = adapter_class.extract_prompt(json_data[0])
+        raw_response = adapter_class.extract_content(json_data[1])
         return llm_prompt, raw_response
     
     @classmethod
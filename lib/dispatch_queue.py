@@ -0,0 +1,61 @@
+"""
+DISPATCH QUEUE
+
+Priority queue between the request file and the scheduler of the inference engine.
+
+The engine reads up to `lookahead` requests ahead of dispatch and moves retries into the
+queue once they are due; the next request to dispatch is then chosen by the policy:
+- `retries_first`: due retries before new requests, new requests in file order (the default,
+  and with a lookahead of 1 the engine's behaviour without this queue)
+- `shortest_first`: fewest estimated tokens first, so small requests fill the token bucket
+  instead of waiting behind one that needs a large share of it
+- `longest_first`: most estimated tokens first, so long requests do not end up as the tail
+  of the run
+
+Retries compete on the same key as new requests under the size policies. Ties are broken by
+arrival order. With `shortest_first`, a long request waits at most until the file has been
+read; a larger lookahead sorts better but holds more requests in memory.
+"""
+
+import heapq
+import itertools
+from enum import Enum
+
+
+class DispatchPolicy(str, Enum):
+    RETRIES_FIRST = "retries_first"
+    SHORTEST_FIRST = "shortest_first"
+    LONGEST_FIRST = "longest_first"
+
+
+class DispatchQueue:
+    """Requests read ahead of dispatch, popped in `policy` order."""
+
+    def __init__(self, policy: DispatchPolicy | str = DispatchPolicy.RETRIES_FIRST, lookahead: int = 1) -> None:
+        self.policy = DispatchPolicy(policy)
+        self.lookahead = max(1, lookahead)
+        self._heap = []
+        self._counter = itertools.count()  # arrival order, also keeps requests from being compared
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def wants_more(self) -> bool:
+        """Whether another request should be read from the file."""
+        return len(self._heap) < self.lookahead
+
+    def push(self, request, is_retry: bool = False) -> None:
+        heapq.heappush(self._heap, (self._priority(request, is_retry), next(self._counter), request))
+
+    def pop(self):
+        """Next request to dispatch, or None if the queue is empty."""
+        if not self._heap:
+            return None
+        return heapq.heappop(self._heap)[2]
+
+    def _priority(self, request, is_retry: bool):
+        if self.policy == DispatchPolicy.SHORTEST_FIRST:
+            return request.token_consumption
+        if self.policy == DispatchPolicy.LONGEST_FIRST:
+            return -request.token_consumption
+        return 0 if is_retry else 1
@@ -0,0 +1,75 @@
+"""
+HEDGED REQUESTS
+
+Opt-in hedging against the latency tail of a run: when a call has not answered after the
+`percentile` of the latencies seen so far in the run, the engine sends the same request a
+second time, provided the rate budget has room for it right away. The first successful
+answer wins and the other call is cancelled.
+
+The delay is learned per engine from the last `window` successful calls; no request is
+hedged before `min_samples` of them have been seen, and never earlier than `min_delay`
+seconds. With the default 95th percentile, about one request in twenty is hedged, so the
+extra tokens stay small while single stuck calls no longer hold up the end of a run.
+
+The first calls to finish are the fastest ones, so early in a run the learned percentile is
+too low; `max_hedge_rate` caps the hedges at a fraction of the calls sent so far.
+
+Config entry (omit it or set `"enabled": false` to turn hedging off):
+```
+"hedge_requests": {"enabled": true, "percentile": 0.95, "min_samples": 20, "max_hedge_rate": 0.1}
+```
+"""
+
+import collections
+import math
+from dataclasses import dataclass, fields
+
+DEFAULT_PERCENTILE = 0.95
+DEFAULT_MIN_SAMPLES = 20
+DEFAULT_WINDOW = 500
+DEFAULT_MIN_DELAY = 1.0  # seconds
+DEFAULT_MAX_HEDGE_RATE = 0.1
+
+
+@dataclass
+class HedgeSettings:
+    percentile: float = DEFAULT_PERCENTILE  # of the latencies seen so far, after which a hedge is sent
+    min_samples: int = DEFAULT_MIN_SAMPLES  # successful calls to learn from before the first hedge
+    window: int = DEFAULT_WINDOW  # most recent latencies the percentile is taken over
+    min_delay: float = DEFAULT_MIN_DELAY  # seconds, never hedge earlier than this
+    max_hedge_rate: float = DEFAULT_MAX_HEDGE_RATE  # hedges per call sent, at most
+
+    @classmethod
+    def from_config(cls, config) -> "HedgeSettings | None":
+        """Settings from the `hedge_requests` entry, or None if hedging is not enabled."""
+        values = dict(config.get("hedge_requests") or {})
+        if not values or not values.pop("enabled", True):
+            return None
+        names = {f.name for f in fields(cls)}
+        unknown = set(values) - names
+        if unknown:
+            raise Exception(f"Unknown hedge_requests settings: {sorted(unknown)}")
+        return cls(**values)
+
+
+class HedgeTimer:
+    """Learns the call latencies of one run and tells how long to wait before hedging."""
+
+    def __init__(self, settings: HedgeSettings | None = None) -> None:
+        self.settings = settings or HedgeSettings()
+        self._latencies = collections.deque(maxlen=self.settings.window)
+
+    def observe(self, seconds: float) -> None:
+        self._latencies.append(seconds)
+
+    def delay(self) -> float | None:
+        """Seconds after which an unanswered call gets a hedge, None while still learning."""
+        if len(self._latencies) < self.settings.min_samples:
+            return None
+        latencies = sorted(self._latencies)
+        index = min(len(latencies) - 1, max(0, math.ceil(self.settings.percentile * len(latencies)) - 1))
+        return max(self.settings.min_delay, latencies[index])
+
+    def may_hedge(self, num_calls: int, num_hedges: int) -> bool:
+        """Whether another hedge stays within `max_hedge_rate` of the `num_calls` sent."""
+        return num_hedges + 1 <= self.settings.max_hedge_rate * num_calls
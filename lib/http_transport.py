@@ -0,0 +1,147 @@
+"""
+HTTP TRANSPORT
+
+Configured aiohttp sessions for the inference engine and the batch runner.
+
+A default `aiohttp.ClientSession()` has an unbounded total timeout and no read timeout, so a
+hung connection keeps its request in flight forever. Sessions built here have:
+- a connection pool with a total and a per-host limit, kept alive between requests
+- a DNS cache with a TTL
+- connect and read timeouts, the read timeout taken from `REQUEST_TIMEOUT_SECS` in the config;
+  a timed out request fails with a TIMEOUT error and is retried like any other
+- pool utilization stats collected through an aiohttp trace config
+
+Usage:
+```
+transport = HttpTransportSettings.from_config(config)
+async with create_session(transport) as session:
+    ...
+    logger.info(pool_stats(session))
+```
+"""
+
+import time
+import weakref
+from dataclasses import dataclass, fields
+
+import aiohttp
+
+DEFAULT_REQUEST_TIMEOUT_SECS = 60
+
+_pool_stats = weakref.WeakKeyDictionary()  # session -> ConnectionPoolStats
+
+
+@dataclass
+class HttpTransportSettings:
+    limit: int = 100  # connections over all hosts, 0 for no limit
+    limit_per_host: int = 0  # 0 for no limit besides `limit`
+    keepalive_timeout: float = 30.0  # seconds an idle connection is kept open
+    ttl_dns_cache: int = 300  # seconds, None caches forever
+    connect_timeout: float = 10.0  # establishing a connection, waiting for a free one in the pool is not limited
+    read_timeout: float = DEFAULT_REQUEST_TIMEOUT_SECS  # max seconds between two reads of a response
+    total_timeout: float | None = None  # whole request, None for no limit besides the above
+
+    @classmethod
+    def from_config(cls, config) -> "HttpTransportSettings":
+        """Settings from the `http_transport` entry, read timeout from `REQUEST_TIMEOUT_SECS`."""
+        values = dict(config.get("http_transport") or {})
+        if "read_timeout" not in values:
+            values["read_timeout"] = config.get("REQUEST_TIMEOUT_SECS", DEFAULT_REQUEST_TIMEOUT_SECS)
+        names = {f.name for f in fields(cls)}
+        unknown = set(values) - names
+        if unknown:
+            raise Exception(f"Unknown http_transport settings: {sorted(unknown)}")
+        return cls(**values)
+
+    def timeout(self) -> aiohttp.ClientTimeout:
+        return aiohttp.ClientTimeout(
+            total=self.total_timeout,
+            sock_connect=self.connect_timeout,
+            sock_read=self.read_timeout,
+        )
+
+
+class ConnectionPoolStats:
+    """Counters filled by aiohttp trace callbacks."""
+
+    def __init__(self) -> None:
+        self.num_requests = 0
+        self.num_connections_created = 0
+        self.num_connections_reused = 0
+        self.num_queued = 0  # requests that had to wait for a free connection
+        self.seconds_queued = 0.0
+        self._queued_since = {}
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(self._on_request_start)
+        trace_config.on_connection_create_end.append(self._on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(self._on_connection_reuseconn)
+        trace_config.on_connection_queued_start.append(self._on_connection_queued_start)
+        trace_config.on_connection_queued_end.append(self._on_connection_queued_end)
+        return trace_config
+
+    async def _on_request_start(self, session, context, params) -> None:
+        self.num_requests += 1
+
+    async def _on_connection_create_end(self, session, context, params) -> None:
+        self.num_connections_created += 1
+
+    async def _on_connection_reuseconn(self, session, context, params) -> None:
+        self.num_connections_reused += 1
+
+    async def _on_connection_queued_start(self, session, context, params) -> None:
+        self.num_queued += 1
+        self._queued_since[id(context)] = time.monotonic()
+
+    async def _on_connection_queued_end(self, session, context, params) -> None:
+        started = self._queued_since.pop(id(context), None)
+        if started is not None:
+            self.seconds_queued += time.monotonic() - started
+
+
+def create_session(settings: HttpTransportSettings | None = None, trace_configs=None) -> aiohttp.ClientSession:
+    """Session with a bounded, kept-alive connection pool, DNS cache, timeouts and pool stats.
+
+    Additional aiohttp `trace_configs` (e.g. of a benchmark) are registered next to the pool stats.
+    """
+    settings = settings or HttpTransportSettings()
+    connector = aiohttp.TCPConnector(
+        limit=settings.limit,
+        limit_per_host=settings.limit_per_host,
+        keepalive_timeout=settings.keepalive_timeout,
+        ttl_dns_cache=settings.ttl_dns_cache,
+        use_dns_cache=True,
+    )
+    stats = ConnectionPoolStats()
+    session = aiohttp.ClientSession(
+        connector=connector,
+        timeout=settings.timeout(),
+        trace_configs=[stats.trace_config(), *(trace_configs or [])],
+    )
+    _pool_stats[session] = stats
+    return session
+
+
+def pool_stats(session: aiohttp.ClientSession) -> dict:
+    """Pool utilization of a session made by `create_session`."""
+    connector = session.connector
+    stats = _pool_stats.get(session)
+    result = {
+        "limit": connector.limit if connector else None,
+        "limit_per_host": connector.limit_per_host if connector else None,
+        # the connector does not expose its pool publicly
+        "in_use": len(getattr(connector, "_acquired", ())),
+        "idle": sum(len(conns) for conns in getattr(connector, "_conns", {}).values()),
+    }
+    if stats is not None:
+        num_connections = stats.num_connections_created + stats.num_connections_reused
+        result.update({
+            "requests": stats.num_requests,
+            "connections_created": stats.num_connections_created,
+            "connections_reused": stats.num_connections_reused,
+            "reuse_rate": round(stats.num_connections_reused / num_connections, 4) if num_connections else 0.0,
+            "queued_for_connection": stats.num_queued,
+            "seconds_queued_for_connection": round(stats.seconds_queued, 3),
+        })
+    return result
@@ -0,0 +1,830 @@
+"""
+INFERENCE ENGINE
+
+Provider-agnostic async engine that streams requests from a jsonl file to an LLM API and
+writes `[request, response, metadata]` lines to an output jsonl file.
+
+The engine owns everything that is not provider specific:
+- Streams requests from file, skipping those the completion journal lists as done
+- Answers deterministic requests from the persistent response cache (lib/response_cache.py)
+  when a previous run already sent them, and caches new successful responses
+- Coalesces identical requests while one of them is in flight: only the first is sent and its
+  result is written once per request, each line with that request's own metadata
+- Reads up to `lookahead` requests ahead into a dispatch queue (lib/dispatch_queue.py) that
+  picks the next one by policy: due retries first, shortest first or longest first
+- Throttles request and token usage with an event-driven scheduler (lib/scheduler.py); once
+  a response reports its token usage, the scheduler is refunded or charged the difference to
+  the estimate and the adapter learns from it for the next estimates
+- Optionally hedges slow calls (lib/hedging.py): a request still unanswered after a latency
+  percentile learned during the run is sent a second time if the budget has room right away,
+  the first answer wins and the other call is cancelled
+- Spreads calls over several API keys when the scheduler is a credential pool
+  (lib/credentials.py): every call goes out with the key that has the most headroom and is
+  booked against that key's budget; keys failing with auth or quota errors are quarantined
+  and the request is retried on another key
+- Retries failed requests up to {max_attempts} times, classified by lib/api_errors.py; each
+  failed request waits out its own jittered exponential backoff (or the provider's
+  Retry-After) while the other requests keep flowing
+- Hands results to a single buffered writer task (lib/result_writer.py), each line with the
+  input line number of its request in the metadata (`"line_number"`) and its position in an
+  offset index (lib/offset_index.py), so results can be looked up by input line
+- Reads and writes gzip or zstd compressed jsonl when the file names end with .gz or .zst
+  (lib/io.py); compressed output files are not indexed
+- Optionally parses every successful response into a result row as it arrives
+  (lib/result_rows.py), so the result file is ready when the run ends
+- Stops gracefully when a shutdown is requested (lib/shutdown.py, e.g. on Ctrl-C): no new
+  dispatch, in-flight calls get a deadline to finish, the writer flushes and the unfinished
+  requests are recorded in a checkpoint next to the output file
+- Counts successes, failures and errors in a StatusTracker and logs them at the end
+- Keeps live latency/throughput metrics (lib/metrics.py), exported while the run is going when
+  the engine is registered with a MetricsExporter
+
+A `ProviderAdapter` (lib/adapters.py) supplies the provider-specific parts: the URL, headers
+and query parameters, token estimates, error classification and content extraction.
+
+Usage:
+```
+adapter = get_adapter("openai", api_key=api_key)
+engine = InferenceEngine(adapter=adapter, scheduler=adapter.create_scheduler(), max_attempts=5)
+await engine.run(requests_filepath, save_filepath, additional_params={"temperature": 0})
+```
+
+An `InferenceJob` bundles one request file with its model and budgets. `run_jobs_concurrently`
+runs several jobs in one event loop: each job keeps its own scheduler (models draw on separate
+rate limits) while all of them share one HTTP session and its connection pool. With
+`share_model_budgets`, jobs calling the same model (e.g. the same model in several configs)
+draw on one shared scheduler instead, each through its own lane, so together they stay within
+the account's limits for that model and are served round-robin.
+
+A job with `use_batch_api` is sent through the OpenAI Batch API (lib/openai_batch.py) instead
+of this engine; it writes the same output file and journal.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+
+import aiohttp
+
+from lib.adapters import ProviderAdapter, get_adapter_class
+from lib.http_transport import HttpTransportSettings, create_session, pool_stats
+from lib.io import open_jsonl
+from lib.api_errors import ErrorKind, RetryPolicy, classify_exception, parse_retry_after
+from lib.credentials import Credential, CredentialPool, CredentialSettings
+from lib.dispatch_queue import DispatchPolicy, DispatchQueue
+from lib.hedging import HedgeSettings, HedgeTimer
+from lib.journal import CompletionJournal, request_key
+from lib.metrics import DEFAULT_EXPORT_INTERVAL, MetricsExporter, RunMetrics
+from lib.offset_index import OffsetIndex, sort_output_by_input
+from lib.openai_batch import BatchStatus, OpenAIBatchRunner
+from lib.response_cache import ResponseCache
+from lib.result_rows import InlineResultParser
+from lib.result_writer import JsonlResultWriter
+from lib.scheduler import RateLimitScheduler, SchedulerLane
+from lib.shutdown import DEFAULT_DRAIN_SECONDS, GracefulShutdown, PendingCheckpoint, RunInterrupted, cancel_on_shutdown
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class StatusTracker:
+    """Stores metadata about the run's progress. One instance per engine."""
+
+    num_tasks_started: int = 0
+    num_tasks_already_completed: int = 0  # skipped because the journal has their result
+    num_tasks_cached: int = 0  # answered from the response cache, included in succeeded
+    num_tasks_coalesced: int = 0  # answered by an identical request in flight, included in succeeded/failed
+    num_tasks_in_progress: int = 0  # run ends when this reaches 0
+    num_tasks_succeeded: int = 0
+    num_tasks_failed: int = 0
+    num_rate_limit_errors: int = 0
+    num_api_errors: int = 0  # excluding rate limit errors, counted above
+    num_other_errors: int = 0
+    num_retries: int = 0
+    num_hedges: int = 0  # duplicate calls sent for slow requests
+    num_hedge_wins: int = 0  # hedges that answered first
+    interrupted: bool = False  # stopped by a shutdown request, unfinished requests are in the checkpoint
+    time_of_last_rate_limit_error: int = 0  # only informative, rate limited requests back off on their own
+
+
+@dataclass
+class APIRequest:
+    """Stores an API request's inputs, outputs, and other metadata."""
+
+    task_id: int
+    request_json: dict
+    token_consumption: int
+    attempts_left: int
+    metadata: dict
+    result: list = field(default_factory=list)
+    request_key: str = None  # journaled once the result is written
+    line_number: int = None  # of the request in the input file
+    cache_key: str = None  # None if the response must not be cached
+    content_key: str = None  # hash of request_json, identical requests share it
+    followers: list = field(default_factory=list)  # identical requests waiting for this one's result
+    error_kinds: list = field(default_factory=list)
+
+
+class InferenceEngine:
+    """Runs the requests of one jsonl file against one provider adapter."""
+
+    def __init__(
+        self,
+        adapter: ProviderAdapter,
+        scheduler: RateLimitScheduler | SchedulerLane,
+        max_attempts: int = 5,
+        cache: ResponseCache | None = None,
+        coalesce_identical_requests: bool = True,
+        retry_policy: RetryPolicy | None = None,
+        result_parser: InlineResultParser | None = None,
+        dispatch_policy: DispatchPolicy | str = DispatchPolicy.RETRIES_FIRST,
+        lookahead: int = 1,
+        hedging: HedgeSettings | None = None,
+        shutdown: GracefulShutdown | None = None,
+        job: str | None = None,
+    ) -> None:
+        self.adapter = adapter
+        self.scheduler = scheduler
+        self.max_attempts = max_attempts
+        self.cache = cache
+        self.coalesce_identical_requests = coalesce_identical_requests
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.result_parser = result_parser
+        self.dispatch_queue = DispatchQueue(dispatch_policy, lookahead=lookahead)
+        self.hedge_timer = HedgeTimer(hedging) if hedging is not None else None  # None disables hedging
+        self.shutdown = shutdown
+        self._open_requests = {}  # task id -> request read but not finished yet
+        self._next_line_number = 0  # first line of the request file not read yet, None at the end
+        self._requests_by_content = {}  # content key -> request in flight or waiting for a retry
+        # `job` tells apart concurrent runs of the same model, run() defaults it to the output file
+        self.metrics = RunMetrics(
+            labels={"job": job or "", "format": adapter.format, "model": adapter.model or ""}, gauges=self._gauges
+        )
+        self.status_tracker = StatusTracker()
+        self._tasks = set()  # keep references to running tasks so they are not garbage collected
+
+    async def run(
+        self,
+        requests_filepath: str,
+        save_filepath: str,
+        additional_params: dict | None = None,
+        resume: bool = True,
+        session: aiohttp.ClientSession | None = None,
+    ) -> StatusTracker:
+        """Process every request of `requests_filepath`, appending results to `save_filepath`.
+
+        With `resume`, requests already journaled as completed are skipped; otherwise the
+        output file and its journal start over. A `session` may be shared between engines.
+        With a `result_parser`, the result file is written once all requests have finished.
+        After a shutdown request, the unfinished requests are saved to a `PendingCheckpoint`.
+        """
+        additional_params = additional_params or {}
+        if not self.metrics.labels["job"]:
+            self.metrics.labels["job"] = save_filepath
+        journal = CompletionJournal(save_filepath)
+        checkpoint = PendingCheckpoint(save_filepath)
+        if resume:
+            journal.load()
+            journal.repair_output()
+            if journal.completed:
+                logger.info(
+                    f"Resuming {save_filepath}: {len(journal.completed)} requests already completed"
+                )
+            previous = checkpoint.load()
+            if previous is not None:
+                logger.info(
+                    f"Previous run was interrupted at {previous['interrupted_at']} with "
+                    f"{len(previous['pending'])} requests pending and reading up to line {previous['next_line_number']}"
+                )
+        else:
+            journal.reset()
+            OffsetIndex(save_filepath).reset()
+
+        if self.result_parser is not None:
+            await self.result_parser.start(resume=resume)
+        finished = False
+        try:
+            if session is None:
+                async with create_session() as session:
+                    status_tracker = await self._run(requests_filepath, save_filepath, additional_params, journal, session)
+            else:
+                status_tracker = await self._run(requests_filepath, save_filepath, additional_params, journal, session)
+            finished = not status_tracker.interrupted
+        finally:
+            if self.cache is not None:
+                self.cache.flush()
+            if self.result_parser is not None:
+                await self.result_parser.close(finalize=finished, completed_keys=journal.completed)
+        if status_tracker.interrupted:
+            pending = [
+                {"line_number": r.line_number, "request_key": r.request_key, "attempts": self.max_attempts - r.attempts_left}
+                for r in self._open_requests.values()
+            ]
+            checkpoint.save(pending, self._next_line_number)
+            logger.warning(
+                f"Interrupted {save_filepath} with {len(pending)} requests pending, saved to {checkpoint.filepath}"
+            )
+        else:
+            checkpoint.remove()
+        return status_tracker
+
+    async def _run(self, requests_filepath, save_filepath, additional_params, journal, session):
+        with open_jsonl(requests_filepath) as file:
+            # `requests` will provide requests one at a time, with their line numbers
+            requests = enumerate(file)
+            index = OffsetIndex(save_filepath)
+            async with JsonlResultWriter(save_filepath, journal=journal, index=index) as result_writer:
+                dispatch = self._dispatch(requests, journal, additional_params, session, result_writer)
+                if self.shutdown is None:
+                    await dispatch
+                else:
+                    finished, _ = await cancel_on_shutdown(dispatch, self.shutdown)
+                    if not finished:
+                        self.status_tracker.interrupted = True
+                        await self._drain()
+
+        self._log_summary(save_filepath)
+        logger.debug(f"Connection pool: {pool_stats(session)}")
+        return self.status_tracker
+
+    async def _dispatch(self, requests, journal, additional_params, session, result_writer) -> None:
+        """Send every request and retry until none is left in progress."""
+        status_tracker = self.status_tracker
+        scheduler = self.scheduler
+        queue = self.dispatch_queue
+        file_not_finished = True  # after file is empty, we'll skip reading it
+
+        while True:
+            # queue due retries and read new requests up to the lookahead, then let the policy pick
+            while (retry := scheduler.pop_due_retry()) is not None:
+                logger.debug(f"Retrying request {retry.task_id}")
+                queue.push(retry, is_retry=True)
+            while file_not_finished and queue.wants_more():
+                try:
+                    request = self._read_request(requests, journal, additional_params)
+                except StopIteration:
+                    logger.debug("Read file exhausted")
+                    file_not_finished = False
+                    break
+                if (
+                    request is not None
+                    and not self._answer_from_cache(request, result_writer)
+                    and not self._coalesce(request)
+                ):
+                    queue.push(request)
+            next_request = queue.pop()
+
+            if next_request is None:
+                # if all tasks are finished, break
+                if status_tracker.num_tasks_in_progress == 0:
+                    break
+                # otherwise sleep until a retry is due or the last task finishes
+                await scheduler.wait_until(lambda: status_tracker.num_tasks_in_progress == 0)
+                continue
+
+            # wait until enough capacity is available, then call API
+            credential = await scheduler.acquire(next_request.token_consumption)  # None without a pool
+            next_request.attempts_left -= 1
+            task = asyncio.create_task(self._call_api(next_request, session, result_writer, credential))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+            # yield so the new task can start before the next launch
+            await asyncio.sleep(0)
+
+    async def _drain(self) -> None:
+        """Give the calls in flight `drain_seconds` to finish after a shutdown request, then cancel them."""
+        tasks = set(self._tasks)
+        if not tasks:
+            return
+        logger.info(f"Waiting up to {self.shutdown.drain_seconds:g}s for {len(tasks)} requests in flight")
+        _, pending = await asyncio.wait(tasks, timeout=self.shutdown.drain_seconds)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        if pending:
+            logger.warning(f"Cancelled {len(pending)} requests still in flight after the drain deadline")
+
+    def _read_request(self, requests, journal, additional_params) -> APIRequest | None:
+        """Next request from file, or None for a blank line or if a previous run already completed it."""
+        try:
+            line_number, line = next(requests)
+        except StopIteration:
+            self._next_line_number = None
+            raise
+        self._next_line_number = line_number + 1
+        if not line.strip():
+            return None  # like the journal and the batch runner, blank lines are not requests
+        key = request_key(line_number, line)
+        if journal.is_completed(key):
+            self.status_tracker.num_tasks_already_completed += 1
+            return None
+        request_json = self.adapter.prepare_request(json.loads(line), additional_params)
+        metadata = request_json.pop("metadata", None)
+        request = APIRequest(
+            task_id=self.status_tracker.num_tasks_started,
+            request_json=request_json,
+            token_consumption=self.adapter.num_tokens(request_json),
+            attempts_left=self.max_attempts,
+            metadata=metadata,
+            request_key=key,
+            line_number=line_number,
+        )
+        if self.cache is not None and self.adapter.is_deterministic(request_json):
+            request.cache_key = self.cache.key(self.adapter.format, self.adapter.request_url, request_json)
+        self.status_tracker.num_tasks_started += 1
+        self.status_tracker.num_tasks_in_progress += 1
+        self._open_requests[request.task_id] = request
+        logger.debug(f"Reading request {request.task_id}")
+        return request
+
+    def _answer_from_cache(self, request: APIRequest, result_writer) -> bool:
+        """Write the cached response for `request`, if there is one."""
+        if request.cache_key is None:
+            return False
+        response = self.cache.get(request.cache_key)
+        if response is None:
+            return False
+        self.status_tracker.num_tasks_cached += 1
+        logger.debug(f"Request {request.task_id} answered from cache")
+        self._save_result(request, response, result_writer, succeeded=True)
+        return True
+
+    def _coalesce(self, request: APIRequest) -> bool:
+        """Attach `request` to an identical one that is already being processed, if any."""
+        if not self.coalesce_identical_requests:
+            return False
+        content = json.dumps(request.request_json, sort_keys=True).encode("utf-8")
+        request.content_key = hashlib.blake2b(content, digest_size=16).hexdigest()
+        leader = self._requests_by_content.get(request.content_key)
+        if leader is None:
+            self._requests_by_content[request.content_key] = request
+            return False
+        leader.followers.append(request)
+        self.status_tracker.num_tasks_coalesced += 1
+        logger.debug(f"Request {request.task_id} waits for identical request {leader.task_id}")
+        return True
+
+    def _save_result(self, request: APIRequest, result, result_writer, succeeded: bool) -> None:
+        """Write `result` once for `request` and once for every identical request waiting on it.
+
+        Only successful results are journaled, failed requests are sent again when resuming.
+        """
+        if request.content_key is not None:
+            self._requests_by_content.pop(request.content_key, None)
+        status_tracker = self.status_tracker
+        for r in [request, *request.followers]:
+            data = [r.request_json, result, {**(r.metadata or {}), "line_number": r.line_number}]
+            result_writer.write(data, journal_key=r.request_key if succeeded else None, line_number=r.line_number)
+            if succeeded and self.result_parser is not None:
+                self.result_parser.add(r.request_key, data)
+            status_tracker.num_tasks_in_progress -= 1
+            self._open_requests.pop(r.task_id, None)
+            if succeeded:
+                status_tracker.num_tasks_succeeded += 1
+            else:
+                status_tracker.num_tasks_failed += 1
+
+    def _budget(self, credential: Credential | None) -> RateLimitScheduler | SchedulerLane:
+        """Scheduler the calls made with `credential` are booked against."""
+        return credential.scheduler if credential is not None else self.scheduler
+
+    async def _post(self, request: APIRequest, session, credential: Credential | None = None) -> tuple:
+        """One HTTP call for `request`: (response, error, error kind, retry after, credential used)."""
+        api_key = credential.api_key if credential is not None else None
+        error = None
+        error_kind = None
+        retry_after = None
+        response = None
+        status = None
+        try:
+            async with session.post(
+                url=self.adapter.request_url,
+                headers=self.adapter.request_headers(api_key),
+                params=self.adapter.request_params(api_key),
+                json=request.request_json,
+            ) as response:
+                status = response.status
+                self._budget(credential).update_from_headers(response.headers)
+                retry_after = parse_retry_after(response.headers)
+                response = await response.json(content_type=None)
+            if not isinstance(response, dict):
+                raise ValueError(f"Expected a json object, got {type(response).__name__}")
+            if "error" in response:
+                logger.warning(f"Request {request.task_id} failed with error {response['error']}")
+                error = response
+                error_kind = self.adapter.classify_error(status, response["error"])
+        except Exception as e:  # catching naked exceptions is bad practice, but in this case we'll log & save them
+            logger.warning(f"Request {request.task_id} failed with Exception {e!r}")
+            error = e
+            if status is not None and isinstance(e, ValueError):
+                # a body that is not json, e.g. the html error page of a proxy: the status tells more
+                error_kind = self.adapter.classify_error(status, {})
+            else:
+                error_kind = classify_exception(e)
+        return response, error, error_kind, retry_after, credential
+
+    async def _post_hedged(self, request: APIRequest, session, credential: Credential | None = None) -> tuple:
+        """Like `_post`, but races a second call against one that takes longer than usual.
+
+        The hedge is only sent if the scheduler has capacity for it right now. The first
+        successful call wins and the other one is cancelled; if the first to finish failed,
+        the other call still gets its chance. With a credential pool, the hedge may go out
+        with another key.
+        """
+        primary = asyncio.create_task(self._post(request, session, credential))
+        hedge = None
+        hedge_credential = None
+        try:
+            delay = self.hedge_timer.delay()
+            if delay is not None:
+                done, _ = await asyncio.wait({primary}, timeout=delay)
+                acquired = (
+                    not done
+                    and self.hedge_timer.may_hedge(self.metrics.num_requests_sent, self.metrics.num_hedges)
+                    and self.scheduler.try_acquire(request.token_consumption)
+                )
+                if acquired:
+                    logger.info(f"Hedging request #{request.task_id}, no answer after {delay:.1f}s")
+                    self.status_tracker.num_hedges += 1
+                    self.metrics.record_hedge(request.token_consumption)
+                    hedge_credential = acquired if isinstance(acquired, Credential) else None
+                    hedge = asyncio.create_task(self._post(request, session, hedge_credential))
+            if hedge is None:
+                return await primary
+
+            pending = {primary, hedge}
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # prefer a successful call if both finished at once
+                for task in sorted(done, key=lambda t: t.result()[1] is not None):
+                    outcome = task.result()
+                    if outcome[1] is None or not pending:
+                        if task is hedge:
+                            self.status_tracker.num_hedge_wins += 1
+                            self.metrics.record_hedge_win()
+                        return outcome
+        finally:
+            tasks = [task for task in (primary, hedge) if task is not None]
+            for task in tasks:
+                task.cancel()  # the loser, no-op for finished calls
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if hedge is not None:
+                await self._budget(hedge_credential).release()  # capacity taken by the hedge
+
+    async def _call_api(self, request: APIRequest, session, result_writer, credential: Credential | None = None) -> None:
+        """Calls the API once for `request` and saves the result or schedules a retry.
+
+        `credential` is the key `acquire` handed out, None without a credential pool. Whatever
+        goes wrong, the capacity taken for the call is released and the request is either
+        retried or saved, so the dispatch loop never waits for it forever.
+        """
+        logger.info(f"Starting request #{request.task_id}")
+        self.metrics.record_request_sent()
+        start_time = time.monotonic()
+        answered_with = credential
+        try:
+            try:
+                if self.hedge_timer is None:
+                    response, error, error_kind, retry_after, answered_with = await self._post(request, session, credential)
+                else:
+                    response, error, error_kind, retry_after, answered_with = await self._post_hedged(
+                        request, session, credential
+                    )
+                if not error:
+                    await self._record_response(request, response, answered_with, time.monotonic() - start_time)
+            except Exception as e:
+                # e.g. a malformed response body or a locked cache, counts as a failed attempt
+                logger.warning(f"Request {request.task_id} failed while handling its response: {e!r}")
+                response, error, error_kind, retry_after = None, e, classify_exception(e), None
+
+            if error:
+                self._handle_error(request, error, error_kind, retry_after, answered_with, result_writer)
+            else:
+                self._save_result(request, response, result_writer, succeeded=True)
+                logger.debug(f"Request {request.task_id} queued for {result_writer.filepath}")
+        finally:
+            await self._budget(credential).release()
+
+    async def _record_response(self, request: APIRequest, response, answered_with: Credential | None, latency: float) -> None:
+        """Book the latency and token usage of a successful call and cache its response."""
+        if self.hedge_timer is not None:
+            self.hedge_timer.observe(latency)
+        self._budget(answered_with).record_success()
+        prompt_tokens, completion_tokens = self.adapter.usage(response)
+        self.metrics.record_response(
+            latency, prompt_tokens, completion_tokens, estimated_tokens=request.token_consumption
+        )
+        if prompt_tokens or completion_tokens:
+            self.adapter.observe_usage(request.request_json, prompt_tokens, completion_tokens)
+            await self._budget(answered_with).reconcile_tokens(request.token_consumption, prompt_tokens + completion_tokens)
+        if request.cache_key is not None:
+            self.cache.put(request.cache_key, response)
+
+    def _handle_error(
+        self, request: APIRequest, error, error_kind: ErrorKind, retry_after, answered_with: Credential | None, result_writer
+    ) -> None:
+        """Count a failed call and schedule a retry, or save the errors once no attempt is left."""
+        status_tracker = self.status_tracker
+        request.result.append(error)
+        request.error_kinds.append(error_kind.value)
+        self.metrics.record_error(error_kind.value)
+        if error_kind == ErrorKind.RATE_LIMIT:
+            status_tracker.time_of_last_rate_limit_error = time.time()
+            status_tracker.num_rate_limit_errors += 1
+            self._budget(answered_with).record_rate_limit_error()
+        elif error_kind.is_api_error:
+            status_tracker.num_api_errors += 1
+        else:
+            status_tracker.num_other_errors += 1
+
+        retryable = error_kind.is_retryable
+        if answered_with is not None and error_kind.is_credential_error:
+            # the key is at fault, not the request: retry with another key if there is one
+            retryable = self.scheduler.quarantine(answered_with)
+        if request.attempts_left and retryable:
+            delay = self.retry_policy.delay(error_kind, len(request.error_kinds), retry_after)
+            logger.info(f"Retrying request {request.task_id} in {delay:.1f}s ({error_kind.value})")
+            status_tracker.num_retries += 1
+            self.metrics.record_retry()
+            self.scheduler.schedule_retry(request, delay)
+        else:
+            logger.error(
+                f"Request {request.task_id} failed ({', '.join(request.error_kinds)}). Saving errors: {request.result}"
+            )
+            errors = [str(e) for e in request.result]
+            self._save_result(request, errors, result_writer, succeeded=False)
+
+    def _gauges(self) -> dict:
+        status_tracker = self.status_tracker
+        return {
+            "calls_in_flight": len(self._tasks),
+            "tasks_in_progress": status_tracker.num_tasks_in_progress,
+            "requests_open": len(self._open_requests),
+            "dispatch_queue_depth": len(self.dispatch_queue),
+            "retry_queue_depth": self.scheduler.num_pending_retries(),
+            "waiting_for_capacity": self.scheduler.num_waiting(),
+            "tasks_succeeded": status_tracker.num_tasks_succeeded,
+            "tasks_failed": status_tracker.num_tasks_failed,
+            "tasks_cached": status_tracker.num_tasks_cached,
+            "tasks_coalesced": status_tracker.num_tasks_coalesced,
+            "max_requests_per_minute": self.scheduler.stats()["max_requests_per_minute"],
+        }
+
+    def _log_summary(self, save_filepath) -> None:
+        status_tracker = self.status_tracker
+        logger.info(f"Parallel processing complete. Results saved to {save_filepath}")
+        if self.cache is not None:
+            logger.info(
+                f"{status_tracker.num_tasks_cached} / {status_tracker.num_tasks_succeeded} succeeded requests answered from cache. Cache stats: {self.cache.stats()}"
+            )
+        if status_tracker.num_tasks_coalesced > 0:
+            logger.info(
+                f"{status_tracker.num_tasks_coalesced} requests were identical to one in flight and shared its result"
+            )
+        if status_tracker.num_tasks_failed > 0:
+            logger.warning(
+                f"{status_tracker.num_tasks_failed} / {status_tracker.num_tasks_started} requests failed. Errors logged to {save_filepath}."
+            )
+        if status_tracker.num_rate_limit_errors > 0:
+            logger.warning(
+                f"{status_tracker.num_rate_limit_errors} rate limit errors received. Consider running at a lower rate."
+            )
+        if status_tracker.num_hedges > 0:
+            metrics = self.metrics
+            logger.info(
+                f"{status_tracker.num_hedges} slow requests hedged (hedge rate {metrics.hedge_rate()}), "
+                f"{status_tracker.num_hedge_wins} answered first by the hedge, "
+                f"{metrics.num_hedge_tokens} tokens budgeted for hedges"
+            )
+        logger.info(f"Final rate limit budgets: {self.scheduler.stats()}")
+        metrics = self.metrics
+        if metrics.num_estimated_tokens:
+            logger.info(
+                f"Token estimate: {metrics.num_estimated_tokens} tokens budgeted vs "
+                f"{metrics.num_prompt_tokens + metrics.num_completion_tokens} reported (ratio {metrics.estimate_ratio()})"
+            )
+        adapter_stats = self.adapter.stats()
+        if adapter_stats:
+            logger.info(f"Adapter stats: {adapter_stats}")
+
+
+@dataclass
+class InferenceJob:
+    """One request file to run against one model with its own rate budget."""
+
+    format: str
+    requests_filepath: str
+    save_filepath: str
+    model: str = None
+    temperature: float = 0  # if model and temperature are None, the value in the input file is used
+    resume: bool = True
+    max_attempts: int = 5
+    # None falls back to the adapter defaults
+    max_requests_per_minute: float = None
+    max_tokens_per_minute: float = None
+    max_in_flight: int = None
+    request_url: str = None  # None uses the adapter's URL for the model
+    cache: ResponseCache = None  # None disables the response cache
+    use_batch_api: bool = False  # OpenAI only, submit as batches instead of live requests
+    result_file: str = None  # parse responses into this file as they arrive, None to parse afterwards
+    integer_score_only: bool = False
+    sort_output: bool = False  # rewrite the output file in input order once all requests have finished
+    dispatch_policy: str = DispatchPolicy.RETRIES_FIRST  # see lib/dispatch_queue.py
+    dispatch_lookahead: int = 1  # requests read ahead of dispatch for the policy to choose from
+    hedging: HedgeSettings = None  # None disables hedged requests
+    credentials: list[CredentialSettings] = None  # several API keys with their own budgets, None for the adapter's key
+
+    @property
+    def budget_key(self) -> tuple:
+        """Jobs with the same key call the same model and can share its rate budget."""
+        return (self.format, self.model or self.request_url)
+
+    def create_adapter(self) -> ProviderAdapter:
+        adapter_class = get_adapter_class(self.format)
+        return adapter_class(
+            api_key=os.getenv(adapter_class.api_key_env_var),
+            request_url=self.request_url,
+            model=self.model,
+        )
+
+    def create_result_parser(self) -> InlineResultParser | None:
+        if self.result_file is None:
+            return None
+        return InlineResultParser(self.result_file, format=self.format, integer_score_only=self.integer_score_only)
+
+    def create_scheduler(
+        self,
+        adapter: ProviderAdapter,
+        max_requests_per_minute: float | None = None,
+        max_tokens_per_minute: float | None = None,
+        max_in_flight: int | None = None,
+    ) -> RateLimitScheduler:
+        """Scheduler with the given budgets, a credential pool if the job has `credentials`."""
+        if self.credentials:
+            return CredentialPool(
+                adapter,
+                self.credentials,
+                max_requests_per_minute=max_requests_per_minute,
+                max_tokens_per_minute=max_tokens_per_minute,
+                max_in_flight=max_in_flight,
+            )
+        return adapter.create_scheduler(
+            max_requests_per_minute=max_requests_per_minute,
+            max_tokens_per_minute=max_tokens_per_minute,
+            max_in_flight=max_in_flight,
+        )
+
+    def create_engine(
+        self,
+        scheduler: RateLimitScheduler | SchedulerLane | None = None,
+        shutdown: GracefulShutdown | None = None,
+    ) -> InferenceEngine:
+        """Engine for this job, with its own scheduler unless a (shared) one is given."""
+        adapter = self.create_adapter()
+        if scheduler is None:
+            scheduler = self.create_scheduler(
+                adapter,
+                max_requests_per_minute=self.max_requests_per_minute,
+                max_tokens_per_minute=self.max_tokens_per_minute,
+                max_in_flight=self.max_in_flight,
+            )
+        return InferenceEngine(
+            adapter=adapter,
+            scheduler=scheduler,
+            max_attempts=self.max_attempts,
+            cache=self.cache,
+            result_parser=self.create_result_parser(),
+            dispatch_policy=self.dispatch_policy,
+            lookahead=self.dispatch_lookahead,
+            hedging=self.hedging,
+            shutdown=shutdown,
+            job=self.save_filepath,
+        )
+
+    async def run(
+        self,
+        session: aiohttp.ClientSession | None = None,
+        scheduler: RateLimitScheduler | SchedulerLane | None = None,
+        exporter: MetricsExporter | None = None,
+        shutdown: GracefulShutdown | None = None,
+    ) -> StatusTracker | BatchStatus | None:
+        """Run the job; None if a `shutdown` stopped a batch job while it was polling."""
+        logger.info(f"Run model [{self.model}] with input: {self.requests_filepath}.")
+        if self.use_batch_api:
+            if shutdown is None:
+                status = await self.run_batch(session=session)
+            else:
+                # the submitted batches are kept in the batch state file, the next run resumes polling
+                finished, status = await cancel_on_shutdown(self.run_batch(session=session), shutdown)
+                if not finished:
+                    return None
+        else:
+            engine = self.create_engine(scheduler=scheduler, shutdown=shutdown)
+            if exporter is not None:
+                exporter.register(engine.metrics)
+            status = await engine.run(
+                requests_filepath=self.requests_filepath,
+                save_filepath=self.save_filepath,
+                additional_params=engine.adapter.additional_params(temperature=self.temperature),
+                resume=self.resume,
+                session=session,
+            )
+            if status.interrupted:
+                return status
+        if self.sort_output:
+            await asyncio.to_thread(sort_output_by_input, self.save_filepath)
+        return status
+
+
+    async def run_batch(self, session: aiohttp.ClientSession | None = None) -> BatchStatus:
+        if self.format != "openai":
+            raise Exception(f"The batch API is not supported for model format: {self.format}")
+        adapter = self.create_adapter()
+        runner = OpenAIBatchRunner(adapter=adapter, cache=self.cache, result_parser=self.create_result_parser())
+        return await runner.run(
+            requests_filepath=self.requests_filepath,
+            save_filepath=self.save_filepath,
+            additional_params=adapter.additional_params(temperature=self.temperature),
+            resume=self.resume,
+            session=session,
+        )
+
+
+def create_shared_schedulers(jobs: list[InferenceJob]) -> dict[tuple, RateLimitScheduler]:
+    """One scheduler per model, keyed by `InferenceJob.budget_key`.
+
+    When jobs of the same model configure different budgets, the smallest one is used.
+    """
+    jobs_by_key = {}
+    for job in jobs:
+        if job.use_batch_api:
+            continue  # batches are not bound by the per-minute limits
+        jobs_by_key.setdefault(job.budget_key, []).append(job)
+    schedulers = {}
+    for key, model_jobs in jobs_by_key.items():
+        adapter = model_jobs[0].create_adapter()
+        schedulers[key] = model_jobs[0].create_scheduler(
+            adapter,
+            max_requests_per_minute=_min_or_none(job.max_requests_per_minute for job in model_jobs),
+            max_tokens_per_minute=_min_or_none(job.max_tokens_per_minute for job in model_jobs),
+            max_in_flight=_min_or_none(job.max_in_flight for job in model_jobs),
+        )
+        logger.info(f"Shared rate budget for {key} across {len(model_jobs)} jobs: {schedulers[key].stats()}")
+    return schedulers
+
+
+def _min_or_none(values):
+    values = [v for v in values if v is not None]
+    return min(values) if values else None
+
+
+async def run_jobs_concurrently(
+    jobs: list[InferenceJob],
+    share_model_budgets: bool = False,
+    transport: HttpTransportSettings | None = None,
+    metrics_dirs: list[str] | None = None,
+    metrics_interval: float = DEFAULT_EXPORT_INTERVAL,
+    drain_seconds: float = DEFAULT_DRAIN_SECONDS,
+) -> list[StatusTracker]:
+    """Run all jobs in the current event loop, sharing one HTTP session built from `transport`.
+
+    With `share_model_budgets`, jobs of the same model share one rate budget (see
+    `create_shared_schedulers`), otherwise every job gets its own.
+    With `metrics_dirs`, live metrics of all jobs are exported there every `metrics_interval` seconds.
+    A failing job does not stop the others; the first error is raised once all have finished.
+    SIGINT/SIGTERM stop all jobs gracefully (see lib/shutdown.py), giving the calls in flight
+    `drain_seconds` to finish, and raise `RunInterrupted` once they have drained.
+    """
+    schedulers = create_shared_schedulers(jobs) if share_model_budgets else {}
+    exporter = MetricsExporter(metrics_dirs, interval=metrics_interval) if metrics_dirs else None
+    shutdown = GracefulShutdown(drain_seconds=drain_seconds)
+    async with create_session(transport) as session:
+        runs = []
+        for job in jobs:
+            scheduler = schedulers.get(job.budget_key)
+            lane = scheduler.lane(name=job.save_filepath) if scheduler else None
+            runs.append(job.run(session=session, scheduler=lane, exporter=exporter, shutdown=shutdown))
+        if exporter is not None:
+            exporter.start()
+        try:
+            with shutdown.handle_signals():
+                results = await asyncio.gather(*runs, return_exceptions=True)
+        finally:
+            if exporter is not None:
+                await exporter.stop()
+        logger.info(f"Connection pool: {pool_stats(session)}")
+    errors = []
+    for job, result in zip(jobs, results):
+        if isinstance(result, BaseException):
+            logger.error(f"Model [{job.model}] failed on {job.requests_filepath}: {result!r}")
+            errors.append(result)
+    if errors:
+        raise errors[0]
+    if shutdown.requested:
+        raise RunInterrupted(f"Stopped by a shutdown request, {len(jobs)} jobs can be resumed")
+    return results
@@ -1,13 +1,110 @@
 from enum import Enum
+import gzip
+import io
 import os
+import zlib
 import pandas as pd
 import json
+import zstandard
+
+
+# Compressed jsonl files are recognized by their extension, e.g. `test.full.gpt-4.output.jsonl.zst`
+COMPRESSION_EXTENSIONS = {
+    '.gz': 'gzip',
+    '.zst': 'zstd',
+    '.zstd': 'zstd',
+}
+DEFAULT_COMPRESSION_LEVELS = {
+    'gzip': 6,  # gzip.open defaults to 9, which is several times slower for little gain
+    'zstd': 3,
+}
+# raised when a compressed stream ends in the middle, e.g. after a crash
+TRUNCATED_STREAM_ERRORS = (EOFError, zlib.error, zstandard.ZstdError)
+_CHUNK_SIZE = 1 << 20
+
+
+def jsonl_compression(file_path):
+    """'gzip', 'zstd' or None, from the extension of `file_path`."""
+    return COMPRESSION_EXTENSIONS.get(os.path.splitext(file_path)[1].lower())
+
+
+def open_jsonl(file_path, mode='r', level=None):
+    """Open a jsonl file, compressing or decompressing on the fly if its extension asks for it.
+
+    `mode` is one of 'r', 'w', 'a' (text, utf-8) or 'rb', 'wb', 'ab'. Reading streams through
+    the file and continues across gzip members and zstd frames, so a file appended to by
+    several runs reads as one. `flush()` makes everything written so far decodable.
+    """
+    compression = jsonl_compression(file_path)
+    if compression is None:
+        return open(file_path, mode)
+    binary = 'b' in mode
+    raw_mode = mode.replace('b', '').replace('t', '') + 'b'
+    level = level or DEFAULT_COMPRESSION_LEVELS[compression]
+    if compression == 'gzip':
+        file = gzip.open(file_path, raw_mode, compresslevel=level)
+        if binary:
+            return file
+        return io.TextIOWrapper(file, encoding='utf-8')
+    if raw_mode == 'rb':
+        reader = zstandard.ZstdDecompressor().stream_reader(
+            open(file_path, 'rb'), read_across_frames=True, closefd=True
+        )
+        file = io.BufferedReader(reader, buffer_size=_CHUNK_SIZE)
+    else:
+        file = zstandard.ZstdCompressor(level=level).stream_writer(open(file_path, raw_mode), closefd=True)
+    if binary:
+        return file
+    return io.TextIOWrapper(file, encoding='utf-8')
+
+
+def iter_jsonl_lines(file_path, mode='r'):
+    """Yield the complete lines of a (compressed) jsonl file, one at a time.
+
+    A partial trailing line, or the undecodable end of a truncated compressed stream, is
+    dropped, like the tail of a file whose writer crashed.
+    """
+    newline = b'\n' if 'b' in mode else '\n'
+    with open_jsonl(file_path, mode) as file:
+        try:
+            for line in file:
+                if line.endswith(newline):
+                    yield line
+        except TRUNCATED_STREAM_ERRORS:
+            pass
+
+
+def compressed_stream_is_intact(file_path):
+    """Whether every gzip member or zstd frame of `file_path` is complete and it ends with a newline."""
+    compression = jsonl_compression(file_path)
+    if compression == 'gzip':
+        new_decoder = lambda: zlib.decompressobj(zlib.MAX_WBITS | 16)
+    else:
+        new_decoder = lambda: zstandard.ZstdDecompressor().decompressobj()
+    decoder = None
+    last_byte = b'\n'
+    try:
+        with open(file_path, 'rb') as file:
+            while chunk := file.read(_CHUNK_SIZE):
+                while chunk:
+                    if decoder is None:
+                        decoder = new_decoder()
+                    data = decoder.decompress(chunk)
+                    if data:
+                        last_byte = data[-1:]
+                    chunk = b''
+                    if decoder.eof:
+                        chunk = decoder.unused_data
+                        decoder = None
+    except TRUNCATED_STREAM_ERRORS:
+        return False
+    return decoder is None and last_byte == b'\n'
 
 
 def save_to_jsonl(dataset, file_path):
     path = os.path.dirname(file_path)
     os.makedirs(path, exist_ok=True)
-    with open(file_path, 'w') as file:
+    with open_jsonl(file_path, 'w') as file:
         for record in dataset:
             json_line = json.dumps(record)
             file.write(json_line + '\n')
@@ -0,0 +1,148 @@
+"""
+COMPLETION JOURNAL
+
+Per-request completion journal kept next to a processor output file, so an interrupted run
+can be resumed instead of re-sending every request.
+
+Each request line of the input file gets a key derived from its line number and content.
+When a result has been written to the output file, its key is appended to
+`<output file>.journal`. A restarted run loads the journal, drops a half-written trailing
+line from the output file, and only dispatches requests whose key is missing. Requests that
+failed after all attempts are written to the output but not journaled, so they are retried.
+
+The journal is written after the output lines it covers have been flushed, so a crash can
+at worst cause a request to be sent (and written) twice, never lost.
+
+Compressed output files (.gz, .zst) cannot be truncated in place; if their stream was cut
+off by a crash, `repair_output` rewrites them with the complete lines. Checking a compressed
+file means decoding it once, on every resume.
+"""
+
+import hashlib
+import logging
+import os
+from lib.io import compressed_stream_is_intact, iter_jsonl_lines, jsonl_compression, open_jsonl
+
+logger = logging.getLogger(__name__)
+
+
+def request_key(line_number: int, line: str) -> str:
+    """Key identifying the request on `line_number` of an input file."""
+    content = f"{line_number}:{line.strip()}".encode("utf-8")
+    return hashlib.blake2b(content, digest_size=16).hexdigest()
+
+
+def iter_request_keys(requests_filepath: str):
+    with open_jsonl(requests_filepath) as file:
+        for line_number, line in enumerate(file):
+            if line.strip():
+                yield request_key(line_number, line)
+
+
+class CompletionJournal:
+    """Set of completed request keys, persisted as one key per line."""
+
+    def __init__(self, output_filepath: str) -> None:
+        self.output_filepath = output_filepath
+        self.filepath = self.journal_path(output_filepath)
+        self.completed = set()
+        self._file = None
+
+    @staticmethod
+    def journal_path(output_filepath: str) -> str:
+        return output_filepath + ".journal"
+
+    def exists(self) -> bool:
+        return os.path.exists(self.filepath)
+
+    def load(self) -> "CompletionJournal":
+        self.completed = set()
+        if self.exists():
+            with open(self.filepath) as file:
+                # a trailing partial key is simply ignored, its request is sent again
+                self.completed = {line.strip() for line in file if line.endswith("\n")}
+        return self
+
+    def reset(self) -> None:
+        """Start over: forget completed requests and truncate the output file."""
+        self.completed = set()
+        for fn in [self.filepath, self.output_filepath]:
+            if os.path.exists(fn):
+                os.remove(fn)
+
+    def is_completed(self, key: str) -> bool:
+        return key in self.completed
+
+    def is_complete(self, requests_filepath: str) -> bool:
+        """Whether every request of `requests_filepath` already has a result in the output file.
+
+        An output file without a journal was produced by a run that predates the journal
+        and is treated as complete.
+        """
+        if not os.path.exists(self.output_filepath):
+            return False
+        if not self.exists():
+            return True
+        self.load()
+        return all(key in self.completed for key in iter_request_keys(requests_filepath))
+
+    def repair_output(self) -> None:
+        """Drop a half-written trailing line left in the output file by a crash."""
+        if not os.path.exists(self.output_filepath):
+            return
+        if jsonl_compression(self.output_filepath):
+            self._repair_compressed_output()
+            return
+        with open(self.output_filepath, "rb+") as file:
+            file.seek(0, os.SEEK_END)
+            size = file.tell()
+            if size == 0:
+                return
+            file.seek(size - 1)
+            if file.read(1) == b"\n":
+                return
+            # walk back to the last complete line
+            position = size - 1
+            chunk_size = 4096
+            while position > 0:
+                start = max(0, position - chunk_size)
+                file.seek(start)
+                chunk = file.read(position - start)
+                index = chunk.rfind(b"\n")
+                if index >= 0:
+                    position = start + index + 1
+                    break
+                position = start
+            file.truncate(position)
+            logger.warning(
+                f"Dropped a partial line at the end of {self.output_filepath} ({size - position} bytes)"
+            )
+
+    def _repair_compressed_output(self) -> None:
+        if compressed_stream_is_intact(self.output_filepath):
+            return
+        size = os.path.getsize(self.output_filepath)
+        tmp_filepath = self.output_filepath + ".repairing" + os.path.splitext(self.output_filepath)[1]
+        with open_jsonl(tmp_filepath, "wb") as file:
+            for line in iter_jsonl_lines(self.output_filepath, "rb"):
+                file.write(line)
+        os.replace(tmp_filepath, self.output_filepath)
+        logger.warning(
+            f"Rewrote {self.output_filepath} without the truncated end of its compressed stream "
+            f"({size} -> {os.path.getsize(self.output_filepath)} bytes)"
+        )
+
+    def open(self) -> None:
+        self._file = open(self.filepath, "a")
+
+    def record(self, keys: list[str]) -> None:
+        if not keys:
+            return
+        self.completed.update(keys)
+        self._file.write("".join(key + "\n" for key in keys))
+        self._file.flush()
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,315 @@
+"""
+RUN METRICS
+
+Live throughput and latency metrics of inference runs, exported while the run is going.
+
+Every engine keeps a `RunMetrics`: cumulative counters and a latency histogram (for
+Prometheus), plus a rolling window of recent events from which requests/s, tokens/s, latency
+percentiles and retry/hedge/rate limit rates are computed. Gauges such as the number of calls in
+flight and the queue depths are read from the engine when a snapshot is taken.
+
+A `MetricsExporter` periodically writes a snapshot of all registered runs to
+`<output_root>/metrics/inference_status.json` and, in the Prometheus text format, to
+`<output_root>/metrics/inference.prom` (e.g. for the node exporter's textfile collector).
+Both files are replaced atomically, so they can be watched during multi-hour runs.
+
+Usage:
+```
+async with MetricsExporter([config.output_root], interval=10) as exporter:
+    exporter.register(engine.metrics)
+    await engine.run(...)
+```
+"""
+
+import asyncio
+import bisect
+import collections
+import json
+import logging
+import math
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LATENCY_BUCKETS = (0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120)  # seconds
+DEFAULT_WINDOW_SECONDS = 60.0
+DEFAULT_EXPORT_INTERVAL = 10.0  # seconds
+
+
+class LatencyHistogram:
+    """Cumulative histogram with fixed upper bounds, like a Prometheus histogram."""
+
+    def __init__(self, buckets=DEFAULT_LATENCY_BUCKETS) -> None:
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self) -> list[tuple[str, int]]:
+        total = 0
+        result = []
+        for bound, count in zip([*map(str, self.buckets), "+Inf"], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class RunMetrics:
+    """Counters, latency histogram and rolling window of one engine run."""
+
+    def __init__(self, labels: dict | None = None, window_seconds: float = DEFAULT_WINDOW_SECONDS, gauges=None) -> None:
+        self.labels = labels or {}
+        self.window_seconds = window_seconds
+        self.gauges = gauges  # callable returning a dict of current values, or None
+        self.started_at = time.time()
+        self.latency = LatencyHistogram()
+        self.num_requests_sent = 0
+        self.num_responses = 0
+        self.num_retries = 0
+        self.num_errors = collections.Counter()  # by ErrorKind value
+        self.num_prompt_tokens = 0
+        self.num_completion_tokens = 0
+        self.num_estimated_tokens = 0  # budgeted for the responses that reported their usage
+        self.num_hedges = 0  # duplicate calls sent for slow requests, not counted in requests sent
+        self.num_hedge_wins = 0  # hedges that answered before the original call
+        self.num_hedge_tokens = 0  # budgeted for the hedges
+        # (monotonic time, event, value) of the last `window_seconds`
+        self._events = collections.deque()
+
+    # recording
+
+    def _event(self, event: str, value: float = 1.0) -> None:
+        now = time.monotonic()
+        self._events.append((now, event, value))
+        self._trim(now)
+
+    def _trim(self, now: float) -> None:
+        cutoff = now - self.window_seconds
+        while self._events and self._events[0][0] < cutoff:
+            self._events.popleft()
+
+    def record_request_sent(self) -> None:
+        self.num_requests_sent += 1
+        self._event("sent")
+
+    def record_response(
+        self, seconds: float, prompt_tokens: int = 0, completion_tokens: int = 0, estimated_tokens: int = 0
+    ) -> None:
+        self.num_responses += 1
+        self.latency.observe(seconds)
+        self.num_prompt_tokens += prompt_tokens
+        self.num_completion_tokens += completion_tokens
+        if prompt_tokens or completion_tokens:
+            self.num_estimated_tokens += estimated_tokens
+        self._event("latency", seconds)
+        if prompt_tokens or completion_tokens:
+            self._event("tokens", prompt_tokens + completion_tokens)
+
+    def record_error(self, error_kind: str) -> None:
+        self.num_errors[error_kind] += 1
+        self._event(f"error:{error_kind}")
+
+    def record_retry(self) -> None:
+        self.num_retries += 1
+        self._event("retry")
+
+    def record_hedge(self, estimated_tokens: int = 0) -> None:
+        self.num_hedges += 1
+        self.num_hedge_tokens += estimated_tokens
+        self._event("hedge")
+
+    def record_hedge_win(self) -> None:
+        self.num_hedge_wins += 1
+
+    # reading
+
+    def rolling(self) -> dict:
+        """Rates and latency percentiles over the last `window_seconds`."""
+        now = time.monotonic()
+        self._trim(now)
+        # use the elapsed time until the window is full, so early rates are not underestimated
+        seconds = max(1e-9, min(self.window_seconds, time.time() - self.started_at))
+        latencies = sorted(value for _, event, value in self._events if event == "latency")
+        num_sent = sum(1 for _, event, _ in self._events if event == "sent")
+        num_retries = sum(1 for _, event, _ in self._events if event == "retry")
+        num_hedges = sum(1 for _, event, _ in self._events if event == "hedge")
+        num_errors = sum(1 for _, event, _ in self._events if event.startswith("error:"))
+        num_rate_limited = sum(1 for _, event, _ in self._events if event == "error:rate_limit")
+        num_tokens = sum(value for _, event, value in self._events if event == "tokens")
+        num_attempts = len(latencies) + num_errors
+        return {
+            "window_seconds": self.window_seconds,
+            "requests_per_second": round(num_sent / seconds, 3),
+            "responses_per_second": round(len(latencies) / seconds, 3),
+            "tokens_per_second": round(num_tokens / seconds, 3),
+            "latency_p50": _percentile(latencies, 0.5),
+            "latency_p90": _percentile(latencies, 0.9),
+            "latency_p99": _percentile(latencies, 0.99),
+            "retry_rate": round(num_retries / num_sent, 4) if num_sent else 0.0,
+            "hedge_rate": round(num_hedges / num_sent, 4) if num_sent else 0.0,
+            "rate_limit_rate": round(num_rate_limited / num_attempts, 4) if num_attempts else 0.0,
+            "error_rate": round(num_errors / num_attempts, 4) if num_attempts else 0.0,
+        }
+
+    def snapshot(self) -> dict:
+        return {
+            "labels": self.labels,
+            "elapsed_seconds": round(time.time() - self.started_at, 1),
+            "totals": {
+                "requests_sent": self.num_requests_sent,
+                "responses": self.num_responses,
+                "retries": self.num_retries,
+                "errors": dict(self.num_errors),
+                "prompt_tokens": self.num_prompt_tokens,
+                "completion_tokens": self.num_completion_tokens,
+                "estimated_tokens": self.num_estimated_tokens,
+                "estimate_ratio": self.estimate_ratio(),
+                "hedges": self.num_hedges,
+                "hedge_wins": self.num_hedge_wins,
+                "hedge_tokens": self.num_hedge_tokens,
+                "hedge_rate": self.hedge_rate(),
+                "latency_mean": round(self.latency.sum / self.latency.count, 4) if self.latency.count else None,
+            },
+            "rolling": self.rolling(),
+            "gauges": self.gauges() if self.gauges else {},
+        }
+
+
+    def estimate_ratio(self) -> float | None:
+        """Budgeted / reported tokens, above 1 when the estimates are too high."""
+        actual = self.num_prompt_tokens + self.num_completion_tokens
+        return round(self.num_estimated_tokens / actual, 4) if actual else None
+
+    def hedge_rate(self) -> float:
+        """Hedges per API call sent."""
+        return round(self.num_hedges / self.num_requests_sent, 4) if self.num_requests_sent else 0.0
+
+
+def _percentile(sorted_values: list, fraction: float) -> float | None:
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, math.ceil(fraction * len(sorted_values)) - 1)
+    return round(sorted_values[max(0, index)], 4)
+
+
+class MetricsExporter:
+    """Writes the metrics of the registered runs to status files every `interval` seconds."""
+
+    status_filename = "inference_status.json"
+    prometheus_filename = "inference.prom"
+
+    def __init__(self, output_dirs: list[str], interval: float = DEFAULT_EXPORT_INTERVAL) -> None:
+        self.output_dirs = [os.path.join(output_dir, "metrics") for output_dir in dict.fromkeys(output_dirs)]
+        self.interval = interval
+        self.runs = []
+        self._task = None
+
+    def register(self, metrics: RunMetrics) -> None:
+        self.runs.append(metrics)
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
+
+    def start(self) -> None:
+        for output_dir in self.output_dirs:
+            os.makedirs(output_dir, exist_ok=True)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop the periodic export and write the final state."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        self.export()
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.export()
+            except OSError as e:
+                logger.warning(f"Could not export metrics: {e!r}")
+
+    def export(self) -> None:
+        snapshots = [metrics.snapshot() for metrics in self.runs]
+        status = json.dumps({"updated_at": time.time(), "runs": snapshots}, indent=2)
+        prometheus = self.prometheus_text(snapshots)
+        for output_dir in self.output_dirs:
+            _write_atomic(os.path.join(output_dir, self.status_filename), status)
+            _write_atomic(os.path.join(output_dir, self.prometheus_filename), prometheus)
+
+    def prometheus_text(self, snapshots: list[dict]) -> str:
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                if value is not None:
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+
+        runs = list(zip(self.runs, snapshots))
+        metric("inference_requests_sent_total", "counter", "API calls sent, including retries.",
+               [(m.labels, m.num_requests_sent) for m, _ in runs])
+        metric("inference_retries_total", "counter", "Requests scheduled for a retry.",
+               [(m.labels, m.num_retries) for m, _ in runs])
+        metric("inference_errors_total", "counter", "Failed API calls by error kind.",
+               [({**m.labels, "kind": kind}, count) for m, _ in runs for kind, count in m.num_errors.items()])
+        metric("inference_tokens_total", "counter", "Tokens reported by the API.",
+               [({**m.labels, "type": "prompt"}, m.num_prompt_tokens) for m, _ in runs]
+               + [({**m.labels, "type": "completion"}, m.num_completion_tokens) for m, _ in runs])
+        metric("inference_estimated_tokens_total", "counter", "Tokens budgeted for the responses that reported usage.",
+               [(m.labels, m.num_estimated_tokens) for m, _ in runs])
+        metric("inference_hedges_total", "counter", "Duplicate calls sent for slow requests.",
+               [(m.labels, m.num_hedges) for m, _ in runs])
+        metric("inference_hedge_wins_total", "counter", "Hedges that answered before the original call.",
+               [(m.labels, m.num_hedge_wins) for m, _ in runs])
+        metric("inference_hedge_tokens_total", "counter", "Tokens budgeted for hedges.",
+               [(m.labels, m.num_hedge_tokens) for m, _ in runs])
+        lines.append("# HELP inference_latency_seconds Latency of successful API calls.")
+        lines.append("# TYPE inference_latency_seconds histogram")
+        for m, _ in runs:
+            for bound, count in m.latency.cumulative_counts():
+                lines.append(f"inference_latency_seconds_bucket{_format_labels({**m.labels, 'le': bound})} {count}")
+            lines.append(f"inference_latency_seconds_sum{_format_labels(m.labels)} {m.latency.sum}")
+            lines.append(f"inference_latency_seconds_count{_format_labels(m.labels)} {m.latency.count}")
+        for key in ["requests_per_second", "tokens_per_second", "latency_p50", "latency_p99", "retry_rate", "hedge_rate", "rate_limit_rate"]:
+            metric(f"inference_rolling_{key}", "gauge", f"{key.replace('_', ' ').capitalize()} over the rolling window.",
+                   [(m.labels, snapshot["rolling"][key]) for m, snapshot in runs])
+        gauge_names = sorted({name for _, snapshot in runs for name in snapshot["gauges"]})
+        for name in gauge_names:
+            metric(f"inference_{name}", "gauge", f"{name.replace('_', ' ').capitalize()}.",
+                   [(m.labels, snapshot["gauges"].get(name)) for m, snapshot in runs])
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape_label_value(value)}"' for key, value in labels.items()) + "}"
+
+
+def _escape_label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _write_atomic(filepath: str, content: str) -> None:
+    tmp_filepath = filepath + ".tmp"
+    with open(tmp_filepath, "w") as file:
+        file.write(content)
+    os.replace(tmp_filepath, filepath)
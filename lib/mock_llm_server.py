@@ -0,0 +1,346 @@
+"""
+MOCK LLM SERVER
+
+Local aiohttp stand-in for the APIs the processors call, to test and benchmark them without
+paying for real calls:
+- OpenAI chat completions: `POST /v1/chat/completions`
+- OpenAI batches: `POST /v1/files`, `POST /v1/batches`, `GET /v1/batches/{id}`,
+  `GET /v1/files/{id}/content` (batches complete after `batch_polls_until_complete` polls)
+- Gemini: `POST /v1beta/models/{model}:generateContent`
+
+Behaviour is set by `MockServerSettings`: a latency distribution per call, random 429 and 5xx
+injection, and optionally real request/token per minute limits that answer 429 with
+`x-ratelimit-*` and `retry-after-ms` headers once exhausted. Responses are essay scores in the
+format `ResponseParser` expects, with token usage.
+
+Usage:
+```
+async with MockLLMServer(MockServerSettings(latency_median_ms=300, rate_limit_error_rate=0.02)) as server:
+    request_url = server.url + "/v1/chat/completions"
+```
+or standalone:
+```
+python -m lib.mock_llm_server --port 8765 --latency_median_ms 300 --requests_per_minute 3000
+```
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import math
+import random
+import time
+from dataclasses import asdict, dataclass, fields
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class MockServerSettings:
+    latency_distribution: str = "lognormal"  # "lognormal", "uniform" or "fixed"
+    latency_median_ms: float = 200.0
+    latency_sigma: float = 0.5  # lognormal shape; uniform spans median * (1 -/+ sigma)
+    rate_limit_error_rate: float = 0.0  # fraction of calls answered with a random 429
+    server_error_rate: float = 0.0  # fraction of calls answered with a 500
+    requests_per_minute: float | None = None  # simulated account limits, None for unlimited
+    tokens_per_minute: float | None = None
+    completion_tokens: int = 60
+    batch_polls_until_complete: int = 2
+    batch_poll_error_rate: float = 0.0  # fraction of batch polls answered with a proxy's html 502 page
+    seed: int | None = None
+
+
+class _Bucket:
+    """Provider-side token bucket, refilled continuously like the real APIs."""
+
+    def __init__(self, limit_per_minute: float) -> None:
+        self.limit = limit_per_minute
+        self.available = limit_per_minute
+        self.last_update = time.monotonic()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.available = min(self.limit, self.available + self.limit * (now - self.last_update) / 60.0)
+        self.last_update = now
+
+    def seconds_until(self, amount: float) -> float:
+        return max(0.0, (amount - self.available) * 60.0 / self.limit)
+
+
+class MockLLMServer:
+    def __init__(self, settings: MockServerSettings | None = None, host: str = "127.0.0.1", port: int = 0) -> None:
+        self.settings = settings or MockServerSettings()
+        self.host = host
+        self.port = port
+        self.random = random.Random(self.settings.seed)
+        self.request_bucket = _Bucket(self.settings.requests_per_minute) if self.settings.requests_per_minute else None
+        self.token_bucket = _Bucket(self.settings.tokens_per_minute) if self.settings.tokens_per_minute else None
+        self.stats = {"requests": 0, "succeeded": 0, "rate_limited": 0, "server_errors": 0, "completion_tokens": 0}
+        self._files = {}
+        self._batches = {}
+        self._ids = itertools.count()
+        self._runner = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=256 * 1024 * 1024)
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        app.router.add_post("/v1beta/models/{model_action}", self.generate_content)
+        app.router.add_post("/v1/files", self.upload_file)
+        app.router.add_get("/v1/files/{file_id}/content", self.file_content)
+        app.router.add_post("/v1/batches", self.create_batch)
+        app.router.add_get("/v1/batches/{batch_id}", self.get_batch)
+        return app
+
+    async def start(self) -> None:
+        self._runner = web.AppRunner(self.app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+        logger.info(f"Mock LLM server listening on {self.url}")
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
+
+    # simulation
+
+    def _latency(self) -> float:
+        settings = self.settings
+        median = settings.latency_median_ms / 1000
+        if settings.latency_distribution == "fixed":
+            return median
+        if settings.latency_distribution == "uniform":
+            return self.random.uniform(median * (1 - settings.latency_sigma), median * (1 + settings.latency_sigma))
+        return self.random.lognormvariate(math.log(median), settings.latency_sigma)
+
+    def _num_prompt_tokens(self, texts: list[str]) -> int:
+        # rough estimate, good enough for simulated token limits and usage
+        return sum(len(text) for text in texts) // 4 + 1
+
+    def _rate_limit_headers(self, num_tokens: int) -> tuple[dict, float | None]:
+        """Consume the simulated limits; returns the headers and the seconds to wait if exhausted."""
+        headers = {}
+        wait = None
+        for bucket, kind, amount in [(self.request_bucket, "requests", 1), (self.token_bucket, "tokens", num_tokens)]:
+            if bucket is None:
+                continue
+            bucket.refill()
+            if bucket.available < amount:
+                wait = max(wait or 0.0, bucket.seconds_until(amount))
+            headers[f"x-ratelimit-limit-{kind}"] = str(int(bucket.limit))
+            headers[f"x-ratelimit-reset-{kind}"] = f"{(bucket.limit - bucket.available) * 60.0 / bucket.limit:.3f}s"
+        if wait is None:
+            for bucket, amount in [(self.request_bucket, 1), (self.token_bucket, num_tokens)]:
+                if bucket is not None:
+                    bucket.available -= amount
+        for bucket, kind in [(self.request_bucket, "requests"), (self.token_bucket, "tokens")]:
+            if bucket is not None:
+                headers[f"x-ratelimit-remaining-{kind}"] = str(max(0, int(bucket.available)))
+        return headers, wait
+
+    async def _simulate(self, num_prompt_tokens: int):
+        """Returns (status, headers) of a failure, or (None, headers) for a success."""
+        self.stats["requests"] += 1
+        headers, wait = self._rate_limit_headers(num_prompt_tokens + self.settings.completion_tokens)
+        if wait is not None:
+            self.stats["rate_limited"] += 1
+            headers["retry-after-ms"] = str(int(wait * 1000) + 1)
+            return 429, headers
+        await asyncio.sleep(self._latency())
+        roll = self.random.random()
+        if roll < self.settings.rate_limit_error_rate:
+            self.stats["rate_limited"] += 1
+            return 429, headers
+        if roll < self.settings.rate_limit_error_rate + self.settings.server_error_rate:
+            self.stats["server_errors"] += 1
+            return 500, headers
+        self.stats["succeeded"] += 1
+        self.stats["completion_tokens"] += self.settings.completion_tokens
+        return None, headers
+
+    def _content(self) -> str:
+        score = self.random.choice([1, 1.5, 2, 2.5, 3, 3.5, 4, 4.5, 5])
+        return json.dumps({"score": str(score), "reasoning": "Mock response."})
+
+    # openai
+
+    def _chat_completion(self, body: dict, num_prompt_tokens: int) -> dict:
+        return {
+            "id": f"chatcmpl-{next(self._ids)}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "mock"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": self._content()}, "finish_reason": "stop"}],
+            "usage": {
+                "prompt_tokens": num_prompt_tokens,
+                "completion_tokens": self.settings.completion_tokens,
+                "total_tokens": num_prompt_tokens + self.settings.completion_tokens,
+            },
+        }
+
+    async def chat_completions(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        num_prompt_tokens = self._num_prompt_tokens([m.get("content") or "" for m in body.get("messages", [])])
+        status, headers = await self._simulate(num_prompt_tokens)
+        if status == 429:
+            error = {"message": "Rate limit reached for requests", "type": "requests", "code": "rate_limit_exceeded"}
+            return web.json_response({"error": error}, status=429, headers=headers)
+        if status is not None:
+            error = {"message": "The server had an error while processing your request.", "type": "server_error"}
+            return web.json_response({"error": error}, status=status, headers=headers)
+        return web.json_response(self._chat_completion(body, num_prompt_tokens), headers=headers)
+
+    # gemini
+
+    async def generate_content(self, request: web.Request) -> web.Response:
+        model, _, action = request.match_info["model_action"].partition(":")
+        if action != "generateContent":
+            raise web.HTTPNotFound()
+        body = await request.json()
+        texts = [part.get("text", "") for content in body.get("contents", []) for part in content.get("parts", [])]
+        num_prompt_tokens = self._num_prompt_tokens(texts)
+        status, headers = await self._simulate(num_prompt_tokens)
+        if status == 429:
+            error = {"code": 429, "message": "Resource has been exhausted (e.g. check quota).", "status": "RESOURCE_EXHAUSTED"}
+            return web.json_response({"error": error}, status=429)
+        if status is not None:
+            error = {"code": status, "message": "An internal error has occurred.", "status": "INTERNAL"}
+            return web.json_response({"error": error}, status=status)
+        return web.json_response({
+            "candidates": [{"content": {"parts": [{"text": self._content()}], "role": "model"}, "finishReason": "STOP", "index": 0}],
+            "usageMetadata": {
+                "promptTokenCount": num_prompt_tokens,
+                "candidatesTokenCount": self.settings.completion_tokens,
+                "totalTokenCount": num_prompt_tokens + self.settings.completion_tokens,
+            },
+        })
+
+    # openai batches
+
+    async def upload_file(self, request: web.Request) -> web.Response:
+        data = await request.post()
+        file = data["file"]
+        content = file.file.read().decode("utf-8") if hasattr(file, "file") else str(file)
+        file_id = f"file-{next(self._ids)}"
+        self._files[file_id] = content
+        return web.json_response({"id": file_id, "object": "file", "purpose": data.get("purpose"), "bytes": len(content)})
+
+    async def file_content(self, request: web.Request) -> web.Response:
+        file_id = request.match_info["file_id"]
+        if file_id not in self._files:
+            raise web.HTTPNotFound()
+        return web.Response(text=self._files[file_id])
+
+    async def create_batch(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        if body.get("input_file_id") not in self._files:
+            return web.json_response({"error": {"message": "No such file"}}, status=400)
+        batch_id = f"batch_{next(self._ids)}"
+        self._batches[batch_id] = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": body["endpoint"],
+            "input_file_id": body["input_file_id"],
+            "completion_window": body.get("completion_window", "24h"),
+            "status": "validating",
+            "output_file_id": None,
+            "error_file_id": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+            "polls": 0,
+        }
+        return web.json_response(self._public_batch(batch_id))
+
+    async def get_batch(self, request: web.Request) -> web.Response:
+        batch_id = request.match_info["batch_id"]
+        if batch_id not in self._batches:
+            raise web.HTTPNotFound()
+        if self.random.random() < self.settings.batch_poll_error_rate:
+            return web.Response(status=502, text="<html><body><h1>502 Bad Gateway</h1></body></html>", content_type="text/html")
+        batch = self._batches[batch_id]
+        batch["polls"] += 1
+        if batch["status"] != "completed":
+            if batch["polls"] >= self.settings.batch_polls_until_complete:
+                self._complete_batch(batch)
+            else:
+                batch["status"] = "in_progress"
+        return web.json_response(self._public_batch(batch_id))
+
+    def _public_batch(self, batch_id: str) -> dict:
+        return {key: value for key, value in self._batches[batch_id].items() if key != "polls"}
+
+    def _complete_batch(self, batch: dict) -> None:
+        outputs = []
+        errors = []
+        for line in self._files[batch["input_file_id"]].splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if self.random.random() < self.settings.server_error_rate:
+                errors.append({
+                    "id": f"batch_req_{next(self._ids)}",
+                    "custom_id": item["custom_id"],
+                    "response": None,
+                    "error": {"code": "server_error", "message": "The server had an error while processing your request."},
+                })
+                continue
+            body = item["body"]
+            num_prompt_tokens = self._num_prompt_tokens([m.get("content") or "" for m in body.get("messages", [])])
+            outputs.append({
+                "id": f"batch_req_{next(self._ids)}",
+                "custom_id": item["custom_id"],
+                "response": {"status_code": 200, "request_id": f"req_{next(self._ids)}", "body": self._chat_completion(body, num_prompt_tokens)},
+                "error": None,
+            })
+        self.random.shuffle(outputs)  # like the real API, output order is not input order
+        for key, items in [("output_file_id", outputs), ("error_file_id", errors)]:
+            if items:
+                file_id = f"file-{next(self._ids)}"
+                self._files[file_id] = "".join(json.dumps(item) + "\n" for item in items)
+                batch[key] = file_id
+        batch["request_counts"] = {"total": len(outputs) + len(errors), "completed": len(outputs), "failed": len(errors)}
+        batch["status"] = "completed"
+
+
+def run_server(settings: MockServerSettings, host: str = "127.0.0.1", port: int = 8765, ready=None) -> None:
+    """Serve until the process is stopped. `ready` (e.g. a multiprocessing Event) is set once listening."""
+
+    async def serve():
+        async with MockLLMServer(settings, host=host, port=port):
+            if ready is not None:
+                ready.set()
+            await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    for f in fields(MockServerSettings):
+        default = getattr(MockServerSettings, f.name)
+        arg_type = str if f.name == "latency_distribution" else (int if f.name in ("completion_tokens", "batch_polls_until_complete", "seed") else float)
+        parser.add_argument(f"--{f.name}", type=arg_type, default=default)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    settings = MockServerSettings(**{f.name: getattr(args, f.name) for f in fields(MockServerSettings)})
+    logger.info(f"Mock settings: {asdict(settings)}")
+    run_server(settings, host=args.host, port=args.port)
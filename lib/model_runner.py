@@ -1,9 +1,14 @@
-import os
 import asyncio
 import logging
+from lib.credentials import credentials_from_config
 from lib.finetuning import FineTuningHelper
-from lib.api_request_parallel_processor import process_api_requests_from_file_openai
-from lib.api_request_google import process_api_requests_from_file as process_api_requests_from_file_google
+from lib.hedging import HedgeSettings
+from lib.inference_engine import InferenceJob, run_jobs_concurrently
+from lib.http_transport import HttpTransportSettings
+from lib.journal import CompletionJournal
+from lib.metrics import DEFAULT_EXPORT_INTERVAL
+from lib.response_cache import get_response_cache
+from lib.shutdown import DEFAULT_DRAIN_SECONDS
 
 logger = logging.getLogger(__name__)
 
@@ -12,12 +17,48 @@ class ModelRunner:
         self.config = config
         
     def run(self, skip_if_exists=True):
-        self._run_openai_finetuned(skip_if_exists=skip_if_exists)
-        self._run_baseline_models(skip_if_exists=skip_if_exists)
+        jobs = self.collect_jobs(skip_if_exists=skip_if_exists)
+        if not jobs:
+            return
+        options = dict(
+            transport=HttpTransportSettings.from_config(self.config),
+            metrics_dirs=[self.config.output_root],
+            metrics_interval=self.config.get("metrics_export_interval", DEFAULT_EXPORT_INTERVAL),
+            drain_seconds=self.config.get("shutdown_drain_seconds", DEFAULT_DRAIN_SECONDS),
+        )
+        if self.config.get("run_models_concurrently", False):
+            # One event loop for all models, each with its own rate budget
+            asyncio.run(run_jobs_concurrently(jobs, **options))
+        else:
+            for job in jobs:
+                asyncio.run(run_jobs_concurrently([job], **options))
+
+    def response_cache(self):
+        """Shared response cache from the `response_cache` config entry, or None if not configured."""
+        cache_config = self.config.get("response_cache")
+        if not cache_config or not cache_config.get("enabled", True):
+            return None
+        return get_response_cache(
+            cache_config["path"],
+            max_size_mb=cache_config.get("max_size_mb"),
+            max_age_days=cache_config.get("max_age_days"),
+        )
 
-    def _run_openai_finetuned(self, skip_if_exists=True):
+    def result_file(self, save_filepath):
+        """Result file to parse the responses of `save_filepath` into while it runs, if enabled."""
+        if not self.config.get("parse_responses_inline", False):
+            return None
+        for data_path in self.config.data_paths:
+            if data_path.dataset_out == save_filepath:
+                return data_path.result_file
+        return None
+
+    def collect_jobs(self, skip_if_exists=True) -> list[InferenceJob]:
+        return self._finetuned_jobs(skip_if_exists=skip_if_exists) + self._baseline_jobs(skip_if_exists=skip_if_exists)
+
+    def _finetuned_jobs(self, skip_if_exists=True):
         if not self.config.run_finetuned:
-            return
+            return []
         finetuner = FineTuningHelper(self.config)
         job = finetuner.try_load_job()
         if job and job['status'] == 'succeeded':
@@ -25,22 +66,34 @@ class ModelRunner:
             input_fn = self.config.dataset_test_short_filename
             output_fn = self.config.get_dataset_test_result_finetuned_filename()
             
-            if skip_if_exists and os.path.exists(output_fn):
+            if skip_if_exists and self._is_complete(input_fn, output_fn):
                 logger.info(f"Skip running model {fine_tuned_model}.")
-            else:
-                self._run_openai_model(
-                    input_jsonl_fn=input_fn,
-                    output_jsonl_fn=output_fn,
-                    model=fine_tuned_model,
-                    temperature=self.config.temperature,
-                )
+                return []
+            return [InferenceJob(
+                format='openai',
+                requests_filepath=input_fn,
+                save_filepath=output_fn,
+                model=fine_tuned_model,
+                temperature=self.config.temperature,
+                resume=skip_if_exists,
+                cache=self.response_cache(),
+                use_batch_api=self.config.get("use_openai_batch_api", False),
+                result_file=self.result_file(output_fn),
+                integer_score_only=self.config.integer_score_only,
+                sort_output=self.config.get("sort_output_by_input", False),
+                dispatch_policy=self.config.get("dispatch_policy", "retries_first"),
+                dispatch_lookahead=self.config.get("dispatch_lookahead", 1),
+                hedging=HedgeSettings.from_config(self.config),
+                credentials=credentials_from_config(self.config, 'openai'),
+            )]
         else:
             logger.info(f"Fine-tuning model is not ready yet: {job}")
+            return []
 
-
-    def _run_baseline_models(self, skip_if_exists=True):
+    def _baseline_jobs(self, skip_if_exists=True):
         if not self.config.run_baseline:
-            return
+            return []
+        jobs = []
         for data_path in self.config.data_paths:
             if not data_path.active or data_path.is_finetuned:
                 continue
@@ -48,98 +101,35 @@ class ModelRunner:
             input_fn = data_path.dataset_in
             output_fn = data_path.dataset_out
             
-            if skip_if_exists and os.path.exists(output_fn):
+            if skip_if_exists and self._is_complete(input_fn, output_fn):
                 logger.info(f"Skip running model {model_id}.")
                 continue
             
-            if data_path.format == 'openai':
-                self._run_openai_model(
-                    input_jsonl_fn=input_fn,
-                    output_jsonl_fn=output_fn,
-                    model=model_id,
-                    temperature=self.config.temperature,
-                )
-            elif data_path.format == 'gemini':
-                self._run_google_model(
-                    input_jsonl_fn=input_fn,
-                    output_jsonl_fn=output_fn,
-                    model=model_id,
-                    temperature=self.config.temperature,
-                )
-            else:
-                raise Exception(f"Unknown model format: {data_path.format}")
-
-    @classmethod
-    def _run_openai_model(
-        cls,
-        input_jsonl_fn,
-        output_jsonl_fn,
-        model=None,
-        temperature=0,
-        max_attempts=5,
-        logging_level=logging.INFO,
-    ):
-        logger.info(f"Run model [{model}] with input: {input_jsonl_fn}.")
-        # If model and temperature are None, the value in the input file will be used.
-        api_key = os.getenv("OPENAI_API_KEY")
-        request_url = "https://api.openai.com/v1/chat/completions"
-        max_requests_per_minute = 3_000 * 0.5
-        max_tokens_per_minute = 250_000 * 0.5
-        token_encoding_name = "cl100k_base"
-
-        additional_params = {}
-        if model is not None:
-            additional_params["model"] = model
-        if temperature is not None:
-            additional_params["temperature"] = temperature
-
-        # run script
-        asyncio.run(
-            process_api_requests_from_file_openai(
-                requests_filepath=input_jsonl_fn,
-                save_filepath=output_jsonl_fn,
-                request_url=request_url,
-                api_key=api_key,
-                max_requests_per_minute=max_requests_per_minute,
-                max_tokens_per_minute=max_tokens_per_minute,
-                token_encoding_name=token_encoding_name,
-                max_attempts=max_attempts,
-                logging_level=logging_level,
-                additional_params=additional_params,
-            )
-        )
-
-    @classmethod
-    def _run_google_model(
-        cls,
-        input_jsonl_fn,
-        output_jsonl_fn,
-        model=None,
-        temperature=0,
-        max_attempts=5,
-        logging_level=logging.INFO,
-    ):
-        logger.info(f"Run model [{model}] with input: {input_jsonl_fn}.")
-        # If model and temperature are None, the value in the input file will be used.
-
-        additional_params = {}
-        # if model is not None:
-            # additional_params["model"] = model
-        if temperature is not None:
-            additional_params["generationConfig"] = {"temperature": temperature}
-
-        api_key = os.getenv("GOOGLE_API_KEY")
-        request_url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-pro:generateContent"
-        
-        asyncio.run(
-            process_api_requests_from_file_google(
-                requests_filepath=input_jsonl_fn,
-                save_filepath=output_jsonl_fn,
-                request_url=request_url,
-                api_key=api_key,
-                max_attempts=max_attempts,
-                logging_level=logging_level,
-                additional_params=additional_params,
-            )
-        )
+            jobs.append(InferenceJob(
+                format=data_path.format,
+                requests_filepath=input_fn,
+                save_filepath=output_fn,
+                model=model_id,
+                temperature=self.config.temperature,
+                resume=skip_if_exists,
+                cache=self.response_cache(),
+                use_batch_api=data_path.format == 'openai' and self.config.get("use_openai_batch_api", False),
+                # Per-model budgets from the config override the adapter defaults
+                max_requests_per_minute=data_path.max_requests_per_minute,
+                max_tokens_per_minute=data_path.max_tokens_per_minute,
+                max_in_flight=data_path.max_in_flight,
+                result_file=self.result_file(output_fn),
+                integer_score_only=self.config.integer_score_only,
+                sort_output=self.config.get("sort_output_by_input", False),
+                dispatch_policy=self.config.get("dispatch_policy", "retries_first"),
+                dispatch_lookahead=self.config.get("dispatch_lookahead", 1),
+                hedging=HedgeSettings.from_config(self.config),
+                credentials=credentials_from_config(self.config, data_path.format),
+            ))
+        return jobs
 
+    @staticmethod
+    def _is_complete(input_fn, output_fn):
+        """Whether a previous run already has a result for every request in `input_fn`.
+        A partially finished run is resumed from its completion journal instead."""
+        return CompletionJournal(output_fn).is_complete(input_fn)
@@ -0,0 +1,197 @@
+"""
+OFFSET INDEX
+
+Input-order index of a processor output file, kept next to it as `<output file>.idx`.
+
+Results are appended in completion order, so output line N has nothing to do with input line
+N. The engine records the input line number of every request in the metadata of its output
+line (`"line_number"`), and the result writer records where that line starts in the index:
+slot N of the index (bytes `8 * N` to `8 * N + 8`) holds the byte offset of the result for
+input line N, plus one, as a little-endian uint64. An empty slot (0) means no result yet. A
+result written again, e.g. after a retry in a resumed run, overwrites its slot, so the index
+always points at the latest result.
+
+Like the journal, the index is written after the output lines it covers have been flushed.
+
+`sort_output_by_input` rewrites the output file in input order, one line at a time, dropping
+superseded lines, and rebuilds the index for the new file. Lines the index misses are kept
+after the sorted ones.
+
+Compressed output files (.gz, .zst) are not indexed and stay in completion order.
+
+Usage:
+```
+index = OffsetIndex(save_filepath)
+request_json, response, metadata = index.read(42)  # result of input line 42, or None
+```
+"""
+
+import json
+import logging
+import os
+import struct
+from lib.io import jsonl_compression
+
+logger = logging.getLogger(__name__)
+
+SLOT = struct.Struct("<Q")
+
+
+class OffsetIndex:
+    """Fixed-width slots mapping input line numbers to byte offsets in the output file."""
+
+    def __init__(self, output_filepath: str) -> None:
+        self.output_filepath = output_filepath
+        self.filepath = self.index_path(output_filepath)
+        self._file = None
+
+    @staticmethod
+    def index_path(output_filepath: str) -> str:
+        return output_filepath + ".idx"
+
+    def exists(self) -> bool:
+        return os.path.exists(self.filepath)
+
+    def reset(self) -> None:
+        if self.exists():
+            os.remove(self.filepath)
+
+    def open(self) -> None:
+        self._file = open(self.filepath, "r+b" if self.exists() else "w+b")
+
+    def record(self, entries: list[tuple[int, int]]) -> None:
+        """Store `(line_number, offset)` pairs."""
+        if not entries:
+            return
+        for line_number, offset in entries:
+            self._file.seek(line_number * SLOT.size)
+            self._file.write(SLOT.pack(offset + 1))
+        self._file.flush()
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __len__(self) -> int:
+        """Number of slots, i.e. the highest indexed input line number plus one."""
+        return os.path.getsize(self.filepath) // SLOT.size if self.exists() else 0
+
+    def offset(self, line_number: int) -> int | None:
+        """Byte offset of the result of input line `line_number`, None if there is none."""
+        if not self.exists():
+            return None
+        with open(self.filepath, "rb") as file:
+            file.seek(line_number * SLOT.size)
+            data = file.read(SLOT.size)
+        if len(data) < SLOT.size:
+            return None
+        (value,) = SLOT.unpack(data)
+        # offsets past the end were dropped as a partial line by `CompletionJournal.repair_output`
+        if value == 0 or value - 1 >= os.path.getsize(self.output_filepath):
+            return None
+        return value - 1
+
+    def read(self, line_number: int):
+        """Parsed output line of input line `line_number`, None if there is none."""
+        offset = self.offset(line_number)
+        if offset is None:
+            return None
+        with open(self.output_filepath, "rb") as file:
+            file.seek(offset)
+            return json.loads(file.readline())
+
+    def iter_offsets(self):
+        """Yield (line_number, offset) of every indexed result, in input order."""
+        if not self.exists():
+            return
+        size = os.path.getsize(self.output_filepath)
+        with open(self.filepath, "rb") as file:
+            line_number = 0
+            while True:
+                data = file.read(SLOT.size * 1024)
+                if not data:
+                    break
+                for (value,) in SLOT.iter_unpack(data[: len(data) - len(data) % SLOT.size]):
+                    if value and value - 1 < size:
+                        yield line_number, value - 1
+                    line_number += 1
+
+
+def sort_output_by_input(output_filepath: str) -> int:
+    """Rewrite `output_filepath` in input order using its index. Returns the number of lines.
+
+    Memory use does not depend on the file size: lines are copied one by one, and the new
+    index is written alongside. Lines the index does not cover, e.g. written just before a
+    crash, are kept: they are appended after the sorted lines (see `_append_unindexed`).
+    """
+    if jsonl_compression(output_filepath):
+        logger.warning(f"{output_filepath} is compressed and not indexed, cannot sort it")
+        return 0
+    index = OffsetIndex(output_filepath)
+    if not index.exists():
+        logger.warning(f"No offset index for {output_filepath}, cannot sort it")
+        return 0
+    tmp_filepath = output_filepath + ".sorting"
+    tmp_index_filepath = OffsetIndex.index_path(tmp_filepath)
+    num_lines = 0
+    with (
+        open(output_filepath, "rb") as source,
+        open(tmp_filepath, "wb") as target,
+        open(tmp_index_filepath, "wb") as target_index,
+    ):
+        next_slot = 0
+        for line_number, offset in index.iter_offsets():
+            source.seek(offset)
+            line = source.readline()
+            # slots come in increasing order, so the new index is written sequentially
+            target_index.write(b"\0" * SLOT.size * (line_number - next_slot))
+            target_index.write(SLOT.pack(target.tell() + 1))
+            next_slot = line_number + 1
+            target.write(line)
+            num_lines += 1
+        source.seek(0)
+        num_source_lines = sum(1 for _ in source)
+        if num_source_lines != num_lines:
+            num_lines += _append_unindexed(index, source, target, target_index)
+    os.replace(tmp_filepath, output_filepath)
+    os.replace(tmp_index_filepath, index.filepath)
+    logger.info(f"Sorted {num_lines} results of {output_filepath} by input line")
+    return num_lines
+
+
+def _append_unindexed(index: OffsetIndex, source, target, target_index) -> int:
+    """Append the lines of `source` that `index` does not point at. Returns how many.
+
+    A line whose input line has an indexed result elsewhere was superseded and is dropped.
+    Of the others, the latest line of every input line is appended and indexed, and lines
+    without a line number are appended as they are.
+    """
+    indexed = dict(index.iter_offsets())
+    indexed_offsets = set(indexed.values())
+    unindexed = {}  # input line number, or the offset if unknown -> offset of its latest line
+    source.seek(0)
+    offset = 0
+    for line in source:
+        if offset not in indexed_offsets:
+            try:
+                line_number = json.loads(line)[-1]["line_number"]
+            except (ValueError, LookupError, TypeError):
+                line_number = None
+            if not isinstance(line_number, int):
+                unindexed[("offset", offset)] = offset
+            elif line_number not in indexed:
+                unindexed[line_number] = offset
+        offset += len(line)
+    for key, offset in sorted(unindexed.items(), key=lambda item: item[1]):
+        source.seek(offset)
+        line = source.readline()
+        if not line.endswith(b"\n"):
+            line += b"\n"
+        if isinstance(key, int):
+            target_index.seek(key * SLOT.size)
+            target_index.write(SLOT.pack(target.tell() + 1))
+        target.write(line)
+    if unindexed:
+        logger.warning(f"Appended {len(unindexed)} results missing from the index of {index.output_filepath}")
+    return len(unindexed)
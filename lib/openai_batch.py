@@ -0,0 +1,410 @@
+"""
+OPENAI BATCH RUNNER
+
+Runs a request file through the OpenAI Batch API instead of live chat completions, for
+offline evaluations that do not need interactive latency and should not be bound by the
+per-minute rate limits.
+
+Steps:
+- Stream the request file and write a batch input file (`<output file>.batch_input.jsonl`),
+  skipping requests the completion journal lists as done and answering cached ones directly
+- Upload it (`POST /v1/files`, purpose "batch") and create the batch (`POST /v1/batches`),
+  splitting into several batches above `max_requests_per_batch` requests or
+  `max_bytes_per_batch` bytes (the API takes input files of up to 200 MB)
+- Poll `GET /v1/batches/{id}` with exponential backoff until every batch has finished
+- Download the output and error files and write `[request, response, metadata]` lines in input
+  order through the same writer and journal as the live engine, so `ResponseParser` reads the
+  results unchanged. Requests without a successful response get an error line and are sent
+  again by the next run. With a `result_parser`, the result rows are written along the way.
+
+The submitted batch ids are kept in `<output file>.batch.json` until the results are written,
+so an interrupted run resumes polling instead of submitting (and paying for) the requests twice.
+The file is updated as soon as each batch has been created, so a run interrupted in the middle
+of a multi-batch submission only submits the chunks that have no batch yet.
+
+Every API call is retried on rate limit, server, timeout and connection errors with the
+`RetryPolicy` backoff (lib/api_errors.py), up to `max_attempts` times, so a single failed poll
+does not end a batch job that runs for hours. Creating a batch is only retried after an error
+response: after a timeout the batch may exist already, and the run fails instead of paying
+twice.
+
+All URLs are derived from `request_url`, so a local stand-in server (lib/mock_llm_server.py) can
+be used:
+```
+runner = OpenAIBatchRunner(adapter=OpenAIAdapter(api_key, request_url="http://127.0.0.1:8765/v1/chat/completions"))
+await runner.run(requests_filepath, save_filepath, additional_params={"model": "gpt-4o", "temperature": 0})
+```
+"""
+
+import asyncio
+import json
+import logging
+import os
+import re
+from dataclasses import dataclass
+
+import aiohttp
+
+from lib.adapters import OpenAIAdapter
+from lib.api_errors import ErrorKind, RetryPolicy, classify_exception, parse_retry_after
+from lib.http_transport import create_session
+from lib.io import open_jsonl
+from lib.journal import CompletionJournal, request_key
+from lib.offset_index import OffsetIndex
+from lib.response_cache import ResponseCache
+from lib.result_rows import InlineResultParser
+from lib.result_writer import JsonlResultWriter
+
+logger = logging.getLogger(__name__)
+
+FINAL_BATCH_STATUSES = ("completed", "failed", "expired", "cancelled")
+# below the 200 MB limit of batch input files, leaving room for the multipart encoding
+DEFAULT_MAX_BYTES_PER_BATCH = 190_000_000
+
+
+class BatchAPIError(Exception):
+    """Failed call to the files or batches API."""
+
+    def __init__(self, message: str, error_kind: ErrorKind, retry_after: float | None = None) -> None:
+        super().__init__(message)
+        self.error_kind = error_kind
+        self.retry_after = retry_after
+
+
+@dataclass
+class BatchStatus:
+    """Counts of one batch run, named like the live engine's StatusTracker."""
+
+    num_tasks_started: int = 0
+    num_tasks_already_completed: int = 0
+    num_tasks_cached: int = 0
+    num_tasks_succeeded: int = 0
+    num_tasks_failed: int = 0
+    num_batches: int = 0
+
+
+class OpenAIBatchRunner:
+    """Submits a request file as OpenAI batches and writes the results like the live engine."""
+
+    def __init__(
+        self,
+        adapter: OpenAIAdapter,
+        cache: ResponseCache | None = None,
+        completion_window: str = "24h",
+        max_requests_per_batch: int = 50_000,
+        max_bytes_per_batch: int = DEFAULT_MAX_BYTES_PER_BATCH,
+        poll_interval: float = 10.0,
+        max_poll_interval: float = 300.0,
+        poll_backoff_factor: float = 1.5,
+        result_parser: InlineResultParser | None = None,
+        max_attempts: int = 8,
+        retry_policy: RetryPolicy | None = None,
+    ) -> None:
+        self.adapter = adapter
+        self.cache = cache
+        self.completion_window = completion_window
+        self.max_requests_per_batch = max_requests_per_batch
+        self.max_bytes_per_batch = max_bytes_per_batch
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.poll_backoff_factor = poll_backoff_factor
+        self.result_parser = result_parser
+        self.max_attempts = max_attempts
+        self.retry_policy = retry_policy or RetryPolicy()
+        match = re.search("^(https?://[^/]+)(/v\\d+)(/.+)$", adapter.request_url)
+        self.api_root = match[1] + match[2]  # e.g. https://api.openai.com/v1
+        self.endpoint = match[2] + match[3]  # e.g. /v1/chat/completions
+        self.status = BatchStatus()
+
+    @staticmethod
+    def custom_id(line_number: int) -> str:
+        return f"request-{line_number}"
+
+    @staticmethod
+    def state_path(save_filepath: str) -> str:
+        return save_filepath + ".batch.json"
+
+    @staticmethod
+    def input_path(save_filepath: str) -> str:
+        return save_filepath + ".batch_input.jsonl"
+
+    async def run(
+        self,
+        requests_filepath: str,
+        save_filepath: str,
+        additional_params: dict | None = None,
+        resume: bool = True,
+        session: aiohttp.ClientSession | None = None,
+    ) -> BatchStatus:
+        additional_params = additional_params or {}
+        journal = CompletionJournal(save_filepath)
+        state_path = self.state_path(save_filepath)
+        if resume:
+            journal.load()
+            journal.repair_output()
+        else:
+            journal.reset()
+            OffsetIndex(save_filepath).reset()
+            if os.path.exists(state_path):
+                os.remove(state_path)
+
+        if self.result_parser is not None:
+            await self.result_parser.start(resume=resume)
+        finished = False
+        try:
+            if session is None:
+                async with create_session() as session:
+                    status = await self._run(requests_filepath, save_filepath, additional_params, journal, session)
+            else:
+                status = await self._run(requests_filepath, save_filepath, additional_params, journal, session)
+            finished = True
+        finally:
+            if self.cache is not None:
+                self.cache.flush()
+            if self.result_parser is not None:
+                await self.result_parser.close(finalize=finished, completed_keys=journal.completed)
+        return status
+
+    async def _run(self, requests_filepath, save_filepath, additional_params, journal, session):
+        state_path = self.state_path(save_filepath)
+        async with JsonlResultWriter(save_filepath, journal=journal, index=OffsetIndex(save_filepath)) as result_writer:
+            if os.path.exists(state_path):
+                with open(state_path) as file:
+                    state = json.load(file)
+                logger.info(f"Resuming {len(state['batch_ids'])} submitted batches for {save_filepath}")
+            else:
+                self._write_batch_input(requests_filepath, save_filepath, additional_params, journal, result_writer)
+                state = {
+                    "batch_ids": [],
+                    "requests_filepath": requests_filepath,
+                    "max_requests_per_batch": self.max_requests_per_batch,
+                    "max_bytes_per_batch": self.max_bytes_per_batch,
+                    "submitted": False,
+                }
+                self._save_state(state_path, state)
+            if not state.get("submitted", True):  # state files without the flag were saved after submitting
+                await self._submit(session, save_filepath, state)
+            batch_ids = state["batch_ids"]
+            self.status.num_batches = len(batch_ids)
+
+            batches = await asyncio.gather(*[self._wait_for_batch(session, batch_id) for batch_id in batch_ids])
+            results = {}
+            for batch in batches:
+                for file_id in [batch.get("output_file_id"), batch.get("error_file_id")]:
+                    if file_id:
+                        results.update(await self._download_results(session, file_id))
+            self._write_results(requests_filepath, save_filepath, additional_params, journal, result_writer, results)
+
+        for fn in [state_path, self.input_path(save_filepath)]:
+            if os.path.exists(fn):
+                os.remove(fn)
+        logger.info(f"Batch processing complete. Results saved to {save_filepath}: {self.status}")
+        return self.status
+
+    def _iter_requests(self, requests_filepath, additional_params):
+        """Yield (line number, journal key, request_json, metadata) for every request of the file."""
+        with open_jsonl(requests_filepath) as file:
+            for line_number, line in enumerate(file):
+                if not line.strip():
+                    continue
+                key = request_key(line_number, line)
+                request_json = self.adapter.prepare_request(json.loads(line), dict(additional_params))
+                metadata = request_json.pop("metadata", None)
+                yield line_number, key, request_json, metadata
+
+    def _cache_key(self, request_json):
+        if self.cache is None or not self.adapter.is_deterministic(request_json):
+            return None
+        return self.cache.key(self.adapter.format, self.adapter.request_url, request_json)
+
+    def _write_batch_input(self, requests_filepath, save_filepath, additional_params, journal, result_writer) -> int:
+        """Write the batch input file, answering cached requests directly. Returns the number of batch requests."""
+        num_pending = 0
+        with open(self.input_path(save_filepath), "w") as file:
+            for line_number, key, request_json, metadata in self._iter_requests(requests_filepath, additional_params):
+                if journal.is_completed(key):
+                    self.status.num_tasks_already_completed += 1
+                    continue
+                cache_key = self._cache_key(request_json)
+                response = self.cache.get(cache_key) if cache_key else None
+                if response is not None:
+                    self._write_line(result_writer, line_number, key, request_json, response, metadata, succeeded=True)
+                    self.status.num_tasks_cached += 1
+                    continue
+                body = {"custom_id": self.custom_id(line_number), "method": "POST", "url": self.endpoint, "body": request_json}
+                file.write(json.dumps(body) + "\n")
+                num_pending += 1
+        return num_pending
+
+    @staticmethod
+    def _save_state(state_path: str, state: dict) -> None:
+        tmp_path = state_path + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(state, file)
+        os.replace(tmp_path, state_path)
+
+    async def _submit(self, session, save_filepath, state: dict) -> None:
+        """Upload the batch input in chunks of `max_requests_per_batch` requests and `max_bytes_per_batch`
+        bytes at most and create one batch per chunk.
+
+        Every batch id is saved to the state file as soon as the batch exists; chunks that got a
+        batch in an interrupted run are skipped.
+        """
+        state_path = self.state_path(save_filepath)
+        batch_ids = state["batch_ids"]
+        if batch_ids:
+            logger.info(f"Resuming the submission of {save_filepath} after {len(batch_ids)} batches")
+        with open(self.input_path(save_filepath)) as file:
+            # the chunk sizes of the state, so a resumed submission splits the file the same way
+            chunks = self._iter_chunks(file, state["max_requests_per_batch"], state.get("max_bytes_per_batch"))
+            for i, chunk in enumerate(chunks):
+                if i < len(batch_ids):
+                    continue
+                batch_ids.append(await self._create_batch(session, "".join(chunk)))
+                self._save_state(state_path, state)
+        state["submitted"] = True
+        self._save_state(state_path, state)
+
+    @staticmethod
+    def _iter_chunks(file, max_lines: int, max_bytes: int | None = None):
+        """Lists of lines with at most `max_lines` lines and `max_bytes` bytes, unless a single line is larger."""
+        chunk = []
+        num_bytes = 0
+        for line in file:
+            line_bytes = len(line.encode("utf-8"))
+            if chunk and max_bytes is not None and num_bytes + line_bytes > max_bytes:
+                yield chunk
+                chunk = []
+                num_bytes = 0
+            chunk.append(line)
+            num_bytes += line_bytes
+            if len(chunk) == max_lines:
+                yield chunk
+                chunk = []
+                num_bytes = 0
+        if chunk:
+            yield chunk
+
+    async def _create_batch(self, session, content: str) -> str:
+        form = aiohttp.FormData()
+        form.add_field("purpose", "batch")
+        form.add_field("file", content.encode("utf-8"), filename="batch_input.jsonl", content_type="application/jsonl")
+        uploaded = await self._request(session, "POST", "/files", data=form)
+        batch = await self._request(
+            session,
+            "POST",
+            "/batches",
+            idempotent=False,
+            json={
+                "input_file_id": uploaded["id"],
+                "endpoint": self.endpoint,
+                "completion_window": self.completion_window,
+            },
+        )
+        logger.info(f"Created batch {batch['id']} from file {uploaded['id']}")
+        return batch["id"]
+
+    async def _wait_for_batch(self, session, batch_id: str) -> dict:
+        """Poll the batch with exponential backoff until it reaches a final status."""
+        interval = self.poll_interval
+        while True:
+            batch = await self._request(session, "GET", f"/batches/{batch_id}")
+            status = batch["status"]
+            counts = batch.get("request_counts") or {}
+            logger.info(
+                f"Batch {batch_id} is {status}: {counts.get('completed', 0)} / {counts.get('total', 0)} completed"
+            )
+            if status in FINAL_BATCH_STATUSES:
+                if status != "completed":
+                    logger.warning(f"Batch {batch_id} ended as {status}: {batch.get('errors')}")
+                return batch
+            await asyncio.sleep(interval)
+            interval = min(interval * self.poll_backoff_factor, self.max_poll_interval)
+
+    async def _download_results(self, session, file_id: str) -> dict:
+        """Map custom_id -> result line of a batch output or error file."""
+        content = await self._request(session, "GET", f"/files/{file_id}/content", raw=True)
+        results = {}
+        for line in content.splitlines():
+            if line.strip():
+                result = json.loads(line)
+                results[result["custom_id"]] = result
+        return results
+
+    def _write_results(self, requests_filepath, save_filepath, additional_params, journal, result_writer, results) -> None:
+        """Write one line per submitted request, in input order."""
+        input_path = self.input_path(save_filepath)
+        if os.path.exists(input_path):
+            with open(input_path) as file:
+                submitted = {json.loads(line)["custom_id"] for line in file if line.strip()}
+        else:
+            submitted = set(results)
+        for line_number, key, request_json, metadata in self._iter_requests(requests_filepath, additional_params):
+            custom_id = self.custom_id(line_number)
+            if custom_id not in submitted or journal.is_completed(key):
+                continue  # completed before, or answered from the cache
+            result = results.get(custom_id) or {}
+            response = result.get("response") or {}
+            if response.get("status_code") == 200:
+                body = response["body"]
+                self._write_line(result_writer, line_number, key, request_json, body, metadata, succeeded=True)
+                cache_key = self._cache_key(request_json)
+                if cache_key:
+                    self.cache.put(cache_key, body)
+            else:
+                error = result.get("error") or response.get("body") or "Missing from batch output"
+                self._write_line(result_writer, line_number, key, request_json, [str(error)], metadata, succeeded=False)
+
+    def _write_line(self, result_writer, line_number, key, request_json, result, metadata, succeeded: bool) -> None:
+        data = [request_json, result, {**(metadata or {}), "line_number": line_number}]
+        result_writer.write(data, journal_key=key if succeeded else None, line_number=line_number)
+        if succeeded and self.result_parser is not None:
+            self.result_parser.add(key, data)
+        self.status.num_tasks_started += 1
+        if succeeded:
+            self.status.num_tasks_succeeded += 1
+        else:
+            self.status.num_tasks_failed += 1
+
+    async def _request(self, session, method: str, path: str, raw: bool = False, idempotent: bool = True, **kwargs):
+        """Call the files or batches API, retrying retryable errors with backoff.
+
+        A call that is not `idempotent` is only retried after the API answered with an error.
+        """
+        num_failures = 0
+        while True:
+            try:
+                return await self._request_once(session, method, path, raw, **kwargs)
+            except Exception as e:
+                if isinstance(e, BatchAPIError):
+                    error_kind, retry_after, answered = e.error_kind, e.retry_after, True
+                else:
+                    error_kind, retry_after, answered = classify_exception(e), None, False
+                num_failures += 1
+                retryable = error_kind.is_retryable and (idempotent or answered)
+                if not retryable or num_failures >= self.max_attempts:
+                    raise
+                delay = self.retry_policy.delay(error_kind, num_failures, retry_after)
+                logger.warning(f"{method} {path} failed ({error_kind.value}: {e!r}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    async def _request_once(self, session, method: str, path: str, raw: bool, **kwargs):
+        async with session.request(
+            method,
+            self.api_root + path,
+            headers=self.adapter.request_headers(),
+            **kwargs,
+        ) as response:
+            text = await response.text()
+            try:
+                data = json.loads(text) if not raw else None
+            except ValueError:
+                data = None  # e.g. the html error page of a proxy
+            error = data.get("error") if isinstance(data, dict) else None
+            if response.status >= 400 or error or (not raw and not isinstance(data, dict)):
+                raise BatchAPIError(
+                    f"{method} {path} failed with status {response.status}: {data if data is not None else text[:200]}",
+                    self.adapter.classify_error(response.status, error if isinstance(error, dict) else {}),
+                    parse_retry_after(response.headers),
+                )
+            return text if raw else data
@@ -0,0 +1,203 @@
+"""
+INFERENCE PLANNER
+
+Dry run of an inference sweep: estimates tokens, wall-clock time and cost of every active
+`DataPath` without sending a single request.
+
+For each request file the planner streams the requests, skips those the completion journal
+already lists as done, and counts prompt tokens with the adapter's memoized token counter
+(the rubric lines shared by all essays are encoded only once). Completion tokens are
+estimated with the adapter's `TokenEstimator`, calibrated from the usage in the existing
+output file if a previous run left one.
+
+The projected wall time is the slowest of the request budget, the token budget and, with a
+concurrency cap, `max_in_flight` calls of `latency_seconds` each. The buckets start full, so
+the first minute of budget is not waited for. The cost uses `MODEL_PRICES` or the
+`model_prices` config entry (USD per million tokens), halved for the OpenAI Batch API.
+
+Usage:
+```
+plans = InferencePlanner(config).run()
+```
+"""
+
+import json
+import logging
+import os
+
+import pandas as pd
+
+from lib.adapters import get_adapter_class
+from lib.journal import CompletionJournal, request_key
+from lib.io import iter_jsonl_lines, open_jsonl, write_data
+
+logger = logging.getLogger(__name__)
+
+# USD per million (input, output) tokens, by model name prefix, most specific first
+MODEL_PRICES = [
+    ("ft:gpt-4o-mini", (0.30, 1.20)),
+    ("ft:gpt-4o", (3.75, 15.00)),
+    ("ft:gpt-3.5-turbo", (3.00, 6.00)),
+    ("gpt-4o-mini", (0.15, 0.60)),
+    ("gpt-4o-2024-05-13", (5.00, 15.00)),
+    ("gpt-4o", (2.50, 10.00)),
+    ("gpt-4-1106-preview", (10.00, 30.00)),
+    ("gpt-4-turbo", (10.00, 30.00)),
+    ("gpt-4", (30.00, 60.00)),
+    ("gpt-3.5-turbo-1106", (1.00, 2.00)),
+    ("gpt-3.5-turbo", (0.50, 1.50)),
+    ("gemini-pro", (0.50, 1.50)),
+    ("gemini-1.5-flash", (0.075, 0.30)),
+    ("gemini-1.5-pro", (1.25, 5.00)),
+]
+BATCH_API_DISCOUNT = 0.5
+DEFAULT_LATENCY_SECONDS = 10.0
+MAX_CALIBRATION_LINES = 1000
+
+
+def price_for_model(model: str | None, prices: dict | None = None) -> tuple[float, float] | None:
+    """(input, output) USD per million tokens; `prices` from the config win over `MODEL_PRICES`."""
+    if not model:
+        return None
+    if prices and model in prices:
+        price = prices[model]
+        return price["input"], price["output"]
+    for prefix, price in MODEL_PRICES:
+        if model.startswith(prefix):
+            return price
+    return None
+
+
+def calibrate_from_output(adapter, save_filepath: str, max_lines: int = MAX_CALIBRATION_LINES) -> int:
+    """Feed the usage of up to `max_lines` saved responses to the adapter's token estimator."""
+    num_lines = 0
+    if not os.path.exists(save_filepath):
+        return num_lines
+    for line in iter_jsonl_lines(save_filepath):
+        request_json, response = json.loads(line)[:2]
+        if not isinstance(response, dict):
+            continue
+        prompt_tokens, completion_tokens = adapter.usage(response)
+        if prompt_tokens or completion_tokens:
+            adapter.observe_usage(request_json, prompt_tokens, completion_tokens)
+            num_lines += 1
+            if num_lines >= max_lines:
+                break
+    return num_lines
+
+
+def plan_request_file(
+    requests_filepath: str,
+    adapter,
+    additional_params: dict | None = None,
+    save_filepath: str | None = None,
+    max_requests_per_minute: float | None = None,
+    max_tokens_per_minute: float | None = None,
+    max_in_flight: int | None = None,
+    latency_seconds: float = DEFAULT_LATENCY_SECONDS,
+    price: tuple[float, float] | None = None,
+    use_batch_api: bool = False,
+) -> dict:
+    """Projected tokens, wall time and cost of the requests of one file that still have to run."""
+    max_requests_per_minute = max_requests_per_minute or adapter.default_max_requests_per_minute
+    max_tokens_per_minute = max_tokens_per_minute or adapter.default_max_tokens_per_minute
+    max_in_flight = max_in_flight or adapter.default_max_in_flight
+    journal = CompletionJournal(save_filepath).load() if save_filepath else None
+    num_calibration_responses = calibrate_from_output(adapter, save_filepath) if save_filepath else 0
+
+    num_requests = num_completed = prompt_tokens = completion_tokens = 0
+    with open_jsonl(requests_filepath) as file:
+        for line_number, line in enumerate(file):
+            if not line.strip():
+                continue
+            if journal is not None and journal.is_completed(request_key(line_number, line)):
+                num_completed += 1
+                continue
+            request_json = json.loads(line)
+            request_json.pop("metadata", None)
+            request_json.update(additional_params or {})
+            num_requests += 1
+            prompt_tokens += adapter.token_estimator.prompt_tokens(adapter.num_prompt_tokens(request_json))
+            completion_tokens += adapter.num_completion_tokens(request_json)
+
+    total_tokens = prompt_tokens + completion_tokens
+    # seconds each budget needs beyond the full bucket it starts with
+    seconds = {"requests": max(0.0, num_requests - max_requests_per_minute) * 60.0 / max_requests_per_minute}
+    if max_tokens_per_minute:
+        seconds["tokens"] = max(0.0, total_tokens - max_tokens_per_minute) * 60.0 / max_tokens_per_minute
+    if max_in_flight:
+        seconds["in_flight"] = num_requests * latency_seconds / max_in_flight
+    bound_by = max(seconds, key=seconds.get)
+    wall_seconds = seconds[bound_by] + (latency_seconds if num_requests else 0.0)
+    if use_batch_api:
+        bound_by = "batch"
+        wall_seconds = None  # up to the completion window, not bound by the per-minute limits
+
+    cost = None
+    if price is not None:
+        cost = (prompt_tokens * price[0] + completion_tokens * price[1]) / 1_000_000
+        if use_batch_api:
+            cost *= BATCH_API_DISCOUNT
+    return {
+        "requests": num_requests,
+        "already_completed": num_completed,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": total_tokens,
+        "completion_tokens_per_request": adapter.token_estimator.completion_tokens(),
+        "calibration_responses": num_calibration_responses,
+        "max_requests_per_minute": max_requests_per_minute,
+        "max_tokens_per_minute": max_tokens_per_minute,
+        "max_in_flight": max_in_flight,
+        "bound_by": bound_by,
+        "wall_minutes": round(wall_seconds / 60.0, 2) if wall_seconds is not None else None,
+        "cost_usd": round(cost, 4) if cost is not None else None,
+    }
+
+
+class InferencePlanner:
+    """Plans the inference runs of every active `DataPath` of a config."""
+
+    def __init__(self, config, latency_seconds: float = DEFAULT_LATENCY_SECONDS) -> None:
+        self.config = config
+        self.latency_seconds = latency_seconds
+
+    def run(self, save=True) -> list[dict]:
+        plans = []
+        for data_path in self.config.data_paths:
+            if not data_path.active:
+                continue
+            if not os.path.exists(data_path.dataset_in):
+                logger.warning(f"Request file {data_path.dataset_in} does not exist, prepare the datasets first.")
+                continue
+            plans.append(self.plan(data_path))
+        if plans and save:
+            write_data(pd.DataFrame(plans), self.plan_filename)
+            logger.info(f"Inference plan saved to file: {self.plan_filename}")
+        return plans
+
+    @property
+    def plan_filename(self):
+        return os.path.join(self.config.output_root, 'plan', 'inference-plan.csv')
+
+    def plan(self, data_path) -> dict:
+        model = data_path.llm_model_id
+        if data_path.is_finetuned:
+            # the fine-tuned model id is only known once the job has succeeded, price it as its base model
+            model = model or f"ft:{self.config.fine_tuning_base_model_id}"
+        adapter_class = get_adapter_class(data_path.format)
+        adapter = adapter_class(api_key=None, model=model)
+        use_batch_api = data_path.format == 'openai' and self.config.get("use_openai_batch_api", False)
+        plan = plan_request_file(
+            data_path.dataset_in,
+            adapter,
+            additional_params=adapter.additional_params(temperature=self.config.temperature),
+            save_filepath=data_path.dataset_out,
+            max_requests_per_minute=data_path.max_requests_per_minute,
+            max_tokens_per_minute=data_path.max_tokens_per_minute,
+            max_in_flight=data_path.max_in_flight,
+            latency_seconds=self.latency_seconds,
+            price=price_for_model(model, self.config.get("model_prices")),
+            use_batch_api=use_batch_api,
+        )
+        return {"model": data_path.llm_model_label or model, "requests_file": data_path.dataset_in, **plan}
@@ -0,0 +1,181 @@
+"""
+RESPONSE CACHE
+
+Persistent, content-addressed cache of successful API responses, shared by all runs.
+
+The key is a hash of the provider format, the request URL (which names the model for Gemini)
+and the request body as it is sent (model, messages/contents, temperature and every other
+parameter), so identical requests from different configs or reruns hit the same entry. Only
+deterministic requests (temperature 0) are cached: sampling at a higher temperature is
+expected to give a new answer every time.
+
+Entries live in one SQLite table. `evict` drops entries older than `max_age_days` and then the
+least recently used ones until the stored responses fit in `max_size_mb`; it runs when the cache
+is opened, every `evict_every` stores and on `close`.
+
+Writes are buffered, so a run does not pay for one SQLite transaction per response on the event
+loop: new responses (and the last use of hits) are kept in memory, where `get` finds them, and
+written in one transaction once `flush_every` of them are pending, on `flush` and on `close`.
+A crash loses at most the pending entries, which only means those requests are sent again.
+
+Usage:
+```
+cache = get_response_cache("./data/cache/responses.sqlite", max_size_mb=1024, max_age_days=90)
+key = cache.key("openai", request_url, request_json)
+response = cache.get(key)  # None on a miss
+cache.put(key, response)
+cache.flush()  # at the end of a run
+```
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FLUSH_EVERY = 100
+DEFAULT_EVICT_EVERY = 5000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    response TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_used_at REAL NOT NULL
+)
+"""
+
+
+class ResponseCache:
+    """SQLite backed map from request hash to response json."""
+
+    def __init__(
+        self,
+        filepath: str,
+        max_size_mb: float | None = None,
+        max_age_days: float | None = None,
+        flush_every: int = DEFAULT_FLUSH_EVERY,
+        evict_every: int = DEFAULT_EVICT_EVERY,
+    ) -> None:
+        self.filepath = filepath
+        self.max_size_mb = max_size_mb
+        self.max_age_days = max_age_days
+        self.flush_every = flush_every
+        self.evict_every = evict_every
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        path = os.path.dirname(filepath)
+        if path:
+            os.makedirs(path, exist_ok=True)
+        self._pending = {}  # key -> (response json, created_at), not written yet
+        self._pending_uses = {}  # key -> last_used_at of stored entries hit since the last flush
+        self._stores_since_evict = 0
+        # autocommit outside the explicit transactions of `flush`
+        self._connection = sqlite3.connect(filepath, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(_SCHEMA)
+        self.evict()
+
+    @staticmethod
+    def key(format: str, request_url: str, request_json: dict) -> str:
+        content = json.dumps([format, request_url, request_json], sort_keys=True, ensure_ascii=False)
+        return hashlib.blake2b(content.encode("utf-8"), digest_size=20).hexdigest()
+
+    def get(self, key: str) -> dict | None:
+        if key in self._pending:
+            self.hits += 1
+            return json.loads(self._pending[key][0])
+        row = self._connection.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._pending_uses[key] = time.time()
+        return json.loads(row[0])
+
+    def put(self, key: str, response: dict) -> None:
+        self._pending[key] = (json.dumps(response), time.time())
+        self.stores += 1
+        self._stores_since_evict += 1
+        if len(self._pending) + len(self._pending_uses) >= self.flush_every:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write the pending entries and uses in one transaction, evicting every `evict_every` stores."""
+        if self._pending or self._pending_uses:
+            with self._connection:
+                self._connection.execute("BEGIN")
+                self._connection.executemany(
+                    "INSERT OR REPLACE INTO responses (key, response, size, created_at, last_used_at) VALUES (?, ?, ?, ?, ?)",
+                    [(key, data, len(data), now, now) for key, (data, now) in self._pending.items()],
+                )
+                self._connection.executemany(
+                    "UPDATE responses SET last_used_at = ? WHERE key = ?",
+                    [(now, key) for key, now in self._pending_uses.items()],
+                )
+            self._pending = {}
+            self._pending_uses = {}
+        if self._stores_since_evict >= self.evict_every:
+            self.evict()
+
+    def evict(self) -> int:
+        """Drop expired entries, then least recently used ones over the size limit."""
+        num_evicted = 0
+        if self.max_age_days is not None:
+            expires_before = time.time() - self.max_age_days * 24 * 3600
+            cursor = self._connection.execute("DELETE FROM responses WHERE created_at < ?", (expires_before,))
+            num_evicted += cursor.rowcount
+        if self.max_size_mb is not None:
+            max_size = self.max_size_mb * 1024 * 1024
+            total_size = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total_size > max_size:
+                keys = []
+                for key, size in self._connection.execute("SELECT key, size FROM responses ORDER BY last_used_at"):
+                    if total_size <= max_size:
+                        break
+                    keys.append((key,))
+                    total_size -= size
+                self._connection.executemany("DELETE FROM responses WHERE key = ?", keys)
+                num_evicted += len(keys)
+        self._stores_since_evict = 0
+        if num_evicted:
+            logger.info(f"Evicted {num_evicted} entries from response cache {self.filepath}")
+        self.evictions += num_evicted
+        return num_evicted
+
+    def num_entries(self) -> int:
+        return self._connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hit_rate, 4),
+            "stores": self.stores,
+            "evictions": self.evictions,
+        }
+
+    def close(self) -> None:
+        self.flush()
+        self.evict()
+        self._connection.close()
+
+
+@lru_cache(maxsize=None)
+def get_response_cache(filepath: str, max_size_mb: float | None = None, max_age_days: float | None = None) -> ResponseCache:
+    """Process-wide cache instance per file, so concurrent jobs share one connection."""
+    return ResponseCache(filepath, max_size_mb=max_size_mb, max_age_days=max_age_days)
@@ -0,0 +1,109 @@
+"""
+INLINE RESULT PARSER
+
+Parses responses into result rows while inference is running, instead of re-reading the
+whole output file with `ResponseParser.parse_response` afterwards.
+
+Every successful response is parsed with `ResponseParser.parse_line` (score, reasoning and
+agreement with the ground truth) as soon as it is saved, and the row is appended to
+`<result file>.rows.jsonl` through its own `JsonlResultWriter`. When the run ends, the rows are
+written to the result file (csv or xlsx), so `ResponseParser.run` finds it and skips the
+second pass. If a response cannot be parsed inline, or the rows do not cover every request
+the completion journal lists as done (e.g. part of the output was written by a run without
+inline parsing), the result file is not written and `ResponseParser` parses the output file
+as before.
+
+Rows are stored with the journal key of their request. A request may be answered again after
+an interrupted run whose output was not journaled yet; only its last row is kept.
+
+Usage:
+```
+result_parser = InlineResultParser(data_path.result_file, format="openai", integer_score_only=False)
+engine = InferenceEngine(adapter=adapter, scheduler=scheduler, result_parser=result_parser)
+```
+"""
+
+import asyncio
+import json
+import logging
+import os
+
+import pandas as pd
+
+from lib.data_processing import ResponseParser
+from lib.io import write_data
+from lib.result_writer import JsonlResultWriter
+
+logger = logging.getLogger(__name__)
+
+
+class InlineResultParser:
+    """Turns saved responses into result rows and writes the result file at the end of a run."""
+
+    def __init__(self, result_file: str, format: str = "openai", integer_score_only: bool = False) -> None:
+        self.result_file = result_file
+        self.format = format
+        self.integer_score_only = integer_score_only
+        self.rows_filepath = self.rows_path(result_file)
+        self.num_rows = 0
+        self.num_errors = 0
+        self._writer = None
+
+    @staticmethod
+    def rows_path(result_file: str) -> str:
+        return result_file + ".rows.jsonl"
+
+    async def start(self, resume: bool = True) -> None:
+        """Open the row file; without `resume` the rows of previous runs are dropped."""
+        if not resume and os.path.exists(self.rows_filepath):
+            os.remove(self.rows_filepath)
+        self._writer = JsonlResultWriter(self.rows_filepath)
+        await self._writer.start()
+
+    def add(self, request_key: str, data: list) -> None:
+        """Parse one `[request, response, metadata]` line and queue its row."""
+        try:
+            row = ResponseParser.parse_line(data, self.integer_score_only, self.format)
+        except Exception as e:
+            # the output line is saved either way, `ResponseParser` can parse it again later
+            logger.warning(f"Cannot parse response inline for {self.result_file}: {e!r}")
+            self.num_errors += 1
+            self._writer.write([request_key, None])  # remembered across resumed runs
+            return
+        if row is not None:
+            self._writer.write([request_key, row])
+            self.num_rows += 1
+
+    async def close(self, finalize: bool = True, completed_keys: set[str] | None = None) -> None:
+        """Write the queued rows and, with `finalize`, the result file."""
+        if self._writer is None:
+            return
+        await self._writer.close()
+        self._writer = None
+        if finalize:
+            # re-reads the rows and writes csv/xlsx, off the event loop so other jobs keep dispatching
+            await asyncio.to_thread(self.finalize, completed_keys)
+
+    def finalize(self, completed_keys: set[str] | None = None) -> None:
+        """Write the result file if the rows cover all of `completed_keys`, the journaled requests."""
+        rows = {}
+        with open(self.rows_filepath) as file:
+            for line in file:
+                request_key, row = json.loads(line)
+                rows.pop(request_key, None)  # keep the last answer, in the order it arrived
+                rows[request_key] = row
+        num_errors = sum(1 for row in rows.values() if row is None)
+        if num_errors:
+            logger.warning(f"Not writing {self.result_file}, {num_errors} responses could not be parsed inline")
+            return
+        num_missing = len(set(completed_keys or ()) - set(rows))
+        if num_missing:
+            logger.warning(
+                f"Not writing {self.result_file}, {num_missing} completed requests have no inline parsed row"
+            )
+            return
+        if not rows:
+            logger.warning(f"Not writing {self.result_file}, no response was parsed inline")
+            return
+        write_data(pd.DataFrame(list(rows.values())), self.result_file)
+        logger.info(f"Parsed result saved to file: {self.result_file} ({len(rows)} rows)")
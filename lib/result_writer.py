@@ -0,0 +1,151 @@
+"""
+RESULT WRITER
+
+Single-writer buffered sink for processor output files.
+
+Request tasks never touch the output file themselves. They serialize their result into a
+complete JSON line and hand it to `JsonlResultWriter.write`, which only enqueues it. One
+writer task owns the open file handle, drains the queue in batches and flushes either when
+`max_batch_size` lines are buffered or `flush_interval` seconds have passed, and once more
+on close. Because a line is only ever written whole by a single task, lines can never be
+interleaved.
+
+If a `CompletionJournal` is given, the journal key passed along with each line is recorded
+right after the batch containing that line has been flushed to the output file. Likewise, if
+an `OffsetIndex` is given, the byte offset of each line passed with an input line number is
+recorded in the index (lib/offset_index.py).
+
+Output files ending with .gz or .zst are compressed as they are written (lib/io.py): every
+run appends a new gzip member or zstd frame, and every flush makes the lines written so far
+decodable. Compressed files have no byte offsets to seek to, so they are not indexed.
+
+Usage:
+```
+async with JsonlResultWriter(save_filepath) as result_writer:
+    result_writer.write([request_json, response, metadata])
+```
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+from lib.io import jsonl_compression, open_jsonl
+from lib.journal import CompletionJournal
+from lib.offset_index import OffsetIndex
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BATCH_SIZE = 100
+DEFAULT_FLUSH_INTERVAL = 1.0  # seconds
+
+_CLOSE = object()  # sentinel telling the writer task to drain and stop
+
+
+class JsonlResultWriter:
+    """Appends json payloads to a jsonl file from a dedicated writer task."""
+
+    def __init__(
+        self,
+        filepath: str,
+        max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+        journal: CompletionJournal | None = None,
+        index: OffsetIndex | None = None,
+    ) -> None:
+        self.filepath = filepath
+        self.journal = journal
+        if index is not None and jsonl_compression(filepath):
+            logger.debug(f"Not indexing compressed output file {filepath}")
+            index = None
+        self.index = index
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval
+        self.num_lines_written = 0
+        self._queue = None
+        self._task = None
+        self._file = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def start(self) -> None:
+        path = os.path.dirname(self.filepath)
+        if path:
+            os.makedirs(path, exist_ok=True)
+        self._file = open_jsonl(self.filepath, "ab")  # binary, so offsets are byte positions
+        if self.journal is not None:
+            self.journal.open()
+        if self.index is not None:
+            self.index.open()
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    def write(self, data, journal_key: str | None = None, line_number: int | None = None) -> None:
+        """Queue a json payload to be appended as one line, journaling `journal_key` and indexing
+        the line under input `line_number` once written."""
+        self._queue.put_nowait(((json.dumps(data) + "\n").encode("utf-8"), journal_key, line_number))
+
+    async def close(self) -> None:
+        """Write everything still queued, flush and close the file."""
+        if self._task is None:
+            return
+        self._queue.put_nowait(_CLOSE)
+        await self._task
+        self._task = None
+        self._file.close()
+        if self.journal is not None:
+            self.journal.close()
+        if self.index is not None:
+            self.index.close()
+        logger.debug(f"Result writer closed after {self.num_lines_written} lines: {self.filepath}")
+
+    async def _run(self) -> None:
+        buffer = []
+        last_flush_time = time.monotonic()
+        closing = False
+        while not closing:
+            timeout = max(0.0, last_flush_time + self.flush_interval - time.monotonic())
+            try:
+                item = await asyncio.wait_for(self._queue.get(), timeout if buffer else None)
+            except asyncio.TimeoutError:
+                item = None
+
+            # drain whatever else is already queued without waiting
+            while item is not None:
+                if item is _CLOSE:
+                    closing = True
+                    break
+                buffer.append(item)
+                item = self._queue.get_nowait() if not self._queue.empty() else None
+
+            if buffer and (
+                closing
+                or len(buffer) >= self.max_batch_size
+                or time.monotonic() - last_flush_time >= self.flush_interval
+            ):
+                self._flush(buffer)
+                buffer = []
+                last_flush_time = time.monotonic()
+            elif not buffer:
+                last_flush_time = time.monotonic()
+
+    def _flush(self, items: list[tuple]) -> None:
+        offset = self._file.tell() if self.index is not None else 0
+        self._file.write(b"".join(line for line, _, _ in items))
+        self._file.flush()
+        self.num_lines_written += len(items)
+        if self.journal is not None:
+            self.journal.record([key for _, key, _ in items if key is not None])
+        if self.index is not None:
+            entries = []
+            for line, _, line_number in items:
+                if line_number is not None:
+                    entries.append((line_number, offset))
+                offset += len(line)
+            self.index.record(entries)
@@ -0,0 +1,536 @@
+"""
+RATE LIMIT SCHEDULER
+
+Event-driven token bucket shared by the API request processors.
+
+Instead of polling capacity in a tight loop, the dispatch loop awaits the scheduler,
+which sleeps on an asyncio condition until exactly the moment the request/token
+buckets have refilled enough, a retry becomes due, or a running task notifies it.
+
+Usage (inside a processor):
+```
+scheduler = RateLimitScheduler(max_requests_per_minute=1500, max_tokens_per_minute=125_000)
+await scheduler.acquire(num_tokens)      # blocks until capacity is available, then consumes it
+scheduler.try_acquire(num_tokens)        # consumes capacity only if it is free right now, e.g. for a hedge
+scheduler.schedule_retry(request)        # re-queue a failed request
+request = scheduler.pop_due_retry()      # next retry whose due time has passed, or None
+await scheduler.release()                # an acquired call finished; wakes the dispatch loop
+await scheduler.wait_until(predicate)    # sleep until predicate() holds or a retry is due
+await scheduler.reconcile_tokens(estimated, actual)  # refund or charge the difference once usage is known
+```
+
+Waiters are served first come, first served. Several clients (e.g. one engine per config, all
+calling the same model) can share one scheduler and its budgets through `scheduler.lane()`:
+each lane has its own retry queue, and since a dispatch loop only waits on one `acquire` at a
+time, FIFO order gives every lane a fair round-robin share of the budget.
+
+`AdaptiveRateLimitScheduler` additionally resizes its buckets from the provider's
+`x-ratelimit-*` response headers: it learns the real limits, clamps local capacity to what the
+provider says is remaining, grows additively while there is headroom and backs off
+multiplicatively on rate limit errors. Without those headers (Gemini, proxies) it grows back
+towards the configured budgets with every window of successful calls.
+"""
+
+import asyncio
+import collections
+import heapq
+import itertools
+import logging
+import re
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimitScheduler:
+    """Token bucket for requests and tokens per minute, with a due-time ordered retry queue."""
+
+    def __init__(
+        self,
+        max_requests_per_minute: float,
+        max_tokens_per_minute: float | None = None,
+        seconds_to_pause_after_rate_limit_error: float | None = None,
+        max_in_flight: int | None = None,
+        condition: asyncio.Condition | None = None,
+    ) -> None:
+        self.max_requests_per_minute = max_requests_per_minute
+        # None disables token accounting (e.g. when the provider has no token estimate)
+        self.max_tokens_per_minute = max_tokens_per_minute
+        # None: a rate limit error does not pause dispatch, only the failed request backs off
+        self.seconds_to_pause_after_rate_limit_error = seconds_to_pause_after_rate_limit_error
+        # None means no cap on concurrent calls besides the rate budgets
+        self.max_in_flight = max_in_flight
+        self.num_in_flight = 0
+
+        self.available_request_capacity = max_requests_per_minute
+        self.available_token_capacity = max_tokens_per_minute or 0
+        self.last_update_time = time.monotonic()
+        self.paused_until = 0.0
+
+        # shared by the per-key buckets of a credential pool, so their releases wake the pool
+        self._condition = condition or asyncio.Condition()
+        self._waiters = collections.deque()  # tickets of pending `acquire` calls, in arrival order
+        self._tickets = itertools.count()
+        self._retries = RetryQueue()
+
+    # capacity
+
+    def _refill(self, now: float) -> None:
+        seconds_since_update = now - self.last_update_time
+        self.available_request_capacity = min(
+            self.available_request_capacity
+            + self.max_requests_per_minute * seconds_since_update / 60.0,
+            self.max_requests_per_minute,
+        )
+        if self.max_tokens_per_minute is not None:
+            self.available_token_capacity = min(
+                self.available_token_capacity
+                + self.max_tokens_per_minute * seconds_since_update / 60.0,
+                self.max_tokens_per_minute,
+            )
+        self.last_update_time = now
+
+    def _seconds_until_available(self, num_tokens: int, now: float) -> float | None:
+        """Seconds until both buckets hold enough capacity for one request of `num_tokens`.
+
+        Returns None when only a `release` can free capacity (the in-flight cap is reached).
+        """
+        if self.max_in_flight is not None and self.num_in_flight >= self.max_in_flight:
+            return None
+        wait = max(0.0, self.paused_until - now)
+        request_deficit = 1 - self.available_request_capacity
+        if request_deficit > 0:
+            wait = max(wait, request_deficit * 60.0 / self.max_requests_per_minute)
+        if self.max_tokens_per_minute is not None:
+            # a request larger than the whole bucket only has to wait for a full bucket
+            needed = min(num_tokens, self.max_tokens_per_minute)
+            token_deficit = needed - self.available_token_capacity
+            if token_deficit > 0:
+                wait = max(wait, token_deficit * 60.0 / self.max_tokens_per_minute)
+        return wait
+
+    def _consume(self, num_tokens: int) -> None:
+        self.available_request_capacity -= 1
+        if self.max_tokens_per_minute is not None:
+            self.available_token_capacity -= num_tokens
+        self.num_in_flight += 1
+
+    def headroom(self) -> float:
+        """Fraction of the fuller-used bucket that is still available, 1.0 when both are full."""
+        self._refill(time.monotonic())
+        headroom = self.available_request_capacity / self.max_requests_per_minute
+        if self.max_tokens_per_minute:
+            headroom = min(headroom, self.available_token_capacity / self.max_tokens_per_minute)
+        return headroom
+
+    async def acquire(self, num_tokens: int = 0) -> None:
+        """Wait until one request and `num_tokens` tokens are available, then consume them.
+
+        Callers are served in arrival order: only the oldest waiter may consume capacity.
+        """
+        ticket = next(self._tickets)
+        async with self._condition:
+            self._waiters.append(ticket)
+            try:
+                while True:
+                    if self._waiters[0] != ticket:
+                        await self._wait(None)  # woken when the waiter ahead is served
+                        continue
+                    now = time.monotonic()
+                    self._refill(now)
+                    delay = self._seconds_until_available(num_tokens, now)
+                    if delay is not None and delay <= 0:
+                        self._consume(num_tokens)
+                        return
+                    logger.debug(f"Waiting {delay}s for capacity ({num_tokens} tokens)")
+                    await self._wait(delay)
+            finally:
+                self._waiters.remove(ticket)
+                self._condition.notify_all()
+
+    def try_acquire(self, num_tokens: int = 0) -> bool:
+        """Consume one request and `num_tokens` tokens if they are available right now.
+
+        Never waits and never overtakes a pending `acquire`, so optional calls (e.g. hedges)
+        only use capacity nobody else is waiting for. Release like `acquire` when done.
+        """
+        if self._waiters:
+            return False
+        now = time.monotonic()
+        self._refill(now)
+        delay = self._seconds_until_available(num_tokens, now)
+        if delay is None or delay > 0:
+            return False
+        self._consume(num_tokens)
+        return True
+
+    async def reconcile_tokens(self, estimated_tokens: int, actual_tokens: int) -> None:
+        """Correct the token bucket once a response reports its usage.
+
+        Over-estimated requests refund the difference (and wake the waiters), under-estimated
+        ones are charged; the bucket may go below zero, delaying the next requests.
+        """
+        if self.max_tokens_per_minute is None or estimated_tokens == actual_tokens:
+            return
+        self._refill(time.monotonic())
+        self.available_token_capacity = min(
+            self.available_token_capacity + estimated_tokens - actual_tokens, self.max_tokens_per_minute
+        )
+        if actual_tokens < estimated_tokens:
+            await self.notify()
+
+    def record_rate_limit_error(self, seconds_to_pause: float | None = None) -> None:
+        """Pause all dispatch to cool down after the provider reported a rate limit error.
+
+        Without a pause (the default), dispatch continues and only the failed request backs off.
+        """
+        if seconds_to_pause is None:
+            seconds_to_pause = self.seconds_to_pause_after_rate_limit_error
+        if not seconds_to_pause:
+            return
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds_to_pause)
+        logger.warning(
+            f"Pausing to cool down until {time.ctime(time.time() + seconds_to_pause)}"
+        )
+
+    def update_from_headers(self, headers) -> None:
+        """Hook for schedulers that adapt to provider rate limit headers."""
+
+    def record_success(self) -> None:
+        """Hook for schedulers that adapt to successful calls."""
+
+    def stats(self) -> dict:
+        return {
+            "max_requests_per_minute": self.max_requests_per_minute,
+            "max_tokens_per_minute": self.max_tokens_per_minute,
+            "max_in_flight": self.max_in_flight,
+        }
+
+    # retries
+
+    def schedule_retry(self, request, delay: float = 0.0) -> None:
+        """Queue `request` to be retried once `delay` seconds have passed."""
+        self._retries.push(request, delay)
+
+    def pop_due_retry(self):
+        """Return the earliest retry whose due time has passed, or None."""
+        return self._retries.pop_due()
+
+    def num_pending_retries(self) -> int:
+        return len(self._retries)
+
+    def num_waiting(self) -> int:
+        """`acquire` calls waiting for capacity."""
+        return len(self._waiters)
+
+    def lane(self, name: str | None = None) -> "SchedulerLane":
+        """A client view sharing this scheduler's budgets, with its own retry queue."""
+        return SchedulerLane(self, name=name)
+
+    # waking
+
+    async def notify(self) -> None:
+        """Wake every coroutine waiting on the scheduler so it re-evaluates its condition."""
+        async with self._condition:
+            self._condition.notify_all()
+
+    async def release(self) -> None:
+        """Mark a call started by `acquire` as finished and wake the waiters."""
+        self.num_in_flight -= 1
+        await self.notify()
+
+    async def wait_until(self, predicate, retries: "RetryQueue | None" = None) -> None:
+        """Sleep until `predicate()` is true or a queued retry becomes due."""
+        if retries is None:
+            retries = self._retries
+        async with self._condition:
+            while not predicate():
+                timeout = retries.seconds_until_next()
+                if timeout == 0:
+                    return
+                await self._wait(timeout)
+
+    async def _wait(self, timeout: float | None) -> None:
+        """Wait for a notification, or at most `timeout` seconds. Must hold the condition."""
+        try:
+            await asyncio.wait_for(self._condition.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+class RetryQueue:
+    """Failed requests ordered by the time their retry becomes due."""
+
+    def __init__(self) -> None:
+        self._heap = []
+        self._counter = itertools.count()  # tie-breaker so requests are never compared
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def push(self, request, delay: float = 0.0) -> None:
+        due = time.monotonic() + delay
+        heapq.heappush(self._heap, (due, next(self._counter), request))
+
+    def pop_due(self):
+        if self._heap and self._heap[0][0] <= time.monotonic():
+            return heapq.heappop(self._heap)[2]
+        return None
+
+    def seconds_until_next(self) -> float | None:
+        if not self._heap:
+            return None
+        return max(0.0, self._heap[0][0] - time.monotonic())
+
+
+class SchedulerLane:
+    """One client of a shared scheduler.
+
+    Budgets, pauses and adaptation go to the shared scheduler; retries stay in the lane so a
+    client never picks up another client's requests.
+    """
+
+    def __init__(self, scheduler: RateLimitScheduler, name: str | None = None) -> None:
+        self.scheduler = scheduler
+        self.name = name
+        self._retries = RetryQueue()
+
+    async def acquire(self, num_tokens: int = 0):
+        return await self.scheduler.acquire(num_tokens)
+
+    def try_acquire(self, num_tokens: int = 0):
+        return self.scheduler.try_acquire(num_tokens)
+
+    def quarantine(self, credential) -> bool:
+        return self.scheduler.quarantine(credential)
+
+    async def release(self) -> None:
+        await self.scheduler.release()
+
+    async def notify(self) -> None:
+        await self.scheduler.notify()
+
+    async def reconcile_tokens(self, estimated_tokens: int, actual_tokens: int) -> None:
+        await self.scheduler.reconcile_tokens(estimated_tokens, actual_tokens)
+
+    def record_rate_limit_error(self, seconds_to_pause: float | None = None) -> None:
+        self.scheduler.record_rate_limit_error(seconds_to_pause)
+
+    def update_from_headers(self, headers) -> None:
+        self.scheduler.update_from_headers(headers)
+
+    def record_success(self) -> None:
+        self.scheduler.record_success()
+
+    def stats(self) -> dict:
+        return self.scheduler.stats()
+
+    def schedule_retry(self, request, delay: float = 0.0) -> None:
+        self._retries.push(request, delay)
+
+    def pop_due_retry(self):
+        return self._retries.pop_due()
+
+    def num_pending_retries(self) -> int:
+        return len(self._retries)
+
+    def num_waiting(self) -> int:
+        return self.scheduler.num_waiting()
+
+    async def wait_until(self, predicate) -> None:
+        await self.scheduler.wait_until(predicate, retries=self._retries)
+
+
+class AdaptiveRateLimitScheduler(RateLimitScheduler):
+    """Scheduler whose budgets follow the provider's `x-ratelimit-*` headers (AIMD).
+
+    The configured budgets are only the starting point. Once the provider reports its limits,
+    the budgets may grow additively up to `target_fraction` of them while more than
+    `headroom_fraction` of the limit is remaining, and every rate limit error halves them.
+
+    A budget whose provider limit is unknown grows by `additive_increase_fraction` of the
+    configured budget after every `successes_per_increase` successful calls, up to the
+    configured budget. Once the provider's reset window (or `default_recovery_seconds`) has
+    passed after a decrease without another rate limit error, the budgets go back to where they
+    were before it. They never drop below `min_fraction` of the provider limit, or of the
+    configured budget while the limit is unknown.
+    """
+
+    def __init__(
+        self,
+        max_requests_per_minute: float,
+        max_tokens_per_minute: float | None = None,
+        seconds_to_pause_after_rate_limit_error: float | None = None,
+        target_fraction: float = 0.9,
+        headroom_fraction: float = 0.2,
+        additive_increase_fraction: float = 0.02,
+        multiplicative_decrease_factor: float = 0.5,
+        min_fraction: float = 0.05,
+        min_seconds_between_decreases: float = 1.0,
+        successes_per_increase: int = 20,
+        default_recovery_seconds: float = 60.0,
+        max_in_flight: int | None = None,
+        condition: asyncio.Condition | None = None,
+    ) -> None:
+        super().__init__(
+            max_requests_per_minute=max_requests_per_minute,
+            max_tokens_per_minute=max_tokens_per_minute,
+            seconds_to_pause_after_rate_limit_error=seconds_to_pause_after_rate_limit_error,
+            max_in_flight=max_in_flight,
+            condition=condition,
+        )
+        self.target_fraction = target_fraction
+        self.headroom_fraction = headroom_fraction
+        self.additive_increase_fraction = additive_increase_fraction
+        self.multiplicative_decrease_factor = multiplicative_decrease_factor
+        self.min_fraction = min_fraction
+        # a burst of in-flight requests failing together should only count as one back-off
+        self.min_seconds_between_decreases = min_seconds_between_decreases
+        self.last_decrease_time = 0.0
+        self.successes_per_increase = successes_per_increase
+        self.default_recovery_seconds = default_recovery_seconds
+        self.configured_requests_per_minute = max_requests_per_minute
+        self.configured_tokens_per_minute = max_tokens_per_minute
+        self._num_successes = 0  # since the last increase or decrease
+        self._recover_at = None  # when the budgets before the last decrease are restored
+        self._budgets_before_decrease = None
+        # ceilings learned from the provider, None until the first response with headers
+        self.request_limit = None
+        self.token_limit = None
+        # seconds until the provider's buckets are full again, from the last response
+        self.seconds_until_request_reset = None
+        self.seconds_until_token_reset = None
+
+    def update_from_headers(self, headers) -> None:
+        limit_requests = _parse_float(headers.get("x-ratelimit-limit-requests"))
+        limit_tokens = _parse_float(headers.get("x-ratelimit-limit-tokens"))
+        remaining_requests = _parse_float(headers.get("x-ratelimit-remaining-requests"))
+        remaining_tokens = _parse_float(headers.get("x-ratelimit-remaining-tokens"))
+        self.seconds_until_request_reset = parse_reset_duration(headers.get("x-ratelimit-reset-requests"))
+        self.seconds_until_token_reset = parse_reset_duration(headers.get("x-ratelimit-reset-tokens"))
+        if limit_requests is None and limit_tokens is None:
+            return
+
+        self._refill(time.monotonic())
+        if limit_requests:
+            self.request_limit = limit_requests
+        if limit_tokens:
+            self.token_limit = limit_tokens
+
+        # the provider's view of the remaining capacity wins over the local estimate
+        if remaining_requests is not None:
+            self.available_request_capacity = min(self.available_request_capacity, remaining_requests)
+        if remaining_tokens is not None and self.max_tokens_per_minute is not None:
+            self.available_token_capacity = min(self.available_token_capacity, remaining_tokens)
+
+        has_headroom = all(
+            remaining is None or not limit or remaining / limit >= self.headroom_fraction
+            for remaining, limit in [
+                (remaining_requests, limit_requests),
+                (remaining_tokens, limit_tokens),
+            ]
+        )
+        if has_headroom:
+            self._increase(requests=self.request_limit is not None, tokens=self.token_limit is not None)
+
+    def record_rate_limit_error(self, seconds_to_pause: float | None = None) -> None:
+        self._decrease()
+        if seconds_to_pause is None and self.seconds_to_pause_after_rate_limit_error:
+            # wait for the exhausted provider bucket to refill, but no longer than the configured pause
+            resets = [r for r in [self.seconds_until_request_reset, self.seconds_until_token_reset] if r]
+            if resets:
+                seconds_to_pause = min(max(resets), self.seconds_to_pause_after_rate_limit_error)
+        super().record_rate_limit_error(seconds_to_pause)
+
+    def record_success(self) -> None:
+        now = time.monotonic()
+        if self._recover_at is not None and now >= self._recover_at:
+            self._recover(now)
+        self._num_successes += 1
+        if self._num_successes >= self.successes_per_increase:
+            self._num_successes = 0
+            # budgets with a known provider limit grow from the headers instead
+            self._increase(requests=self.request_limit is None, tokens=self.token_limit is None)
+
+    def _ceiling(self, limit: float | None, configured: float) -> float:
+        return limit * self.target_fraction if limit else configured
+
+    def _floor(self, limit: float | None, configured: float) -> float:
+        return (limit or configured) * self.min_fraction
+
+    def _increase(self, requests: bool = True, tokens: bool = True) -> None:
+        if requests:
+            ceiling = self._ceiling(self.request_limit, self.configured_requests_per_minute)
+            if self.max_requests_per_minute < ceiling:
+                step = (self.request_limit or self.configured_requests_per_minute) * self.additive_increase_fraction
+                self.max_requests_per_minute = min(ceiling, self.max_requests_per_minute + step)
+        if tokens and self.max_tokens_per_minute is not None:
+            ceiling = self._ceiling(self.token_limit, self.configured_tokens_per_minute)
+            if self.max_tokens_per_minute < ceiling:
+                step = (self.token_limit or self.configured_tokens_per_minute) * self.additive_increase_fraction
+                self.max_tokens_per_minute = min(ceiling, self.max_tokens_per_minute + step)
+
+    def _decrease(self) -> None:
+        now = time.monotonic()
+        if now - self.last_decrease_time < self.min_seconds_between_decreases:
+            return
+        self.last_decrease_time = now
+        self._refill(now)
+        self._num_successes = 0
+        if self._recover_at is None:
+            self._budgets_before_decrease = (self.max_requests_per_minute, self.max_tokens_per_minute)
+        resets = [r for r in [self.seconds_until_request_reset, self.seconds_until_token_reset] if r]
+        self._recover_at = now + (max(resets) if resets else self.default_recovery_seconds)
+        floor = self._floor(self.request_limit, self.configured_requests_per_minute)
+        self.max_requests_per_minute = max(floor, self.max_requests_per_minute * self.multiplicative_decrease_factor)
+        self.available_request_capacity = min(self.available_request_capacity, self.max_requests_per_minute)
+        if self.max_tokens_per_minute is not None:
+            floor = self._floor(self.token_limit, self.configured_tokens_per_minute)
+            self.max_tokens_per_minute = max(floor, self.max_tokens_per_minute * self.multiplicative_decrease_factor)
+            self.available_token_capacity = min(self.available_token_capacity, self.max_tokens_per_minute)
+        logger.warning(
+            f"Rate limited, budgets reduced to {self.max_requests_per_minute:.0f} requests "
+            f"and {self.max_tokens_per_minute or 0:.0f} tokens per minute"
+        )
+
+    def _recover(self, now: float) -> None:
+        """Restore the budgets of before the last decreases, the provider's window has reset since."""
+        max_requests_per_minute, max_tokens_per_minute = self._budgets_before_decrease
+        self._recover_at = None
+        self._budgets_before_decrease = None
+        self._refill(now)
+        self.max_requests_per_minute = max(self.max_requests_per_minute, max_requests_per_minute)
+        if self.max_tokens_per_minute is not None:
+            self.max_tokens_per_minute = max(self.max_tokens_per_minute, max_tokens_per_minute)
+        logger.info(
+            f"No rate limit errors since the reset window, budgets restored to {self.max_requests_per_minute:.0f} "
+            f"requests and {self.max_tokens_per_minute or 0:.0f} tokens per minute"
+        )
+
+    def stats(self) -> dict:
+        return {
+            **super().stats(),
+            "request_limit": self.request_limit,
+            "token_limit": self.token_limit,
+        }
+
+
+_duration_pattern = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+
+
+def parse_reset_duration(value: str | None) -> float | None:
+    """Parse reset durations like "20ms", "1s" or "6m0s" into seconds."""
+    if not value:
+        return None
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    matches = _duration_pattern.findall(value)
+    if not matches:
+        return _parse_float(value)
+    return sum(float(number) * units[unit] for number, unit in matches)
+
+
+def _parse_float(value) -> float | None:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,138 @@
+"""
+GRACEFUL SHUTDOWN
+
+Turns SIGINT (Ctrl-C) and SIGTERM into an orderly stop of the running inference engines
+instead of killing the event loop, so responses that were already paid for are not lost.
+
+On the first signal, every engine stops dispatching new requests and waits up to
+`drain_seconds` for the calls in flight; calls still running after that are cancelled. The
+result writer then writes and flushes everything it has queued, so the output file ends with
+complete lines, and the journal lists every result written. Each engine also writes a
+`<output file>.pending` checkpoint: the line numbers and keys of the requests that were read
+but not finished (queued, waiting for a retry, in flight or cancelled) and the first line
+that was not read yet. The next run with `resume` sends exactly the requests missing from the
+journal, logs the checkpoint and removes it once it has finished. After the drain,
+`run_jobs_concurrently` raises `RunInterrupted`.
+
+A second signal restores the default handlers, so pressing Ctrl-C again aborts immediately.
+
+Usage:
+```
+shutdown = GracefulShutdown(drain_seconds=30)
+with shutdown.handle_signals():
+    await engine.run(...)  # engine created with shutdown=shutdown
+```
+"""
+
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import signal
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DRAIN_SECONDS = 30.0
+SIGNALS = (signal.SIGINT, signal.SIGTERM)
+
+
+class RunInterrupted(Exception):
+    """Raised once the engines have drained after a shutdown signal."""
+
+
+class GracefulShutdown:
+    """Shutdown request shared by the engines of one event loop."""
+
+    def __init__(self, drain_seconds: float = DEFAULT_DRAIN_SECONDS) -> None:
+        self.drain_seconds = drain_seconds
+        self.event = asyncio.Event()
+        self._loop = None
+
+    @property
+    def requested(self) -> bool:
+        return self.event.is_set()
+
+    def request(self, reason: str = "shutdown requested") -> None:
+        if self.requested:
+            return
+        logger.warning(
+            f"{reason}: stopping dispatch, waiting up to {self.drain_seconds:g}s for requests in flight. "
+            "Signal again to abort immediately."
+        )
+        self.event.set()
+
+    @contextlib.contextmanager
+    def handle_signals(self):
+        """Request a shutdown on SIGINT/SIGTERM while in this block (no-op where unsupported)."""
+        self._loop = asyncio.get_running_loop()
+        installed = []
+        for sig in SIGNALS:
+            try:
+                self._loop.add_signal_handler(sig, self._on_signal, sig)
+                installed.append(sig)
+            except (NotImplementedError, RuntimeError, ValueError):
+                logger.debug(f"Cannot handle {sig.name} in this event loop")
+        try:
+            yield self
+        finally:
+            for sig in installed:
+                self._loop.remove_signal_handler(sig)
+
+    def _on_signal(self, sig: signal.Signals) -> None:
+        # the next signal gets the default behaviour, i.e. aborts the run
+        for s in SIGNALS:
+            self._loop.remove_signal_handler(s)
+        self.request(f"Received {sig.name}")
+
+
+async def cancel_on_shutdown(awaitable, shutdown: GracefulShutdown) -> tuple[bool, object]:
+    """Await `awaitable` until it is done or a shutdown is requested, which cancels it.
+
+    Returns whether it finished and its result; its exceptions are raised as usual.
+    """
+    task = asyncio.ensure_future(awaitable)
+    stop = asyncio.ensure_future(shutdown.event.wait())
+    try:
+        await asyncio.wait({task, stop}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        stop.cancel()
+        if not task.done():
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+    if task.cancelled():
+        return False, None
+    return True, task.result()
+
+
+class PendingCheckpoint:
+    """Requests left unfinished by an interrupted run, kept next to its output file."""
+
+    def __init__(self, output_filepath: str) -> None:
+        self.filepath = output_filepath + ".pending"
+
+    def exists(self) -> bool:
+        return os.path.exists(self.filepath)
+
+    def load(self) -> dict | None:
+        if not self.exists():
+            return None
+        with open(self.filepath) as file:
+            return json.load(file)
+
+    def save(self, pending: list[dict], next_line_number: int | None) -> None:
+        checkpoint = {
+            "interrupted_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "next_line_number": next_line_number,  # None if the request file was read to the end
+            "pending": sorted(pending, key=lambda request: request["line_number"]),
+        }
+        tmp_filepath = self.filepath + ".tmp"
+        with open(tmp_filepath, "w") as file:
+            json.dump(checkpoint, file, indent=1)
+        os.replace(tmp_filepath, self.filepath)
+
+    def remove(self) -> None:
+        if self.exists():
+            os.remove(self.filepath)
@@ -0,0 +1,168 @@
+"""
+TOKEN COUNTER
+
+Memoized token counting for request budgeting.
+
+Every essay request repeats the same rubric text in front of the essay, so re-encoding
+whole messages wastes most of the dispatch CPU time. `TokenCounter` loads the tiktoken
+encoder once, splits text into line segments and memoizes the token count of each segment
+in a bounded LRU keyed by a hash of its content. Only the lines that were never seen
+before (i.e. the essay itself) are actually encoded.
+
+Counting per line can differ by a token or so from encoding the whole text at once,
+which is fine for rate limit budgeting.
+
+`encoding_name_for_model` picks the tiktoken encoding of an OpenAI model (o200k_base for the
+gpt-4o family, cl100k_base for gpt-4 and gpt-3.5).
+
+`TokenEstimator` learns from the `usage` reported with each response how far the local count
+is off: a scale for prompt tokens (e.g. Gemini, which is counted with a tiktoken encoding it
+does not use) and the typical number of completion tokens, which is only bounded by
+`max_tokens` in the request and otherwise unknown until the response arrives.
+"""
+
+import hashlib
+import math
+from collections import OrderedDict
+from functools import lru_cache
+
+import tiktoken
+
+DEFAULT_MAX_CACHE_ENTRIES = 8192
+DEFAULT_ENCODING_NAME = "cl100k_base"
+DEFAULT_COMPLETION_TOKENS_ESTIMATE = 256  # until the first responses report their usage
+
+# model name prefixes, most specific first; fine-tuned models ("ft:gpt-4o-mini:...") use their base model's
+MODEL_PREFIX_ENCODINGS = [
+    ("gpt-4o", "o200k_base"),
+    ("gpt-4.1", "o200k_base"),
+    ("gpt-4.5", "o200k_base"),
+    ("chatgpt-4o", "o200k_base"),
+    ("o1", "o200k_base"),
+    ("o3", "o200k_base"),
+    ("o4", "o200k_base"),
+    ("gpt-4", "cl100k_base"),
+    ("gpt-3.5", "cl100k_base"),
+    ("text-embedding-3", "cl100k_base"),
+    ("text-embedding-ada", "cl100k_base"),
+]
+
+
+class TokenCounter:
+    """Counts tokens with a single encoder instance and an LRU of segment counts."""
+
+    def __init__(self, encoding_name: str, max_cache_entries: int = DEFAULT_MAX_CACHE_ENTRIES) -> None:
+        self.encoding_name = encoding_name
+        self.encoding = tiktoken.get_encoding(encoding_name)
+        self.max_cache_entries = max_cache_entries
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+
+    def count(self, text: str) -> int:
+        """Number of tokens in `text`, summed over its memoized line segments."""
+        return sum(self.count_segment(segment) for segment in text.splitlines(keepends=True))
+
+    def count_segment(self, segment: str) -> int:
+        key = hashlib.blake2b(segment.encode("utf-8"), digest_size=16).digest()
+        num_tokens = self._cache.get(key)
+        if num_tokens is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return num_tokens
+
+        self.misses += 1
+        num_tokens = len(self.encoding.encode(segment))
+        self._cache[key] = num_tokens
+        if len(self._cache) > self.max_cache_entries:
+            self._cache.popitem(last=False)
+        return num_tokens
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> dict:
+        return {
+            "encoding": self.encoding_name,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+            "cache_entries": len(self._cache),
+        }
+
+
+@lru_cache(maxsize=None)
+def get_token_counter(encoding_name: str) -> TokenCounter:
+    """Shared counter per encoding, so the encoder is loaded only once per process."""
+    return TokenCounter(encoding_name)
+
+
+def encoding_name_for_model(model: str | None) -> str:
+    """tiktoken encoding of an OpenAI model, `DEFAULT_ENCODING_NAME` if the model is unknown."""
+    if not model:
+        return DEFAULT_ENCODING_NAME
+    if model.startswith("ft:"):
+        model = model.split(":")[1]
+    for prefix, encoding_name in MODEL_PREFIX_ENCODINGS:
+        if model.startswith(prefix):
+            return encoding_name
+    try:
+        return tiktoken.encoding_for_model(model).name
+    except KeyError:
+        return DEFAULT_ENCODING_NAME
+
+
+class TokenEstimator:
+    """Online correction of token estimates from the usage reported by the provider.
+
+    Both quantities are exponentially weighted moving averages, so the estimate follows
+    changes of the prompt or model within a run. The completion estimate adds
+    `num_deviations` standard deviations, so most requests are not under-budgeted.
+    """
+
+    def __init__(
+        self,
+        completion_tokens: float = DEFAULT_COMPLETION_TOKENS_ESTIMATE,
+        smoothing: float = 0.1,
+        num_deviations: float = 1.0,
+    ) -> None:
+        self.smoothing = smoothing
+        self.num_deviations = num_deviations
+        self.prompt_scale = 1.0
+        self.completion_mean = float(completion_tokens)
+        self.completion_variance = 0.0
+        self.num_observations = 0
+
+    def prompt_tokens(self, counted_tokens: int) -> int:
+        return math.ceil(counted_tokens * self.prompt_scale)
+
+    def completion_tokens(self, max_tokens: int | None = None) -> int:
+        """Expected completion tokens of one choice, never more than the request's `max_tokens`."""
+        estimate = math.ceil(self.completion_mean + self.num_deviations * math.sqrt(self.completion_variance))
+        return min(estimate, max_tokens) if max_tokens is not None else estimate
+
+    def observe(self, counted_prompt_tokens: int, prompt_tokens: int, completion_tokens: float) -> None:
+        """Learn from one response: the locally counted and the reported prompt tokens, and the
+        reported completion tokens per choice."""
+        if self.num_observations == 0:
+            # replace the initial guesses instead of slowly moving away from them
+            if counted_prompt_tokens and prompt_tokens:
+                self.prompt_scale = prompt_tokens / counted_prompt_tokens
+            self.completion_mean = float(completion_tokens)
+        else:
+            a = self.smoothing
+            if counted_prompt_tokens and prompt_tokens:
+                self.prompt_scale += a * (prompt_tokens / counted_prompt_tokens - self.prompt_scale)
+            difference = completion_tokens - self.completion_mean
+            self.completion_mean += a * difference
+            self.completion_variance = (1 - a) * (self.completion_variance + a * difference * difference)
+        self.num_observations += 1
+
+    def stats(self) -> dict:
+        return {
+            "observations": self.num_observations,
+            "prompt_scale": round(self.prompt_scale, 4),
+            "completion_tokens_estimate": self.completion_tokens(),
+        }